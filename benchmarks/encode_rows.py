@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of encoding rows of the messages table
+using `Row` objects against the compiled `Table.encode_rows`.
+"""
+import time
+import argparse
+
+from testflows.database.clickhouse import ColumnTypes
+from testflows.database._clickhouse.database import table_from_columns
+
+columns = [
+    ("message_keyword", "Enum8('NONE' = 0, 'TEST' = 1, 'RESULT' = 2, 'NOTE' = 4)"),
+    ("message_hash", "String"),
+    ("message_object", "UInt16"),
+    ("message_num", "UInt32"),
+    ("message_stream", "String"),
+    ("message_level", "UInt32"),
+    ("message_time", "Float64"),
+    ("message_rtime", "Float64"),
+    ("test_type", "Enum8('' = 0, 'Module' = 40, 'Suite' = 30, 'Test' = 20, 'Step' = 10)"),
+    ("test_subtype", "Enum8('' = 0, 'Feature' = 60, 'Scenario' = 50, 'Given' = 30, 'When' = 20)"),
+    ("test_id", "String"),
+    ("test_flags", "UInt32"),
+    ("test_cflags", "UInt32"),
+    ("test_level", "UInt32"),
+    ("test_name", "String"),
+    ("test_uid", "String"),
+    ("test_description", "String"),
+    ("attribute_name", "String"),
+    ("attribute_value", "String"),
+    ("example_row", "UInt32"),
+    ("example_columns", "Array(String)"),
+    ("example_values", "Array(String)"),
+    ("message", "String"),
+    ("metric_name", "String"),
+    ("metric_value", "Float64"),
+    ("result_message", "String"),
+    ("result_type", "Enum8('' = 0, 'OK' = 1, 'Fail' = 2, 'Error' = 3)"),
+    ("result_test", "String")
+]
+
+def messages(count):
+    """Return messages similar to the ones in a test log.
+    """
+    rows = []
+    for i in range(count):
+        rows.append({
+            "message_keyword": ("TEST", "NOTE", "RESULT")[i % 3],
+            "message_hash": f"{i:08x}",
+            "message_object": 1,
+            "message_num": i,
+            "message_stream": None,
+            "message_level": 2,
+            "message_time": 1600000000.0 + i,
+            "message_rtime": i / 1000,
+            "test_type": "Test",
+            "test_subtype": "Scenario",
+            "test_id": f"/regression/feature/scenario {i % 100}",
+            "test_flags": 0,
+            "test_cflags": 0,
+            "test_level": 3,
+            "test_name": f"/regression/feature/scenario {i % 100}",
+            "test_uid": None,
+            "test_description": None,
+            "message": f"note {i}" if i % 3 == 1 else None,
+            "result_type": "OK" if i % 3 == 2 else None
+        })
+    return rows
+
+def row_path(table, rows):
+    """Encode rows as VALUES using `Row` objects.
+    """
+    values = []
+    for message in rows:
+        row = table.default_row()
+        for key, value in message.items():
+            if value is not None:
+                row[key] = value
+        values.append(f"({','.join(row.values())})")
+    return ",".join(values).encode("utf-8")
+
+def encode_rows_path(table, rows):
+    """Encode rows in RowBinary format using the compiled encoder.
+    """
+    return table.encode_rows(rows)
+
+def run(name, func, table, rows, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        data = func(table, rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<16} {len(rows) / best:>14,.0f} rows/s {len(data):>12,} bytes")
+    return best
+
+def argparser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000, help="number of rows, default: 100000")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs, default: 5")
+    return parser
+
+if __name__ == "__main__":
+    args = argparser().parse_args()
+    table = table_from_columns("default", "messages", ColumnTypes(),
+        [{"name": name, "type": type} for name, type in columns])
+    rows = messages(args.rows)
+    row = run("Row", row_path, table, rows, args.repeat)
+    compiled = run("encode_rows", encode_rows_path, table, rows, args.repeat)
+    print(f"speedup {row / compiled:.1f}x")
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark suite that runs against a local fake ClickHouse HTTP server
+and writes results in JSON format.
+
+Benchmarks:
+    encode     encoding rows using Row objects and Table.encode_rows
+    decode     decoding query responses of different sizes
+    io         DatabaseConnection.io latency
+    transform  messages per second written by the transform
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import threading
+
+from server import FakeClickHouse
+from encode_rows import messages, row_path
+
+from testflows.database.clickhouse import Database, DatabaseConnection, ColumnTypes, transform
+from testflows.database._clickhouse import jsonbackend
+from testflows.database._clickhouse.database import table_from_columns, columns_from_tsv
+
+benchmarks = ["encode", "decode", "io", "transform"]
+
+def timeit(func, repeat):
+    """Return list of run times of the function in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def result(name, unit, value, **extra):
+    return dict(name=name, unit=unit, value=round(value, 6), **extra)
+
+def encode(server, args):
+    table = table_from_columns("default", "messages", ColumnTypes(), [{"name": name, "type": type}
+        for name, type in server.columns])
+    rows = messages(args.rows)
+    results = []
+    for name, func in (("Row", lambda: row_path(table, rows)), ("encode_rows", lambda: table.encode_rows(rows))):
+        best = min(timeit(func, args.repeat))
+        results.append(result(f"encode.{name}", "rows/s", len(rows) / best, rows=len(rows)))
+    return results
+
+def decode(server, args):
+    results = []
+    for size in args.sizes:
+        content = server.rows(size, "JSONEachRow")
+        tsv = server.rows(size, "TabSeparatedWithNamesAndTypes")
+        decoders = (
+            ("rejoin", lambda: json.loads(f"[{','.join(content.decode('utf-8').splitlines())}]")),
+            (f"jsonbackend.{jsonbackend.backend}", lambda: jsonbackend.loads_rows(content)),
+            ("columns.tsv", lambda: columns_from_tsv(tsv))
+        )
+        for name, func in decoders:
+            best = min(timeit(func, args.repeat))
+            results.append(result(f"decode.{name}.{size}", "rows/s", size / best, rows=size, bytes=len(content)))
+    return results
+
+def io(server, args):
+    connection = DatabaseConnection("127.0.0.1", "default", port=server.port)
+    times = []
+    errors = 0
+    for i in range(args.queries):
+        start = time.perf_counter()
+        try:
+            connection.io("SELECT 1", data=True)
+        except Exception:
+            errors += 1
+        times.append(time.perf_counter() - start)
+    connection.close()
+    times.sort()
+    quantile = lambda q: times[min(len(times) - 1, int(q * len(times)))]
+    return [
+        result("io.latency.mean", "s", statistics.mean(times), queries=len(times), errors=errors),
+        result("io.latency.p50", "s", quantile(0.5)),
+        result("io.latency.p90", "s", quantile(0.9)),
+        result("io.latency.p99", "s", quantile(0.99))
+    ]
+
+def transform_rate(server, args):
+    lines = [json.dumps(row, separators=(",", ":")) + "\n" for row in messages(args.messages)]
+    results = []
+    for format in ("JSONEachRow", "RowBinary"):
+        database = Database(DatabaseConnection("127.0.0.1", "default", port=server.port))
+        spool = tempfile.mkdtemp() if server.error_rate else None
+        inserted = server.inserted_bytes
+        stop = threading.Event()
+        start = time.perf_counter()
+        writer = transform(database, stop, format=format, max_batch_rows=args.batch_rows, spool=spool)
+        next(writer)
+        for i, line in enumerate(lines):
+            if i == len(lines) - 1:
+                stop.set()
+            writer.send(line)
+        elapsed = time.perf_counter() - start
+        database.connection.close()
+        results.append(result(f"transform.{format}", "messages/s", len(lines) / elapsed,
+            messages=len(lines), bytes=server.inserted_bytes - inserted))
+    return results
+
+runners = {
+    "encode": encode,
+    "decode": decode,
+    "io": io,
+    "transform": transform_rate
+}
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "json_backend": jsonbackend.backend
+    }
+
+def argparser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", metavar="benchmark", nargs="*",
+        help=f"benchmarks to run either {', '.join(benchmarks)}, default: all")
+    parser.add_argument("-o", "--output", type=str, default="-", help="output file, default: stdout")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs, default: 5")
+    parser.add_argument("--rows", type=int, default=20000, help="number of rows to encode, default: 20000")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000],
+        help="number of rows in decoded responses, default: 10 1000 100000")
+    parser.add_argument("--queries", type=int, default=200, help="number of io queries, default: 200")
+    parser.add_argument("--messages", type=int, default=100000,
+        help="number of messages written by the transform, default: 100000")
+    parser.add_argument("--batch-rows", type=int, default=10000,
+        help="maximum number of messages in a batch, default: 10000")
+    parser.add_argument("--latency", type=float, default=0, help="server response latency in seconds, default: 0")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of failed requests, default: 0")
+    parser.add_argument("--throughput", type=float, default=None,
+        help="server response throughput in bytes per second, default: unlimited")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, default: 0")
+    return parser
+
+if __name__ == "__main__":
+    parser = argparser()
+    args = parser.parse_args()
+    selected = args.benchmarks or benchmarks
+    for name in selected:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark '{name}'")
+
+    report = {
+        "environment": environment(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("benchmarks", "output")},
+        "results": []
+    }
+
+    with FakeClickHouse(latency=args.latency, error_rate=args.error_rate,
+            throughput=args.throughput, seed=args.seed) as server:
+        for name in selected:
+            for r in runners[name](server, args):
+                print(f"{r['name']:<32} {r['value']:>16,.6g} {r['unit']}", file=sys.stderr)
+                report["results"].append(r)
+
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as fd:
+            fd.write(output + "\n")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local stand-in for the ClickHouse HTTP interface used by the benchmarks.
+
+The server answers the queries issued by this package without storing
+any data. SELECT queries return generated rows, queries against
+`system.columns` return the columns of the `messages` table and inserts
+are read, decompressed and counted. Latency, error rate and throughput
+of the responses can be configured. Failed requests return transient
+errors that the client retries. Queries against system tables
+never fail.
+"""
+import re
+import gzip
+import json
+import zlib
+import time
+import socket
+import random
+import argparse
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from testflows.database._clickhouse.schema import columns
+
+limit_re = re.compile(r"\bLIMIT\s+(\d+)", re.IGNORECASE)
+format_re = re.compile(r"\bFORMAT\s+(\w+)\s*$", re.IGNORECASE)
+
+#: transient errors injected into responses as (status, body),
+#: the same ones the client retries
+injected_errors = [
+    (503, b"Service Unavailable\n"),
+    (503, b"Code: 202. DB::Exception: Too many simultaneous queries. (TOO_MANY_SIMULTANEOUS_QUERIES)\n"),
+    (500, b"Code: 252. DB::Exception: Too many parts. Merges are processing significantly slower than inserts."
+        b" (TOO_MANY_PARTS)\n")
+]
+
+def schema_columns():
+    """Return (name, type) of the columns of the messages table
+    that are not materialized.
+    """
+    return [(name, definition) for name, definition in columns() if " MATERIALIZED " not in f" {definition} "]
+
+decompressors = {
+    "gzip": gzip.decompress,
+    "deflate": zlib.decompress
+}
+
+try:
+    import zstandard
+    decompressors["zstd"] = lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    decompressors["lz4"] = lz4.frame.decompress
+except ImportError:
+    pass
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super(Handler, self).setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b"", content_type="text/plain; charset=UTF-8"):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not server.throughput:
+            self.wfile.write(body)
+            return
+        chunk_size = 65536
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / server.throughput)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/ping":
+            return self.send(200, b"Ok.\n")
+        return self.send(404, b"Not found\n")
+
+    def do_POST(self):
+        server = self.server
+        params = {k: v[-1] for k, v in parse_qs(urlparse(self.path).query).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        encoding = self.headers.get("Content-Encoding")
+        if encoding:
+            body = decompressors[encoding](body)
+
+        if "query" in params:
+            query, data = params["query"], body
+        else:
+            query, data = body.decode("utf-8"), b""
+
+        with server.lock:
+            server.requests += 1
+            # metadata queries do not fail so that benchmarks can set up
+            failed = "system." not in query and server.random.random() < server.error_rate
+            if failed:
+                status, message = server.random.choice(injected_errors)
+
+        if failed:
+            return self.send(status, message)
+
+        statement = query.lstrip().upper()
+        if statement.startswith("INSERT"):
+            rows = data.count(b"\n") if "JSONEachRow" in query else None
+            with server.lock:
+                server.inserts += 1
+                server.inserted_bytes += len(data)
+                if rows is not None:
+                    server.inserted_rows += rows
+            return self.send(200)
+
+        if not statement.startswith(("SELECT", "WITH")):
+            return self.send(200)
+
+        match = format_re.search(query)
+        format = match.group(1) if match else "TabSeparated"
+
+        if "system.columns" in query:
+            rows = [{"name": name, "type": type} for name, type in server.columns]
+            return self.send(200, server.encode(rows, format))
+
+        match = limit_re.search(query)
+        count = int(match.group(1)) if match else 1
+        return self.send(200, server.rows(count, format))
+
+
+class FakeClickHouse(ThreadingHTTPServer):
+    """Fake ClickHouse HTTP server.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, error_rate=0, throughput=None, seed=0):
+        """
+        :param host: host, default: '127.0.0.1'
+        :param port: port, default: 0 (any free port)
+        :param latency: response latency in seconds, default: 0
+        :param error_rate: fraction of requests that fail, default: 0
+        :param throughput: response throughput in bytes per second, default: None (unlimited)
+        :param seed: seed of the random number generator used for errors, default: 0
+        """
+        super(FakeClickHouse, self).__init__((host, port), Handler)
+        self.latency = float(latency)
+        self.error_rate = float(error_rate)
+        self.throughput = float(throughput) if throughput else None
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.columns = schema_columns()
+        self.thread = None
+        self.requests = 0
+        self.inserts = 0
+        self.inserted_rows = 0
+        self.inserted_bytes = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def rows(self, count, format):
+        if format == "JSONEachRow":
+            return b"".join(b'{"number":"%d"}\n' % i for i in range(count))
+        if format == "TabSeparatedWithNamesAndTypes":
+            return b"number\nUInt64\n" + b"".join(b"%d\n" % i for i in range(count))
+        return b"".join(b"%d\n" % i for i in range(count))
+
+    def encode(self, rows, format):
+        if format == "JSONEachRow":
+            return "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+        return "".join("\t".join(row.values()) + "\n" for row in rows).encode("utf-8")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.stop()
+
+def argparser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host, default: 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8123, help="port, default: 8123")
+    parser.add_argument("--latency", type=float, default=0, help="response latency in seconds, default: 0")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests that fail, default: 0")
+    parser.add_argument("--throughput", type=float, default=None,
+        help="response throughput in bytes per second, default: unlimited")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, default: 0")
+    return parser
+
+if __name__ == "__main__":
+    args = argparser().parse_args()
+    server = FakeClickHouse(host=args.host, port=args.port, latency=args.latency,
+        error_rate=args.error_rate, throughput=args.throughput, seed=args.seed)
+    print(f"listening on http://{args.host}:{server.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -48,6 +48,12 @@ setup(
     extras_require={
         "dev": [
             "testflows.core>=1.6"
+        ],
+        "async": [
+            "aiohttp"
+        ],
+        "json": [
+            "orjson"
         ]
     }
 )
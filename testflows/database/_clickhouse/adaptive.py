@@ -0,0 +1,108 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import threading
+
+#: query to get the maximum number of active parts in a partition of the table
+parts_query = ("SELECT max(parts) AS parts FROM (SELECT count() AS parts FROM system.parts"
+    " WHERE database = currentDatabase() AND table = {table:String} AND active GROUP BY partition)")
+
+class BatchController:
+    """Controller that adapts the flush interval and the maximum
+    batch size of the writer.
+
+    The flush interval is kept close to one insert every 1/`target_insert_rate`
+    seconds and is increased when the insert latency goes above `max_insert_latency`
+    or when the number of active parts in a partition grows above half of `max_parts`
+    so that MergeTree merges can keep up. The maximum batch size is halved
+    when an insert takes longer than `max_insert_latency` and is increased
+    when full batches are inserted quickly.
+    """
+    latency_weight = 0.2
+
+    def __init__(self, min_flush_interval=0.25, max_flush_interval=10, min_batch_rows=1000,
+            max_batch_rows=100000, target_insert_rate=1, max_insert_latency=1, max_parts=300,
+            parts_check_interval=10):
+        """
+        :param min_flush_interval: minimum flush interval in seconds, default: 0.25
+        :param max_flush_interval: maximum flush interval in seconds, default: 10
+        :param min_batch_rows: minimum batch size, default: 1000
+        :param max_batch_rows: maximum batch size, default: 100000
+        :param target_insert_rate: target number of inserts per second, default: 1
+        :param max_insert_latency: maximum insert latency in seconds, default: 1
+        :param max_parts: maximum number of active parts in a partition, default: 300
+        :param parts_check_interval: interval in seconds between part count checks, default: 10
+        """
+        self.min_flush_interval = float(min_flush_interval)
+        self.max_flush_interval = float(max_flush_interval)
+        self.min_batch_rows = int(min_batch_rows)
+        self.max_batch_rows = int(max_batch_rows)
+        self.target_insert_rate = float(target_insert_rate)
+        self.max_insert_latency = float(max_insert_latency)
+        self.max_parts = int(max_parts)
+        self.parts_check_interval = float(parts_check_interval)
+        self.lock = threading.Lock()
+        self.latency = None
+        self.parts = None
+        self.parts_checked = None
+        self.batch_rows = self.max_batch_rows
+        self.flush_interval = None
+        self.adjust_flush_interval()
+
+    def observe(self, rows, latency):
+        """Update controller using the size and the latency
+        of a completed insert.
+
+        :param rows: number of rows in the batch
+        :param latency: insert latency in seconds
+        """
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.latency_weight * (latency - self.latency)
+
+            if latency > self.max_insert_latency:
+                self.batch_rows = max(self.min_batch_rows, min(self.batch_rows, rows) // 2)
+            elif self.latency < self.max_insert_latency / 2 and rows >= self.batch_rows:
+                self.batch_rows = min(self.max_batch_rows, self.batch_rows * 3 // 2)
+
+            self.adjust_flush_interval()
+
+    def check_parts(self):
+        """Return True if part count should be checked.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.parts_checked is not None and now - self.parts_checked < self.parts_check_interval:
+                return False
+            self.parts_checked = now
+            return True
+
+    def observe_parts(self, parts):
+        """Update controller using the maximum number
+        of active parts in a partition.
+        """
+        with self.lock:
+            self.parts = parts
+            self.adjust_flush_interval()
+
+    def adjust_flush_interval(self):
+        interval = 1 / self.target_insert_rate
+        if self.latency is not None and self.latency > self.max_insert_latency:
+            interval *= self.latency / self.max_insert_latency
+        if self.parts is not None and self.parts > self.max_parts / 2:
+            interval *= 2 * self.parts / self.max_parts
+        self.flush_interval = min(self.max_flush_interval, max(self.min_flush_interval, interval))
@@ -0,0 +1,85 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import json
+import threading
+import collections
+
+class Checkpoint:
+    """Log offset up to which all the messages
+    have been durably committed to the database.
+
+    Batches are added in log order and can complete
+    in any order. The offset only advances past a batch
+    once the batch and all the batches before it are done.
+    """
+    def __init__(self, path, head=None):
+        """
+        :param path: checkpoint file path
+        :param head: identifier of the log, for example, hash of its first line,
+            stored offset is ignored if it was recorded for a different log
+        """
+        self.path = path
+        self.head = head
+        self.lock = threading.Lock()
+        self.batches = collections.deque()
+        self.offset = 0
+        self.complete = False
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as fd:
+                data = json.load(fd)
+            if head is None or data.get("head") == head:
+                self.offset = int(data["offset"])
+                self.complete = bool(data.get("complete", False))
+
+        self.start = self.offset
+
+    def add(self, offset):
+        """Add batch that ends at the log offset.
+
+        :param offset: log offset right after the last message in the batch
+        """
+        batch = [offset, False]
+        with self.lock:
+            self.batches.append(batch)
+        return batch
+
+    def done(self, batch):
+        """Mark batch as committed and advance the checkpoint.
+        """
+        with self.lock:
+            batch[1] = True
+            offset = None
+            while self.batches and self.batches[0][1]:
+                offset = self.batches.popleft()[0]
+            if offset is not None:
+                self.offset = offset
+                self.save()
+
+    def finish(self):
+        """Mark the whole log as committed.
+        """
+        with self.lock:
+            self.complete = True
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump({"offset": self.offset, "head": self.head, "complete": self.complete}, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_path, self.path)
@@ -12,18 +12,300 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import re
+import gzip
 import json
+import zlib
+import uuid
+import time
+import asyncio
+import struct
 import requests
 import datetime
+import threading
+import importlib.util
+
+from collections import OrderedDict
 
 from testflows.database.base import *
+from testflows.database._clickhouse import jsonbackend
+from testflows.database._clickhouse.retry import error_class, default_policies, idempotent
+from testflows.database._clickhouse.routes import view_table
+from testflows.database._clickhouse import rollups
+from testflows.database.metrics import registry
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+compressors = {
+    "gzip": lambda data: gzip.compress(data, compresslevel=3),
+    "deflate": zlib.compress
+}
+
+if zstandard is not None:
+    compressors["zstd"] = lambda data: zstandard.ZstdCompressor().compress(data)
+
+if lz4 is not None:
+    compressors["lz4"] = lz4.frame.compress
+
+if brotli is not None:
+    compressors["br"] = brotli.compress
+
+try:
+    from urllib3.util.request import ACCEPT_ENCODING
+except ImportError:
+    ACCEPT_ENCODING = "gzip,deflate"
+
+# response encodings that the installed urllib3 used by requests
+# can decode, for example urllib3 1.x can't decode zstd
+decompressors = [encoding for encoding in ACCEPT_ENCODING.split(",")
+    if encoding in ("gzip", "deflate", "br", "zstd")]
+
+tsv_escapes = {b"b": b"\b", b"f": b"\f", b"r": b"\r", b"n": b"\n", b"t": b"\t", b"0": b"\0"}
+tsv_escape_re = re.compile(rb"\\(.)", re.S)
+
+def tsv_unescape(value):
+    if b"\\" not in value:
+        return value.decode("utf-8")
+    return tsv_escape_re.sub(lambda m: tsv_escapes.get(m.group(1), m.group(1)), value).decode("utf-8")
+
+def tsv_column(type, values):
+    """Return column array for the TSV values of the specified type.
+    Numeric columns are returned as NumPy arrays when NumPy
+    is installed and all other columns as lists.
+    """
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if type.startswith("LowCardinality("):
+        type = type[len("LowCardinality("):-1]
+
+    if type.startswith(("Int", "UInt")) and type[-1].isdigit():
+        if numpy is not None and int(type.rsplit("Int", 1)[-1]) <= 64:
+            return numpy.array(values, dtype="S").astype(numpy.uint64 if type.startswith("U") else numpy.int64)
+        return [int(value) for value in values]
+    elif type.startswith("Float"):
+        if numpy is not None:
+            return numpy.array(values, dtype="S").astype(numpy.float64)
+        return [float(value) for value in values]
+    elif type.startswith("Nullable("):
+        return [None if value == b"\\N" else tsv_unescape(value) for value in values]
+    return [tsv_unescape(value) for value in values]
+
+def columns_from_tsv(content):
+    """Return columns from TabSeparatedWithNamesAndTypes formatted content.
+    """
+    lines = content.split(b"\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    if len(lines) < 2:
+        return OrderedDict()
+    names = [tsv_unescape(name) for name in lines[0].split(b"\t")]
+    types = [tsv_unescape(type) for type in lines[1].split(b"\t")]
+    values = list(zip(*[line.split(b"\t") for line in lines[2:]])) or [()] * len(names)
+    return OrderedDict([(name, tsv_column(type, column)) for name, type, column in zip(names, types, values)])
+
+def columns_from_arrow(content):
+    """Return columns from ArrowStream formatted content
+    as `pyarrow` arrays.
+    """
+    import pyarrow.ipc
+
+    table = pyarrow.ipc.open_stream(content).read_all()
+    return OrderedDict([(name, table.column(i).combine_chunks()) for i, name in enumerate(table.column_names)])
+
+column_formats = {
+    "ArrowStream": columns_from_arrow,
+    "TabSeparatedWithNamesAndTypes": columns_from_tsv
+}
+
+def columns_format(format):
+    """Return ClickHouse format used to get columns.
+
+    :param format: either 'columns' to use 'ArrowStream' format when `pyarrow`
+        is installed and 'TabSeparatedWithNamesAndTypes' otherwise
+        or one of the supported columns formats
+    """
+    if format == "columns":
+        if importlib.util.find_spec("pyarrow") is not None:
+            return "ArrowStream"
+        return "TabSeparatedWithNamesAndTypes"
+    if format not in column_formats:
+        raise ValueError(f"unsupported format '{format}'")
+    return format
+
+epoch_date = datetime.date(1970, 1, 1)
+
+def timestamp(d):
+    """Return Unix timestamp of the datetime treating naive
+    datetimes as UTC the same way as the text format
+    that sends them as is to the server.
+    """
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=datetime.timezone.utc)
+    return d.timestamp()
+
+def varuint(n):
+    """Return LEB128 encoded unsigned integer
+    used for lengths in RowBinary format.
+    """
+    if n < 0x80:
+        return bytes((n,))
+    b = bytearray()
+    while n >= 0x80:
+        b.append((n & 0x7f) | 0x80)
+        n >>= 7
+    b.append(n)
+    return bytes(b)
+
+int_type_re = re.compile(r"^U?Int(8|16|32|64|128|256)$")
+
+def unsupported_encoder(name):
+    """Return RowBinary encoder of a type
+    that can't be encoded.
+    """
+    def encode(value):
+        raise TypeError(f"RowBinary encoding of '{name}' values is not supported")
+    return encode
+
+def int_struct(name):
+    """Return struct, mask and sign offset
+    for the integer type.
+    """
+    bits = int(name.rsplit("Int", 1)[-1])
+    signed = not name.startswith("U")
+    mask = (1 << bits) - 1
+    half = (1 << (bits - 1)) if signed else 0
+    fmt = {8: "b", 16: "h", 32: "i", 64: "q"}.get(bits)
+    if fmt is None:
+        return None, bits, signed, mask, half
+    return struct.Struct("<" + (fmt if signed else fmt.upper())), bits, signed, mask, half
+
+def enum_values(name):
+    """Return mapping of names to values
+    for the Enum type.
+    """
+    return {re.sub(r"\\(.)", r"\1", k): int(v) for k, v in
+        re.findall(r"'((?:[^'\\]|\\.)*)'\s*=\s*(-?\d+)", name)}
+
+def compile_encoder(columns):
+    """Return function that encodes an iterable of rows
+    in RowBinary format for the specified table columns.
 
+    The source of the function is generated for the columns
+    so that integer, float, Enum and String values are encoded
+    inline and consecutive fixed width values of a row are packed using
+    one struct call. Values of other types use the column type encoder.
+    """
+    namespace = {"varuint": varuint}
+    body = []
+    fixed = []
+
+    def pack():
+        if fixed:
+            packer = f"pack{len(namespace)}"
+            namespace[packer] = struct.Struct("<" + "".join(fmt for fmt, _ in fixed)).pack
+            body.append(f"data += {packer}({', '.join(v for _, v in fixed)})")
+            fixed.clear()
+
+    for i, column in enumerate(columns.values()):
+        name = column.type.name
+        if name.startswith("LowCardinality("):
+            name = name.split("(", 1)[-1][:-1]
+        v = f"v{i}"
+        body.append(f"{v} = get({column.name!r})")
+
+        if int_type_re.match(name):
+            packer, bits, signed, mask, half = int_struct(name)
+            if packer is None:
+                pack()
+                namespace[f"encode{i}"] = column.type.encode
+                body.append(f"data += encode{i}({v})")
+                continue
+            body.append(f"{v} = ({v} if {v}.__class__ is int else int({v} or 0)) & {mask}")
+            if signed:
+                body.append(f"{v} = (({v} + {half}) & {mask}) - {half}")
+            fixed.append((packer.format[-1], v))
+
+        elif name in ("Float32", "Float64"):
+            body.append(f"{v} = {v} if {v}.__class__ is float else float({v} or 0)")
+            fixed.append(("f" if name == "Float32" else "d", v))
+
+        elif name.startswith("Enum"):
+            values = enum_values(name)
+            namespace[f"enum{i}"] = values
+            body.append(f"{v} = {min(values.values()) if values else 0} if {v} is None"
+                f" else {v} if {v}.__class__ is int else enum{i}[{v}]")
+            fixed.append(("b" if name.startswith("Enum8") else "h", v))
+
+        elif name == "String":
+            pack()
+            body += [
+                f"if {v}:",
+                f"    {v} = {v} if {v}.__class__ is bytes else ({v} if {v}.__class__ is str else str({v})).encode('utf-8')",
+                f"    n = len({v})",
+                "    if n < 128:",
+                "        append(n)",
+                "    else:",
+                "        data += varuint(n)",
+                f"    data += {v}",
+                "else:",
+                "    append(0)"
+            ]
+
+        else:
+            pack()
+            namespace[f"encode{i}"] = column.type.encode
+            body.append(f"data += encode{i}({v})")
+
+    pack()
+
+    namespace["encode_row"] = lambda row: b"".join([column.type.encode(row.get(column.name))
+        for column in columns.values()])
+
+    source = "\n".join([
+        "def encode_rows(rows):",
+        "    data = bytearray()",
+        "    append = data.append",
+        "    row = None",
+        "    try:",
+        "        for row in rows:",
+        "            get = row.get"] + [f"            {line}" for line in body] + [
+        "    except KeyError:",
+        "        # raise the error of the column encoder",
+        "        encode_row(row)",
+        "        raise",
+        "    return bytes(data)"
+    ])
+    exec(compile(source, "<encode_rows>", "exec"), namespace)
+    return namespace["encode_rows"]
+
+encoders = {}
 
 class ColumnTypes(ColumnTypes):
     def __getitem__(self, name):
         if name.startswith("Array"):
-            type_name = name.split("(")[-1].strip("()")
-            return self.Array(name, self[type_name].convert)
+            type_name = name.split("(", 1)[-1][:-1]
+            return self.Array(name, self[type_name])
+        elif name.startswith("LowCardinality"):
+            return self[name.split("(", 1)[-1][:-1]]
+        elif name.startswith("SimpleAggregateFunction("):
+            # values are stored using the type of the argument
+            return self[name[len("SimpleAggregateFunction("):-1].split(",", 1)[-1].strip()]
         elif "Int" in name:
             return self.Int(name)
         elif "Float" in name:
@@ -46,14 +328,38 @@ class ColumnTypes(ColumnTypes):
                 return '1'
             return str(i)
 
-        return ColumnType(name, convert, "0")
+        if not int_type_re.match(name):
+            # wrapped or composite type such as Nullable(UInt8) or Map(String, UInt64)
+            return ColumnType(name, convert, "0", unsupported_encoder(name))
+
+        packer, bits, signed, mask, half = int_struct(name)
+
+        def encode(i):
+            if not i:
+                i = 0
+            i = int(i) & mask
+            if signed:
+                i = ((i + half) & mask) - half
+            if packer is None:
+                return i.to_bytes(bits // 8, "little", signed=signed)
+            return packer.pack(i)
+
+        return ColumnType(name, convert, "0", encode)
 
     @classmethod
     def Float(cls, name):
         def convert(f):
             return repr(f)[1:-1]
 
-        return ColumnType(name, convert, "0")
+        if name not in ("Float32", "Float64"):
+            return ColumnType(name, convert, "0", unsupported_encoder(name))
+
+        packer = struct.Struct("<f" if name == "Float32" else "<d")
+
+        def encode(f):
+            return packer.pack(float(f or 0))
+
+        return ColumnType(name, convert, "0", encode)
 
     @classmethod
     def String(cls, name):
@@ -62,7 +368,14 @@ class ColumnTypes(ColumnTypes):
                 return "''"
             return f"'{json.dumps(s)[1:-1]}'"
 
-        return ColumnType(name, convert, "''")
+        def encode(s):
+            if not s:
+                return b"\x00"
+            if type(s) is not bytes:
+                s = str(s).encode("utf-8")
+            return varuint(len(s)) + s
+
+        return ColumnType(name, convert, "''", encode)
 
     @classmethod
     def Enum(cls, name):
@@ -73,85 +386,669 @@ class ColumnTypes(ColumnTypes):
                 return "''"
             return f"'{json.dumps(e)[1:-1]}'"
 
-        return ColumnType(name, convert, "''")
+        values = enum_values(name)
+        packer = struct.Struct("<b" if name.startswith("Enum8") else "<h")
+        default = packer.pack(min(values.values()) if values else 0)
+        encoded = {k: packer.pack(v) for k, v in values.items()}
+
+        def encode(e):
+            if e is None:
+                return default
+            if type(e) is int:
+                return packer.pack(e)
+            try:
+                return encoded[e]
+            except KeyError:
+                raise ValueError(f"'{e}' is not a valid value for {name}") from None
+
+        return ColumnType(name, convert, "''", encode)
 
     @classmethod
-    def Array(cls, name, type_convert):
+    def Array(cls, name, type):
+        type_convert = type.convert
+        type_encode = type.encode
+
         def convert(l):
             return f"[{','.join([type_convert(e) for e in l])}]"
 
-        return ColumnType(name, convert, "[]")
+        def encode(l):
+            if not l:
+                return b"\x00"
+            return varuint(len(l)) + b"".join([type_encode(e) for e in l])
+
+        return ColumnType(name, convert, "[]", encode)
 
     @classmethod
     def Date(cls):
         def convert(d):
             return f"'{d.strftime('%Y-%m-%d')}'"
 
-        return ColumnType('Date', convert, '0')
+        def encode(d):
+            if not d:
+                d = 0
+            elif isinstance(d, str):
+                d = datetime.date.fromisoformat(d[:10])
+            if isinstance(d, datetime.datetime):
+                d = d.date()
+            if isinstance(d, datetime.date):
+                d = (d - epoch_date).days
+            return struct.pack("<H", int(d))
+
+        return ColumnType('Date', convert, '0', encode)
 
     @classmethod
     def DateTime(cls):
         def convert(d):
             return f"'{d.strftime('%Y-%m-%d %H:%M:%S')}'"
 
-        return ColumnType('DateTime', convert, '0')
+        def encode(d):
+            if not d:
+                d = 0
+            elif isinstance(d, str):
+                d = datetime.datetime.fromisoformat(d)
+            if isinstance(d, datetime.datetime):
+                d = timestamp(d)
+            return struct.pack("<I", int(d))
+
+        return ColumnType('DateTime', convert, '0', encode)
 
     @classmethod
     def DateTime64(cls, name, precision):
         def convert(d):
-            return f"%.{precision}f" % d.timestamp()
+            return f"%.{precision}f" % timestamp(d)
 
-        return ColumnType(name, convert, '0')
+        scale = 10 ** int(precision)
+
+        def encode(d):
+            if not d:
+                d = 0
+            elif isinstance(d, str):
+                d = datetime.datetime.fromisoformat(d)
+            if isinstance(d, datetime.datetime):
+                d = timestamp(d)
+            return struct.pack("<q", round(d * scale))
+
+        return ColumnType(name, convert, '0', encode)
+
+
+class Table(Table):
+    def __init__(self, name, database, columns):
+        super(Table, self).__init__(name, database, columns)
+        self.encoder = None
+
+    def encode_rows(self, rows):
+        """Encode rows in RowBinary format using the encoder
+        compiled for the table's columns.
+
+        :param rows: iterable of dictionaries keyed by column name,
+            missing columns are set to their default values
+        """
+        if self.encoder is None:
+            schema = tuple((column.name, column.type.name) for column in self.columns.values())
+            encoder = encoders.get(schema)
+            if encoder is None:
+                encoder = encoders.setdefault(schema, compile_encoder(self.columns))
+            self.encoder = encoder
+        return self.encoder(rows)
+
+
+parameter_name_re = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+tsv_parameter_escapes = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"})
+quoted_parameter_escapes = str.maketrans({"\\": "\\\\", "'": "\\'", "\t": "\\t", "\n": "\\n",
+    "\r": "\\r", "\0": "\\0"})
+
+def quote_parameter(value):
+    """Return value formatted as a literal inside of
+    an array, a tuple or a map query parameter.
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    if isinstance(value, str):
+        return "'" + value.translate(quoted_parameter_escapes) + "'"
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return "'" + format_parameter(value) + "'"
+    return format_parameter(value)
+
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def unix_timestamp(value):
+    """Return Unix timestamp of the timezone aware datetime
+    with microsecond precision.
+    """
+    delta = value - epoch
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    seconds, fraction = divmod(abs(microseconds), 1000000)
+    sign = "-" if microseconds < 0 else ""
+    return f"{sign}{seconds}.{fraction:06d}" if fraction else f"{sign}{seconds}"
+
+def format_parameter(value):
+    """Return query parameter value in the text format
+    expected by the server for `param_<name>` HTTP parameters.
+
+    Naive datetimes are read by the server in its timezone while
+    timezone aware datetimes are sent as Unix timestamps
+    so that they do not depend on the server timezone.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    if isinstance(value, str):
+        return value.translate(tsv_parameter_escapes)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            return unix_timestamp(value)
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f" if value.microsecond else "%Y-%m-%d %H:%M:%S")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, list):
+        return "[" + ",".join(quote_parameter(v) for v in value) + "]"
+    if isinstance(value, tuple):
+        return "(" + ",".join(quote_parameter(v) for v in value) + ")"
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{quote_parameter(k)}:{quote_parameter(v)}" for k, v in value.items()) + "}"
+    raise TypeError(f"unsupported query parameter type {type(value).__name__}")
+
+def query_parameters(parameters):
+    """Return HTTP parameters that bind values to
+    the `{name:Type}` placeholders of the query.
+
+    :param parameters: dictionary of parameter values
+    """
+    params = {}
+    for name, value in parameters.items():
+        if not parameter_name_re.match(name):
+            raise ValueError(f"invalid query parameter name '{name}'")
+        params[f"param_{name}"] = format_parameter(value)
+    return params
+
+identifier = r'(?:`(?:[^`\\]|\\.)+`|"(?:[^"\\]|\\.)+"|(?!VALUES\b)[A-Za-z_][\w$]*)'
+
+#: 'INSERT INTO <table> [(<columns>)] [VALUES]' query without any data
+insert_re = re.compile(rf"^\s*(INSERT\s+INTO\s+(?:TABLE\s+)?{identifier}(?:\s*\.\s*{identifier})?"
+    r"(?:\s*\([^()]*\))?)(?:\s+VALUES)?\s*$", re.IGNORECASE)
+
+def json_default(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return format_parameter(value)
+    raise TypeError(f"unsupported value type {type(value).__name__}")
+
+def executemany_request(query, rows):
+    """Return insert query and body used to insert
+    the rows in one request.
+    """
+    match = insert_re.match(query)
+    if not match:
+        raise ValueError("executemany() only supports INSERT INTO queries")
+    rows = list(rows)
+    format = "JSONEachRow"
+    if rows and not isinstance(rows[0], dict):
+        format = "JSONCompactEachRow"
+        rows = [list(row) for row in rows]
+    body = "".join(json.dumps(row, default=json_default, separators=(",", ":")) + "\n" for row in rows)
+    return f"{match.group(1)} FORMAT {format}", body.encode("utf-8")
+
+table_query = ("SELECT name, type FROM system.columns WHERE table = {name:String}"
+    " AND database = {database:String} AND default_kind != 'MATERIALIZED'")
+
+def table_from_columns(database, name, column_types, r):
+    """Return table object created from the result
+    of the table columns query.
+    """
+    if not r:
+        raise KeyError("no table")
+    columns = Columns(
+        [(entry["name"], Column(entry["name"], idx, column_types[entry["type"]])) for idx, entry in
+         enumerate(r)])
+    return Table(name, database, columns)
+
+
+#: hash of the names, types and positions of all the columns of the table
+#: that changes with any ALTER of the columns, unlike
+#: `system.tables.metadata_modification_time` that has one second resolution
+columns_hash = "toString(cityHash64(arraySort(groupArray((position, name, type, default_kind)))))"
+
+tables_metadata_query = ("SELECT c.table AS table, c.name AS name, c.type AS type,"
+    " h.columns_hash AS columns_hash"
+    " FROM system.columns AS c INNER JOIN"
+    f" (SELECT table, {columns_hash} AS columns_hash FROM system.columns"
+    " WHERE database = {database:String} GROUP BY table) AS h"
+    " ON c.table = h.table"
+    " WHERE c.database = {database:String} AND c.default_kind != 'MATERIALIZED'"
+    " ORDER BY c.table, c.position")
+
+metadata_query = tables_metadata_query.replace(" ORDER BY", " AND c.table = {name:String} ORDER BY")
+
+columns_hash_query = (f"SELECT {columns_hash} AS columns_hash FROM system.columns"
+    " WHERE database = {database:String} AND table = {name:String}")
+
+
+class TableMetadata:
+    def __init__(self, table, columns_hash):
+        self.table = table
+        self.columns_hash = columns_hash
+        self.checked = time.monotonic()
+
+
+class TableMetadataCache:
+    """Cache of table objects that can be shared
+    by multiple `Database` objects.
+
+    A cached table is returned without a query if it was checked
+    within the check interval, otherwise the hash of the table's columns
+    is compared with the cached one and the columns are only queried
+    again if they were changed.
+
+    The `lookup()` and `refresh()` generators yield each query
+    the caller needs to run as a `(query, parameters)` tuple,
+    receive the rows of its result and return the tables
+    so that the same logic is used by `Database`
+    and `AsyncDatabase` objects.
+    """
+    def __init__(self, check_interval=5):
+        """
+        :param check_interval: interval in seconds during which the cached
+            table is used without checking if it was modified, default: 5
+        """
+        self.check_interval = float(check_interval)
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def __len__(self):
+        return len(self.tables)
+
+    def get(self, server, name):
+        """Return cached table metadata or None.
+
+        :param server: name of the connection to the server and database
+        :param name: table name
+        """
+        with self.lock:
+            return self.tables.get((server, name))
+
+    def fresh(self, metadata):
+        """Return True if table metadata does not need to be checked.
+        """
+        return time.monotonic() - metadata.checked < self.check_interval
+
+    def checked(self, metadata):
+        metadata.checked = time.monotonic()
+
+    def lookup(self, server, database, name, column_types):
+        """Generator that returns the table.
+
+        :param server: name of the connection to the server and database
+        :param database: database name
+        :param name: table name
+        :param column_types: column types
+        """
+        parameters = {"database": database, "name": name}
+        metadata = self.get(server, name)
+
+        if metadata is not None:
+            if self.fresh(metadata):
+                return metadata.table
+            r = yield columns_hash_query, parameters
+            if r and r[0]["columns_hash"] == metadata.columns_hash:
+                self.checked(metadata)
+                return metadata.table
+
+        r = yield metadata_query, parameters
+        if not r:
+            self.invalidate(server, name)
+            raise KeyError("no table")
+        return self.update(server, database, column_types, r)[name]
+
+    def refresh(self, server, database, column_types):
+        """Generator that returns all the tables in the database.
+
+        :param server: name of the connection to the server and database
+        :param database: database name
+        :param column_types: column types
+        """
+        r = yield tables_metadata_query, {"database": database}
+        return self.update(server, database, column_types, r, all=True)
+
+    def update(self, server, database, column_types, r, all=False):
+        """Update cache using the result of the metadata query
+        and return updated tables.
+
+        :param server: name of the connection to the server and database
+        :param database: database name
+        :param column_types: column types
+        :param r: result of the metadata query
+        :param all: result contains all the tables in the database, default: False
+        """
+        entries = OrderedDict()
+        for entry in r:
+            entries.setdefault(entry["table"], []).append(entry)
+
+        # create all the tables first so that the cache
+        # is not changed if any of the tables can't be created
+        tables = OrderedDict()
+        metadata = {}
+        for name, columns in entries.items():
+            tables[name] = table_from_columns(database, name, column_types, columns)
+            metadata[(server, name)] = TableMetadata(tables[name], columns[0]["columns_hash"])
+
+        with self.lock:
+            if all:
+                for key in [key for key in self.tables if key[0] == server]:
+                    del self.tables[key]
+            self.tables.update(metadata)
+        return tables
+
+    def invalidate(self, server=None, name=None):
+        """Remove cached tables.
+
+        :param server: name of the connection to the server and database, default: all
+        :param name: table name, default: all
+        """
+        with self.lock:
+            for key in [key for key in self.tables
+                    if (server is None or key[0] == server) and (name is None or key[1] == name)]:
+                del self.tables[key]
 
 
 class Database(Database):
     column_types = ColumnTypes()
 
+    def __init__(self, connection, cache=None, metadata=None):
+        """
+        :param connection: database connection
+        :param cache: query result cache, default: None
+        :param metadata: table metadata cache, default: None
+        """
+        super(Database, self).__init__(connection, cache=cache)
+        self.metadata = metadata
+
+    def query(self, query, data=None, stream=False, params=None, body=None, format=None, parameters=None):
+        """Execute query.
+
+        :param query: query
+        :param data: query returns data, default: auto
+        :param stream: stream results, default: False
+        :param params: HTTP parameters, default: None
+        :param body: request body, default: None
+        :param format: columnar result format, default: None
+        :param parameters: values of `{name:Type}` query parameters, default: None
+        """
+        if parameters:
+            params = dict(params or {})
+            params.update(query_parameters(parameters))
+        return super(Database, self).query(query, data=data, stream=stream, params=params,
+            body=body, format=format)
+
+    def executemany(self, query, rows, params=None):
+        """Insert rows using one request.
+
+        :param query: 'INSERT INTO <table> [(<columns>)] [VALUES]' query
+        :param rows: iterable of dictionaries or sequences of values
+        :param params: HTTP parameters, default: None
+        """
+        query, body = executemany_request(query, rows)
+        return self.query(query, params=params, body=body)
+
+    def metadata_queries(self, steps):
+        """Run the queries of the table metadata cache
+        generator and return its result.
+        """
+        try:
+            request = next(steps)
+            while True:
+                query, parameters = request
+                request = steps.send(self.query(query, parameters=parameters).any())
+        except StopIteration as e:
+            return e.value
+
     def table(self, name):
-        query = f"SELECT name, type FROM system.columns WHERE table = '{name}' AND database = '{self.connection.database}' and default_kind != 'MATERIALIZED'"
-        r = self.query(query).any()
+        database = self.connection.database
 
-        if not r:
-            raise KeyError("no table")
-        columns = Columns(
-            [(entry["name"], Column(entry["name"], idx, self.column_types[entry["type"]])) for idx, entry in
-             enumerate(r)])
-        return Table(name, self.connection.database, columns)
+        if self.metadata is None:
+            r = self.query(table_query, parameters={"database": database, "name": name}).any()
+            return table_from_columns(database, name, self.column_types, r)
+
+        return self.metadata_queries(self.metadata.lookup(self.connection.name, database, name, self.column_types))
+
+    def refresh_tables(self):
+        """Refresh metadata of all the tables in the database
+        using one query and return the tables.
+        """
+        if self.metadata is None:
+            raise ValueError("no table metadata cache")
+        return self.metadata_queries(self.metadata.refresh(self.connection.name,
+            self.connection.database, self.column_types))
+
+    def routed_view(self, table="messages"):
+        """Return the table that merges keyword-routed
+        tables back into one table with all the columns.
+
+        :param table: table name, default: 'messages'
+        """
+        return self.table(view_table(table))
+
+    def run_summary(self, run):
+        """Return summary of the run using the test results rollup
+        or None if the run has no results.
+
+        The summary has the name, the result and the duration of the top
+        level test and the number of tests that passed, failed, errored,
+        were null, skipped or had expected failures.
+
+        :param run: id of the top level test
+        """
+        query, parameters = rollups.run_summary_request(run)
+        r = self.query(query, parameters=parameters).any()
+        return r[0] if r else None
+
+    def run_summaries(self, since=None, limit=100):
+        """Return summaries of the latest runs using the test results rollup.
+
+        :param since: date of the earliest results, default: None (all)
+        :param limit: maximum number of runs, default: 100
+        """
+        query, parameters = rollups.run_summaries_request(since=since, limit=limit)
+        return self.query(query, parameters=parameters).any()
+
+    def test_summaries(self, since=None, flaky=False, limit=100):
+        """Return number of runs, result counts, flakiness and durations
+        of each test across runs using the test results rollup
+        with the flakiest and the most failing tests first.
+
+        The flakiness is the fraction of results that disagree with
+        the majority of passing or failing results of the test.
+
+        :param since: date of the earliest results, default: None (all)
+        :param flaky: only return tests with both passing and failing results, default: False
+        :param limit: maximum number of tests, default: 100
+        """
+        query, parameters = rollups.test_summaries_request(since=since, flaky=flaky, limit=limit)
+        return self.query(query, parameters=parameters).any()
+
+
+class AsyncDatabase(AsyncDatabase):
+    column_types = ColumnTypes()
+
+    def __init__(self, connection, metadata=None):
+        """
+        :param connection: database connection
+        :param metadata: table metadata cache, default: None
+        """
+        super(AsyncDatabase, self).__init__(connection)
+        self.metadata = metadata
+
+    async def query(self, query, data=None, stream=False, params=None, body=None, format=None, parameters=None):
+        """Execute query.
+
+        Accepts the same arguments as `Database.query()`.
+        """
+        if parameters:
+            params = dict(params or {})
+            params.update(query_parameters(parameters))
+        return await super(AsyncDatabase, self).query(query, data=data, stream=stream, params=params,
+            body=body, format=format)
+
+    async def executemany(self, query, rows, params=None):
+        """Insert rows using one request.
+
+        Accepts the same arguments as `Database.executemany()`.
+        """
+        query, body = executemany_request(query, rows)
+        return await self.query(query, params=params, body=body)
+
+    async def metadata_queries(self, steps):
+        """Run the queries of the table metadata cache
+        generator and return its result.
+        """
+        try:
+            request = next(steps)
+            while True:
+                query, parameters = request
+                request = steps.send((await self.query(query, parameters=parameters)).any())
+        except StopIteration as e:
+            return e.value
+
+    async def table(self, name):
+        database = self.connection.database
+
+        if self.metadata is None:
+            r = (await self.query(table_query, parameters={"database": database, "name": name})).any()
+            return table_from_columns(database, name, self.column_types, r)
+
+        return await self.metadata_queries(self.metadata.lookup(self.connection.name, database, name,
+            self.column_types))
+
+    async def refresh_tables(self):
+        """Refresh metadata of all the tables in the database
+        using one query and return the tables.
+        """
+        if self.metadata is None:
+            raise ValueError("no table metadata cache")
+        return await self.metadata_queries(self.metadata.refresh(self.connection.name,
+            self.connection.database, self.column_types))
 
+    async def routed_view(self, table="messages"):
+        """Return the table that merges keyword-routed
+        tables back into one table with all the columns.
 
-class DatabaseConnection(DatabaseConnection):
-    def __init__(self, host, database, user=None, password=None, port=8123):
+        Accepts the same arguments as `Database.routed_view()`.
+        """
+        return await self.table(view_table(table))
+
+    async def run_summary(self, run):
+        """Return summary of the run using the test results rollup
+        or None if the run has no results.
+
+        Accepts the same arguments as `Database.run_summary()`.
+        """
+        query, parameters = rollups.run_summary_request(run)
+        r = (await self.query(query, parameters=parameters)).any()
+        return r[0] if r else None
+
+    async def run_summaries(self, since=None, limit=100):
+        """Return summaries of the latest runs using the test results rollup.
+
+        Accepts the same arguments as `Database.run_summaries()`.
+        """
+        query, parameters = rollups.run_summaries_request(since=since, limit=limit)
+        return (await self.query(query, parameters=parameters)).any()
+
+    async def test_summaries(self, since=None, flaky=False, limit=100):
+        """Return summaries of the tests across runs using the test results rollup.
+
+        Accepts the same arguments as `Database.test_summaries()`.
+        """
+        query, parameters = rollups.test_summaries_request(since=since, flaky=flaky, limit=limit)
+        return (await self.query(query, parameters=parameters)).any()
+
+
+class IOMetrics:
+    """Connection metrics.
+    """
+    def __init__(self, registry):
+        self.requests = registry.counter("database_io_requests_total", "queries sent")
+        self.errors = registry.counter("database_io_errors_total", "failed queries")
+        self.sent_bytes = registry.counter("database_io_sent_bytes_total", "size of sent request bodies")
+        self.received_bytes = registry.counter("database_io_received_bytes_total",
+            "size of received responses excluding streamed ones")
+        self.seconds = registry.histogram("database_io_seconds", "time to get response")
+        self.retries = registry.counter("database_io_retries_total", "retried queries")
+        self.rejected = registry.counter("database_io_rejected_total",
+            "queries rejected because circuit breaker is open")
+
+
+class HTTPConnection:
+    """Common ClickHouse HTTP connection settings
+    shared by the synchronous and asynchronous connections.
+    """
+    def __init__(self, host, database, user=None, password=None, port=8123,
+            compression=None, response_compression=None, retry=None, circuit_breaker=None):
+        """ClickHouse HTTP connection.
+
+        Queries that fail with a transient error are retried
+        using the retry policy for the error class. See `retry.error_class()`.
+        Only idempotent queries, that either only read data or are inserts
+        with the `insert_deduplication_token` setting, are retried.
+        See `retry.idempotent()`.
+
+        :param host: host
+        :param database: database
+        :param user: user, default: None
+        :param password: password, default: None
+        :param port: port, default: 8123
+        :param compression: request body compression either
+            'gzip', 'deflate', 'zstd', 'lz4' or 'br', default: None
+        :param response_compression: response compression either
+            'gzip', 'deflate', 'zstd' or 'br' if supported by the installed
+            `urllib3` package, default: None
+        :param retry: dictionary of retry policies by error class, default: `retry.default_policies`
+        :param circuit_breaker: circuit breaker, default: None
+        """
+        if compression is not None and compression not in compressors:
+            raise ValueError(f"unsupported compression '{compression}'")
+        if response_compression is not None and response_compression not in decompressors:
+            raise ValueError(f"unsupported response compression '{response_compression}'")
         self.host = host
         self.database = database
         self.user = user
         self.password = password
         self.port = port
-        self.session = requests.Session()
-        self.init()
-        super(DatabaseConnection, self).__init__()
+        self.compression = compression
+        self.response_compression = response_compression
+        self.retry = dict(default_policies if retry is None else retry)
+        self.circuit_breaker = circuit_breaker
 
     def init(self):
         self.url = f"http://{self.host}:{self.port}/"
         self.name = f"{self.database}@{self.url}"
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.name = self.name
+        self.metrics = IOMetrics(registry)
         self.default_params = {
             "user": self.user,
             "password": self.password,
             "database": self.database,
             "input_format_null_as_default": 1
         }
+        self.headers = {}
+        if self.compression:
+            self.headers["Content-Encoding"] = self.compression
+        if self.response_compression:
+            self.default_params["enable_http_compression"] = 1
+            self.headers["Accept-Encoding"] = self.response_compression
 
-    def reset(self):
-        self.close()
-        self.init()
-        self.open()
-
-    def open(self):
-        pass
-
-    def close(self):
-        self.session.close()
-
-    def io(self, query, data=False, stream=False, params=None):
+    def request(self, query, data=None, params=None, body=None, format=None):
+        """Return data flag, request body and parameters
+        for the query.
+        """
         if data is None:
             if query.startswith(("INSERT", "CREATE", "DROP",
                     "SYSTEM", "ALTER", "GRANT", "REVOKE", "ATTACH",
@@ -162,23 +1059,259 @@ class DatabaseConnection(DatabaseConnection):
                 data = True
 
         if data:
-            query += " FORMAT JSONEachRow"
+            query += f" FORMAT {format or 'JSONEachRow'}"
 
         params = dict(params or {})
         params.update(self.default_params)
 
+        if format == "ArrowStream":
+            params["output_format_arrow_string_as_string"] = 1
+
+        if body is not None:
+            params["query"] = query
+            query = body
+
+        # send encoded bytes so that the size of the body is known
+        if type(query) is str:
+            query = query.encode("utf-8")
+
+        if self.compression:
+            query = compressors[self.compression](query)
+
+        return data, query, params
+
+    def admit(self):
+        """Raise an exception if circuit breaker is open.
+        """
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow():
+            self.metrics.rejected.inc()
+            raise DatabaseCircuitOpenError(f"circuit breaker is open for {self.name}")
+
+    def succeeded(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.success()
+
+    def failed(self, exc, attempt, retry=True):
+        """Record failed query and return delay in seconds
+        before the retry or None if query should not be retried.
+
+        :param exc: exception
+        :param attempt: number of the failed attempt starting from 0
+        :param retry: query can be retried, default: True
+        """
+        error = error_class(exc)
+        if error is None:
+            # server answered so it is available
+            self.succeeded()
+            return None
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.failure()
+        if not retry:
+            return None
+        policy = self.retry.get(error)
+        delay = policy.delay(attempt) if policy is not None else None
+        if delay is not None:
+            self.metrics.retries.inc()
+        return delay
+
+
+class DatabaseConnection(HTTPConnection, DatabaseConnection):
+    def __init__(self, host, database, user=None, password=None, port=8123,
+            compression=None, response_compression=None, retry=None, circuit_breaker=None):
+        super(DatabaseConnection, self).__init__(host=host, database=database, user=user,
+            password=password, port=port, compression=compression,
+            response_compression=response_compression, retry=retry,
+            circuit_breaker=circuit_breaker)
+        self.session = requests.Session()
+        self.init()
+
+    def reset(self):
+        self.close()
+        self.init()
+        self.open()
+
+    def open(self):
+        pass
+
+    def close(self):
+        self.session.close()
+
+    def kill(self, query_id):
+        """Kill running query.
+
+        :param query_id: query id
+        """
         try:
-            r = self.session.post(self.url, data=query, params=params, stream=stream)
+            self.session.post(self.url, params=self.default_params,
+                data=f"KILL QUERY WHERE query_id = '{query_id}' ASYNC").close()
+        except Exception:
+            pass
+
+    def post(self, query, params, stream):
+        """Send request and return response.
+        """
+        metrics = self.metrics
+        metrics.requests.inc()
+        metrics.sent_bytes.inc(len(query))
+        start = time.monotonic()
+        try:
+            r = self.session.post(self.url, data=query, params=params, headers=self.headers, stream=stream)
         except Exception as exc:
+            metrics.errors.inc()
             raise DatabaseConnectionError from exc
+        finally:
+            metrics.seconds.observe(time.monotonic() - start)
         try:
             r.raise_for_status()
         except Exception as exc:
-            raise DatabaseError(r.text) from exc
+            metrics.errors.inc()
+            raise DatabaseServerError(r.text, status=r.status_code) from exc
+        return r
+
+    def io(self, query, data=False, stream=False, params=None, body=None, format=None):
+        if format is not None:
+            if stream:
+                raise ValueError("format is not supported in stream mode")
+            format = columns_format(format)
+
+        retry = idempotent(query, params)
+        data, query, params = self.request(query, data=data, params=params, body=body, format=format)
+
+        if stream and data:
+            params.setdefault("query_id", str(uuid.uuid4()))
+
+        attempt = 0
+        while True:
+            self.admit()
+            try:
+                r = self.post(query, params, stream)
+                break
+            except DatabaseError as exc:
+                delay = self.failed(exc, attempt, retry=retry)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+        self.succeeded()
+
+        if not stream:
+            self.metrics.received_bytes.inc(len(r.content))
 
         if not data:
             return r
 
         if stream:
-            return DatabaseQueryStreamResponse(r, convert=json.loads)
-        return DatabaseQueryResponse(r, convert=lambda r: json.loads(f"[{','.join(r.text.splitlines())}]"))
+            return DatabaseQueryStreamResponse(r, convert=jsonbackend.loads,
+                convert_batch=jsonbackend.loads_lines,
+                cancel=lambda: self.kill(params["query_id"]))
+        if format is not None:
+            return DatabaseQueryColumnsResponse(r, convert=lambda r: column_formats[format](r.content))
+        return DatabaseQueryResponse(r, convert=lambda r: jsonbackend.loads_rows(r.content))
+
+
+class AsyncDatabaseConnection(HTTPConnection, AsyncDatabaseConnection):
+    def __init__(self, host, database, user=None, password=None, port=8123,
+            compression=None, response_compression=None, retry=None, circuit_breaker=None, limit=100):
+        """Asynchronous ClickHouse HTTP connection that requires
+        `aiohttp` package.
+
+        Accepts the same arguments as `DatabaseConnection` and
+
+        :param limit: maximum number of simultaneous HTTP connections, default: 100
+        """
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError("AsyncDatabaseConnection requires 'aiohttp' package") from None
+        super(AsyncDatabaseConnection, self).__init__(host=host, database=database, user=user,
+            password=password, port=port, compression=compression,
+            response_compression=response_compression, retry=retry,
+            circuit_breaker=circuit_breaker)
+        self.limit = limit
+        self.session = None
+        self.init()
+
+    async def reset(self):
+        await self.close()
+        self.init()
+        await self.open()
+
+    async def open(self):
+        import aiohttp
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit))
+
+    async def close(self):
+        if self.session is not None:
+            session, self.session = self.session, None
+            await session.close()
+
+    async def post(self, query, params):
+        """Send request and return response.
+        """
+        metrics = self.metrics
+        metrics.requests.inc()
+        metrics.sent_bytes.inc(len(query))
+        start = time.monotonic()
+        try:
+            r = await self.session.post(self.url, data=query, params=params, headers=self.headers)
+        except Exception as exc:
+            metrics.errors.inc()
+            raise DatabaseConnectionError from exc
+        finally:
+            metrics.seconds.observe(time.monotonic() - start)
+
+        if r.status >= 400:
+            metrics.errors.inc()
+            try:
+                text = await r.text()
+            finally:
+                r.close()
+            raise DatabaseServerError(text, status=r.status)
+        return r
+
+    async def io(self, query, data=False, stream=False, params=None, body=None, format=None):
+        if format is not None:
+            if stream:
+                raise ValueError("format is not supported in stream mode")
+            format = columns_format(format)
+
+        retry = idempotent(query, params)
+        data, query, params = self.request(query, data=data, params=params, body=body, format=format)
+        # aiohttp does not accept None values in parameters
+        params = {k: str(v) for k, v in params.items() if v is not None}
+
+        await self.open()
+
+        attempt = 0
+        while True:
+            self.admit()
+            try:
+                r = await self.post(query, params)
+                break
+            except DatabaseError as exc:
+                delay = self.failed(exc, attempt, retry=retry)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+        self.succeeded()
+
+        try:
+            if stream and data:
+                return AsyncDatabaseQueryStreamResponse(r, convert=jsonbackend.loads)
+
+            content = await r.read()
+            self.metrics.received_bytes.inc(len(content))
+        except BaseException:
+            r.close()
+            raise
+
+        if not data:
+            return r
+
+        if format is not None:
+            return DatabaseQueryColumnsResponse(r, convert=lambda r: column_formats[format](content))
+
+        return DatabaseQueryResponse(r, convert=lambda r: jsonbackend.loads_rows(content))
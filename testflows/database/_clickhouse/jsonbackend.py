@@ -0,0 +1,73 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+backends = {
+    "json": json.loads
+}
+
+if simdjson is not None:
+    backends["simdjson"] = simdjson.loads
+
+if orjson is not None:
+    backends["orjson"] = orjson.loads
+
+backend = "orjson" if orjson is not None else "simdjson" if simdjson is not None else "json"
+
+def set_backend(name):
+    """Set JSON backend used to parse query results
+    and log messages.
+
+    :param name: either 'json', 'orjson' or 'simdjson'
+    """
+    global backend
+    if name not in backends:
+        raise ValueError(f"unsupported JSON backend '{name}'")
+    backend = name
+
+def loads(data):
+    """Parse one JSON value from bytes or string.
+    """
+    return backends[backend](data)
+
+def loads_rows(content):
+    """Parse JSONEachRow content into a list of rows
+    without splitting it into separate lines.
+
+    :param content: bytes where each row is on its own line
+    """
+    if type(content) is str:
+        content = content.encode("utf-8")
+    content = content.strip()
+    if not content:
+        return []
+    return backends[backend](b"[" + content.replace(b"\n", b",") + b"]")
+
+def loads_lines(lines):
+    """Parse a list of JSON lines into a list of rows.
+
+    :param lines: list of bytes where each item is one row
+    """
+    return backends[backend](b"[" + b",".join(lines) + b"]")
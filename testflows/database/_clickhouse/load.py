@@ -0,0 +1,236 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import gzip
+import hashlib
+import queue
+import fnmatch
+import multiprocessing
+import concurrent.futures
+
+from testflows._core.compress import CompressedFile
+from testflows.database._clickhouse import jsonbackend
+from testflows.database._clickhouse.database import ColumnTypes, table_from_columns
+from testflows.database._clickhouse.transform import max_batch_rows, max_inflight
+
+def log_files(paths, pattern="*.log*"):
+    """Return log files for the list of files and directories.
+    Directories are searched recursively for files matching the pattern.
+
+    :param paths: list of files or directories
+    :param pattern: file name pattern used for directories, default: '*.log*'
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files += [os.path.join(root, name) for name in sorted(names) if fnmatch.fnmatch(name, pattern)]
+        else:
+            files.append(path)
+    return list(dict.fromkeys(files))
+
+def open_log(path):
+    """Open log file that is either compressed using the testflows
+    log compression, gzip compressed or not compressed.
+    """
+    with open(path, "rb") as fd:
+        magic = fd.read(6)
+    if magic == b"\xfd7zXZ\x00":
+        return CompressedFile(path, tail=False)
+    if magic.startswith(b"\x1f\x8b"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def encode_file(path, table, format, batch_rows, results):
+    """Read log file and put encoded batches into the results queue.
+    """
+    lines = []
+
+    def batch():
+        data = b"".join(lines)
+        if format == "RowBinary":
+            data = table.encode_rows(jsonbackend.loads_rows(data))
+        results.put((path, data, len(lines)))
+        lines.clear()
+
+    with open_log(path) as log:
+        for line in log:
+            if not line.strip():
+                continue
+            lines.append(line if line.endswith(b"\n") else line + b"\n")
+            if len(lines) >= batch_rows:
+                batch()
+        if lines:
+            batch()
+
+#: interval in seconds used to check if the worker processes are alive
+worker_check_interval = 1
+
+def worker(tasks, results, database, table, columns, format, batch_rows, json):
+    """Worker process that encodes log files
+    it gets from the tasks queue.
+    """
+    jsonbackend.set_backend(json)
+
+    if columns is not None:
+        table = table_from_columns(database, table, ColumnTypes(), columns)
+
+    while True:
+        path = tasks.get()
+        if path is None:
+            break
+        try:
+            encode_file(path, table, format, batch_rows, results)
+            results.put((path, None, None))
+        except Exception as exc:
+            results.put((path, None, f"{type(exc).__name__}: {exc}"))
+
+def load(database, paths, table="messages", format="JSONEachRow", workers=None,
+        connections=max_inflight, batch_rows=max_batch_rows, pattern="*.log*", progress=None, json=None):
+    """Load log files into the table.
+
+    Log files are read and encoded by a pool of worker processes
+    and the encoded batches are inserted using a pool of threads that share
+    the database connection. Returns a list of (path, rows, error) tuples.
+    Files that were not loaded because the worker processes
+    exited unexpectedly are returned with an error.
+    Each insert has an `insert_deduplication_token` computed
+    from the batch data, the same way as the transform, so that
+    it is retried on transient errors and loading the same
+    files again does not duplicate the rows. The rows of a file
+    are only counted once their inserts succeed.
+
+    :param database: database
+    :param paths: list of log files or directories
+    :param table: table name, default: 'messages'
+    :param format: insert format either 'JSONEachRow' or 'RowBinary', default: 'JSONEachRow'
+    :param workers: number of worker processes, default: number of CPUs
+    :param connections: number of concurrent inserts, default: `max_inflight`
+    :param batch_rows: maximum number of rows in a batch, default: `max_batch_rows`
+    :param pattern: file name pattern used for directories, default: '*.log*'
+    :param progress: function called with (path, rows, error) for each loaded file, default: None
+    :param json: JSON backend used by the worker processes, default: current backend
+    """
+    files = log_files(paths, pattern=pattern)
+    if not files:
+        return []
+
+    columns = None
+    if format == "RowBinary":
+        columns = [{"name": column.name, "type": column.type.name} for column in database.table(table).columns.values()]
+        query = f"INSERT INTO {table} ({', '.join(column['name'] for column in columns)}) FORMAT RowBinary"
+    elif format == "JSONEachRow":
+        query = f"INSERT INTO {table} FORMAT JSONEachRow"
+    else:
+        raise ValueError(f"unsupported format '{format}'")
+
+    workers = min(int(workers or os.cpu_count() or 1), len(files))
+    connections = int(connections)
+
+    context = multiprocessing.get_context()
+    tasks = context.Queue()
+    # bound the number of encoded batches waiting to be inserted
+    results = context.Queue(maxsize=connections * 2)
+
+    for path in files:
+        tasks.put(path)
+    for i in range(workers):
+        tasks.put(None)
+
+    processes = [context.Process(target=worker, args=(tasks, results, database.connection.database,
+        table, columns, format, int(batch_rows), json or jsonbackend.backend), daemon=True) for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    rows = {path: 0 for path in files}
+    outstanding = {path: 0 for path in files}
+    errors = {}
+    inserts = {}
+    finished = set()
+
+    def insert(data):
+        database.query(query, body=data, params={"insert_deduplication_token": hashlib.sha1(data).hexdigest()})
+
+    def file_done(path):
+        if path in finished and not outstanding[path] and progress is not None:
+            progress(path, rows[path], errors.get(path))
+
+    def next_result():
+        """Return next result from the workers or None
+        if all the worker processes have exited.
+        """
+        while True:
+            # check before waiting so that results put
+            # by the workers before they exited are not lost
+            alive = any(process.is_alive() for process in processes)
+            try:
+                return results.get(timeout=worker_check_interval)
+            except queue.Empty:
+                if not alive:
+                    return None
+
+    def workers_exited():
+        codes = ", ".join(sorted(set(str(process.exitcode) for process in processes)))
+        for path in files:
+            if path not in finished:
+                errors.setdefault(path, f"worker processes exited before the file was loaded (exit codes: {codes})")
+                finished.add(path)
+                file_done(path)
+
+    def completed(futures):
+        for future in futures:
+            path, count = inserts.pop(future)
+            outstanding[path] -= 1
+            try:
+                future.result()
+                rows[path] += count
+            except Exception as exc:
+                errors.setdefault(path, f"{type(exc).__name__}: {exc}")
+            file_done(path)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            while len(finished) < len(files):
+                result = next_result()
+                if result is None:
+                    workers_exited()
+                    break
+
+                path, data, count = result
+                if data is None:
+                    if count is not None:
+                        errors.setdefault(path, count)
+                    finished.add(path)
+                    file_done(path)
+                    continue
+
+                outstanding[path] += 1
+                inserts[executor.submit(insert, data)] = (path, count)
+
+                if len(inserts) >= connections:
+                    futures, _ = concurrent.futures.wait(inserts,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    completed(futures)
+
+            futures, _ = concurrent.futures.wait(inserts)
+            completed(futures)
+    finally:
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+
+    return [(path, rows[path], errors.get(path)) for path in files]
@@ -0,0 +1,218 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import namedtuple
+
+from testflows.database._clickhouse.schema import messages_table
+from testflows.database._clickhouse.profiles import messages_schema
+from testflows.database._clickhouse import routes
+from testflows.database._clickhouse import rollups
+
+#: table that records applied migrations
+migrations_table = "schema_migrations"
+
+Migration = namedtuple("Migration", "version description statements")
+
+#: skip indexes of the messages table by name
+skip_indexes = [
+    ("test_name_idx", "test_name"),
+    ("result_type_idx", "result_type"),
+    ("attribute_name_idx", "attribute_name")
+]
+
+def skip_index_statements(table, columns=None):
+    """Return statements that add and materialize
+    the skip indexes of the columns the table has.
+
+    :param table: table name
+    :param columns: names of the columns of the table, default: all
+    """
+    indexes = [(name, column) for name, column in skip_indexes if columns is None or column in columns]
+    return ([f"ALTER TABLE {table} ADD INDEX IF NOT EXISTS {name} {column} TYPE bloom_filter(0.01) GRANULARITY 4"
+            for name, column in indexes]
+        + [f"ALTER TABLE {table} MATERIALIZE INDEX {name}" for name, column in indexes])
+
+#: skip index used by per-run queries that filter on `test_top_key`,
+#: messages are sorted by `test_id` that starts with the id of the run
+#: so a granule almost always holds messages of one run
+run_index = ("test_top_key_idx", "test_top_key")
+
+def run_index_statements(table):
+    """Return statements that add and materialize
+    the per-run skip index.
+    """
+    name, column = run_index
+    return [
+        f"ALTER TABLE {table} ADD INDEX IF NOT EXISTS {name} {column} TYPE minmax GRANULARITY 1",
+        f"ALTER TABLE {table} MATERIALIZE INDEX {name}"
+    ]
+
+def routed_statements(table="messages"):
+    """Return statements that add the skip indexes of the messages table
+    to the keyword-routed tables and aggregate the results
+    of the routed RESULT messages into the rollup.
+    """
+    statements = []
+    for route in routes.routes:
+        statements += skip_index_statements(routes.route_table(table, route), routes.route_columns(route))
+        statements += run_index_statements(routes.route_table(table, route))
+    result_table = routes.route_table(table, "result")
+    return statements + rollups.source_statements(result_table, view=rollups.source_view(result_table))
+
+def routed_tables(database, table="messages"):
+    """Return True if the keyword-routed tables were created.
+    """
+    r = database.query("SELECT count() AS count FROM system.tables"
+        " WHERE database = currentDatabase() AND name = {name:String}",
+        parameters={"name": routes.view_table(table)}).one()
+    return int(r["count"]) > 0
+
+class Routed:
+    def __init__(self, table="messages"):
+        """Statements that evolve the keyword-routed tables
+        that are only run if the tables were created
+        as they are optional, see `create()`.
+
+        :param table: table name, default: 'messages'
+        """
+        self.table = table
+        self.statements = routed_statements(table)
+
+    def __str__(self):
+        return "\n    ".join([f"-- only if {routes.view_table(self.table)} exists"]
+            + [str(statement) for statement in self.statements])
+
+    def __call__(self, database):
+        if routed_tables(database, self.table):
+            run(database, self.statements)
+
+#: version of the migration that evolves the keyword-routed tables
+routed_version = 6
+
+#: migrations of the messages table and the keyword-routed tables in the order they are applied,
+#: a statement is either a query or a function that is called with the database
+#: and statements must be safe to run again if a migration is interrupted
+migrations = [
+    Migration(1, "create messages table", [
+        messages_table.replace("CREATE TABLE messages", "CREATE TABLE IF NOT EXISTS messages", 1)
+    ]),
+    Migration(2, "enable insert deduplication", [
+        "ALTER TABLE messages MODIFY SETTING non_replicated_deduplication_window = 1000"
+    ]),
+    Migration(3, "add skip indexes", skip_index_statements("messages")),
+    Migration(4, "add per-run skip index", run_index_statements("messages")),
+    Migration(5, "add test results rollup", rollups.statements),
+    Migration(routed_version, "add skip indexes and results rollup to keyword-routed tables", [Routed()])
+]
+
+def latest_version():
+    """Return version of the last migration.
+    """
+    return migrations[-1].version
+
+def create_migrations_table(database):
+    database.query(f"CREATE TABLE IF NOT EXISTS {migrations_table} (version UInt32, description String,"
+        " applied DateTime DEFAULT now()) ENGINE = MergeTree() ORDER BY version")
+
+def current_version(database):
+    """Return version of the last applied migration
+    or 0 if no migrations were applied.
+    """
+    create_migrations_table(database)
+    r = database.query(f"SELECT max(version) AS version FROM {migrations_table}").one()
+    return int(r["version"] or 0)
+
+def pending(database, version=None):
+    """Return migrations that are not yet applied.
+
+    :param database: database
+    :param version: target version, default: latest
+    """
+    version = latest_version() if version is None else int(version)
+    current = current_version(database)
+    if version < current:
+        raise ValueError(f"can't migrate from version {current} to older version {version}")
+    return [migration for migration in migrations if current < migration.version <= version]
+
+def run(database, statements):
+    """Run statements where a statement is either a query
+    or a function that is called with the database.
+    """
+    for statement in statements:
+        if callable(statement):
+            statement(database)
+        else:
+            database.query(statement)
+
+def migrate(database, version=None, progress=None):
+    """Apply pending migrations in order and return
+    the list of applied migrations.
+
+    :param database: database
+    :param version: target version, default: latest
+    :param progress: function called with each migration before it is applied, default: None
+    """
+    applied = []
+    for migration in pending(database, version):
+        if progress is not None:
+            progress(migration)
+        run(database, migration.statements)
+        database.executemany(f"INSERT INTO {migrations_table} (version, description)",
+            [(migration.version, migration.description)])
+        applied.append(migration)
+    return applied
+
+def create(database, force=False, progress=None, profile="default", ttl=None, routed=False):
+    """Create messages table at the latest version.
+
+    The schema profile and the TTL are only used
+    if the tables do not exist.
+
+    If `routed` is set then the keyword-routed tables
+    and their view are also created using the schema profile
+    and the TTL and are evolved by the migrations from then on.
+
+    :param database: database
+    :param force: drop existing tables and migration history, default: False
+    :param progress: function called with each migration before it is applied, default: None
+    :param profile: schema profile, default: 'default'
+    :param ttl: number of days messages are kept, default: None (keep forever)
+    :param routed: create keyword-routed tables, default: False
+    """
+    if force:
+        result_table = routes.route_table("messages", "result")
+        database.query(f"DROP TABLE IF EXISTS {rollups.rollup_view}")
+        database.query(f"DROP TABLE IF EXISTS {rollups.source_view(result_table)}")
+        database.query(f"DROP TABLE IF EXISTS {rollups.rollup_table}")
+        database.query(f"DROP TABLE IF EXISTS {rollups.backfills_table}")
+        database.query("DROP TABLE IF EXISTS messages")
+        database.query(f"DROP TABLE IF EXISTS {routes.view_table('messages')}")
+        for route in routes.routes:
+            database.query(f"DROP TABLE IF EXISTS {routes.route_table('messages', route)}")
+        database.query(f"DROP TABLE IF EXISTS {migrations_table}")
+    if profile != "default" or ttl is not None:
+        database.query(messages_schema(profile, ttl=ttl).replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+
+    # routed tables added to a database that already passed the migration
+    # that evolves them are brought up to date after the migrations
+    update_routed = False
+    if routed:
+        update_routed = current_version(database) >= routed_version and not routed_tables(database)
+        for statement in routes.routed_schema(profile=profile, ttl=ttl):
+            database.query(statement)
+
+    applied = migrate(database, progress=progress)
+    if update_routed:
+        run(database, Routed().statements)
+    return applied
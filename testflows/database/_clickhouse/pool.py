@@ -0,0 +1,229 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import threading
+import requests
+
+import testflows.database.base as base
+
+from testflows.database.base import DatabaseConnectionError, DatabaseQueryStreamResponse
+from testflows.database._clickhouse.database import DatabaseConnection
+from testflows.database._clickhouse.retry import default_policies, idempotent
+
+policies = ("round-robin", "least-loaded")
+
+class Replica:
+    def __init__(self, connection, pool_size):
+        self.connection = connection
+        self.inflight = 0
+        # connections that are in use, bounded by the pool size
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.healthy = True
+        self.failed_at = None
+
+    def __repr__(self):
+        return f"Replica({self.connection.url}, healthy={self.healthy}, inflight={self.inflight})"
+
+class DatabaseConnectionPool(base.DatabaseConnection):
+    def __init__(self, hosts, database, user=None, password=None, port=8123,
+            pool_size=5, policy="round-robin", health_check_interval=5, health_check_timeout=1,
+            compression=None, response_compression=None, retry=None, pool_timeout=30):
+        """Pool of ClickHouse HTTP connections to one or more replicas.
+
+        Each query is sent to a replica selected using the policy.
+        If a replica fails to respond then it is marked as unhealthy
+        and the query is retried on the next replica if it is idempotent,
+        see `retry.idempotent()`. Unhealthy replicas
+        are checked in the background and returned to the pool
+        once they respond to a health check. Other transient errors
+        are retried on the same replica using the retry policies.
+
+        :param hosts: list of hosts or 'host:port' strings
+        :param database: database
+        :param user: user, default: None
+        :param password: password, default: None
+        :param port: default port, default: 8123
+        :param pool_size: maximum number of connections per replica, default: 5
+        :param policy: replica selection policy either 'round-robin' or 'least-loaded',
+            default: 'round-robin'
+        :param health_check_interval: interval in seconds between health checks
+            of unhealthy replicas, default: 5
+        :param health_check_timeout: health check timeout in seconds, default: 1
+        :param compression: request body compression, default: None
+        :param response_compression: response compression, default: None
+        :param retry: dictionary of retry policies by error class, default: `retry.default_policies`
+        :param pool_timeout: time in seconds to wait for a free connection
+            to the replica before the query fails, default: 30
+        """
+        if policy not in policies:
+            raise ValueError(f"unsupported policy '{policy}'")
+        if isinstance(hosts, str):
+            hosts = [host.strip() for host in hosts.split(",") if host.strip()]
+        if not hosts:
+            raise ValueError("no hosts")
+
+        self.database = database
+        self.pool_size = int(pool_size)
+        self.pool_timeout = float(pool_timeout)
+        self.policy = policy
+        self.health_check_interval = float(health_check_interval)
+        self.health_check_timeout = float(health_check_timeout)
+        self.lock = threading.Lock()
+        self.next = 0
+        self.replicas = []
+        # connection errors fail over to the next replica instead of being retried
+        retry = {name: policy for name, policy in (default_policies if retry is None else retry).items()
+            if name != "connection"}
+
+        for host in hosts:
+            host, _, host_port = host.partition(":")
+            connection = DatabaseConnection(host=host, database=database, user=user, password=password,
+                port=host_port or port, compression=compression, response_compression=response_compression,
+                retry=retry)
+            self.replicas.append(Replica(connection, self.pool_size))
+
+        self.health_checker = None
+        self.stop_health_checker = threading.Event()
+        self.init()
+        super(DatabaseConnectionPool, self).__init__()
+
+    def init(self):
+        for replica in self.replicas:
+            replica.connection.database = self.database
+            replica.connection.init()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                pool_maxsize=self.pool_size, pool_block=True)
+            replica.connection.session.mount("http://", adapter)
+        self.name = f"{self.database}@[{','.join(replica.connection.url for replica in self.replicas)}]"
+
+    def reset(self):
+        self.close()
+        self.init()
+        self.open()
+
+    def open(self):
+        pass
+
+    def close(self):
+        self.stop_health_checker.set()
+        with self.lock:
+            health_checker, self.health_checker = self.health_checker, None
+        if health_checker is not None:
+            health_checker.join()
+        self.stop_health_checker.clear()
+        for replica in self.replicas:
+            replica.connection.close()
+
+    def ping(self, replica):
+        """Return True if replica responds to a health check.
+        """
+        try:
+            r = replica.connection.session.get(replica.connection.url + "ping",
+                timeout=self.health_check_timeout)
+            return r.status_code == 200
+        except Exception:
+            return False
+
+    def check_health(self):
+        """Check health of all the unhealthy replicas
+        and return healthy ones back to the pool.
+        """
+        for replica in self.replicas:
+            if not replica.healthy and self.ping(replica):
+                with self.lock:
+                    replica.healthy = True
+                    replica.failed_at = None
+
+    def health_check_loop(self):
+        try:
+            while not self.stop_health_checker.wait(self.health_check_interval):
+                self.check_health()
+                with self.lock:
+                    if all(replica.healthy for replica in self.replicas):
+                        return
+        finally:
+            with self.lock:
+                if self.health_checker is threading.current_thread():
+                    self.health_checker = None
+
+    def mark_unhealthy(self, replica):
+        with self.lock:
+            replica.healthy = False
+            replica.failed_at = time.time()
+            if self.health_checker is None and self.health_check_interval > 0:
+                self.health_checker = threading.Thread(target=self.health_check_loop, daemon=True)
+                self.health_checker.name = "tfs-database-health-check"
+                self.health_checker.start()
+
+    def select(self, exclude):
+        """Select replica using the policy.
+        If there are no healthy replicas then unhealthy ones are used.
+
+        :param exclude: replicas that should not be selected
+        """
+        with self.lock:
+            candidates = [r for r in self.replicas if r.healthy and r not in exclude] \
+                or [r for r in self.replicas if r not in exclude]
+            if not candidates:
+                return None
+            if self.policy == "least-loaded":
+                replica = min(candidates, key=lambda r: r.inflight)
+            else:
+                replica = candidates[self.next % len(candidates)]
+                self.next += 1
+            replica.inflight += 1
+            return replica
+
+    def acquire(self, replica):
+        """Wait for a free connection to the selected replica.
+        """
+        if not replica.slots.acquire(timeout=self.pool_timeout):
+            with self.lock:
+                replica.inflight -= 1
+            raise DatabaseConnectionError(f"no free connection to {replica.connection.url}"
+                f" within {self.pool_timeout} sec")
+
+    def release(self, replica):
+        with self.lock:
+            replica.inflight -= 1
+        replica.slots.release()
+
+    def io(self, query, data=False, stream=False, params=None, body=None, format=None):
+        tried = []
+
+        while True:
+            replica = self.select(exclude=tried)
+            if replica is None:
+                raise DatabaseConnectionError(f"all replicas failed: {tried}")
+            tried.append(replica)
+            self.acquire(replica)
+            try:
+                r = replica.connection.io(query, data=data, stream=stream, params=params, body=body, format=format)
+            except DatabaseConnectionError:
+                self.release(replica)
+                self.mark_unhealthy(replica)
+                if len(tried) == len(self.replicas) or not idempotent(query, params):
+                    raise
+                continue
+            except BaseException:
+                self.release(replica)
+                raise
+
+            if isinstance(r, DatabaseQueryStreamResponse):
+                # streamed query stays in flight until its response is read or cancelled
+                r.on_done(lambda: self.release(replica))
+            else:
+                self.release(replica)
+            return r
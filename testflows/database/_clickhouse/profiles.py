@@ -0,0 +1,171 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+
+from collections import namedtuple, OrderedDict
+
+from testflows.database._clickhouse.schema import messages_table, columns
+
+Profile = namedtuple("Profile", "description low_cardinality codecs default_codec")
+
+#: columns with a small number of distinct values
+low_cardinality = (
+    "message_stream",
+    "attribute_name", "attribute_type", "attribute_group",
+    "requirement_name", "requirement_version", "requirement_priority",
+    "requirement_type", "requirement_group",
+    "argument_name", "argument_type", "argument_group",
+    "tag_value", "example_row_format",
+    "node_name", "node_module",
+    "protocol_version", "framework_version",
+    "ticket_name", "ticket_type", "ticket_group",
+    "value_name", "value_type", "value_group",
+    "metric_name", "metric_units", "metric_type", "metric_group"
+)
+
+#: columns that hold long text
+text_columns = (
+    "message", "result_message", "result_reason", "test_description",
+    "requirement_description", "attribute_value", "argument_value",
+    "value_value", "example_values"
+)
+
+profiles = OrderedDict([
+    ("default", Profile("messages table as created by the migrations", (), {}, None)),
+    ("storage", Profile("LowCardinality strings, delta coded counters and ZSTD compression",
+        low_cardinality, dict(
+            [("message_num", "DoubleDelta, ZSTD(1)"), ("message_time", "Delta, ZSTD(1)")]
+            + [(name, "ZSTD(3)") for name in text_columns]),
+        "ZSTD(1)"))
+])
+
+def column_definitions(profile="default"):
+    """Return list of (name, type, default, codec) tuples
+    for the columns of the messages table using the schema profile
+    where default is the MATERIALIZED expression if any.
+
+    :param profile: profile name, default: 'default'
+    """
+    if profile not in profiles:
+        raise ValueError(f"unknown schema profile '{profile}'")
+    profile = profiles[profile]
+
+    definitions = []
+    for name, definition in columns():
+        type, _, default = definition.partition(" MATERIALIZED ")
+        if name in profile.low_cardinality:
+            type = f"LowCardinality({type})"
+        codec = profile.codecs.get(name)
+        if codec is None and profile.default_codec and not default and type.startswith(("String", "Array(")):
+            codec = profile.default_codec
+        definitions.append((name, type, default or None, codec))
+    return definitions
+
+def messages_schema(profile="default", table="messages", ttl=None, include=None):
+    """Return CREATE TABLE statement for the messages table
+    using the schema profile.
+
+    :param profile: profile name, default: 'default'
+    :param table: table name, default: 'messages'
+    :param ttl: number of days messages are kept, expired parts are dropped
+        as a whole so partitions are removed once all their messages expire,
+        default: None (keep forever)
+    :param include: names of the columns to include, default: all
+    """
+    definitions = []
+    for name, type, default, codec in column_definitions(profile):
+        if include is not None and name not in include:
+            continue
+        definitions.append(f"    {name} {type}" + (f" MATERIALIZED {default}" if default else "")
+            + (f" CODEC({codec})" if codec else ""))
+
+    engine = messages_table[messages_table.rindex(") ENGINE"):]
+    if ttl is not None:
+        engine, _, settings = engine.rpartition("\nSETTINGS ")
+        engine += f"\nTTL message_date + INTERVAL {int(ttl)} DAY\nSETTINGS {settings}, ttl_only_drop_parts = 1"
+
+    return f"CREATE TABLE {table}\n(\n" + ",\n".join(definitions) + "\n" + engine
+
+#: queries used to measure scan speed
+scan_queries = OrderedDict([
+    ("messages by keyword", "SELECT message_keyword, count() AS count FROM {table} GROUP BY message_keyword"),
+    ("results by type", "SELECT result_type, count() AS count FROM {table}"
+        " WHERE message_keyword = 'RESULT' GROUP BY result_type"),
+    ("attributes", "SELECT attribute_name, count() AS count FROM {table}"
+        " WHERE attribute_name != '' GROUP BY attribute_name"),
+    ("message text", "SELECT count() AS count FROM {table} WHERE message LIKE '%error%'"),
+    ("time range", "SELECT min(message_time) AS start, max(message_time) AS end,"
+        " max(message_num) AS num FROM {table}")
+])
+
+def table_size(database, table):
+    """Return rows, compressed and uncompressed size
+    of the active parts of the table.
+    """
+    return database.query("SELECT sum(rows) AS rows, sum(data_compressed_bytes) AS compressed,"
+        " sum(data_uncompressed_bytes) AS uncompressed FROM system.parts"
+        " WHERE database = currentDatabase() AND table = {table:String} AND active",
+        parameters={"table": table}).one()
+
+def report(database, paths, profiles=tuple(profiles), repeat=3, keep=False, progress=None):
+    """Load sample logs into a table for each schema profile
+    and return a list of reports with the compressed size of the table
+    and the best time of each of the `scan_queries`.
+
+    :param database: database
+    :param paths: list of log files or directories
+    :param profiles: profile names, default: all
+    :param repeat: number of times each scan query is run, default: 3
+    :param keep: keep tables after the report, default: False
+    :param progress: function called with each report, default: None
+    """
+    # imported here because load imports the database module
+    # which imports this module through the routes
+    from testflows.database._clickhouse.load import load
+
+    reports = []
+    for profile in profiles:
+        table = f"messages_{profile}"
+        database.query(f"DROP TABLE IF EXISTS {table}")
+        database.query(messages_schema(profile, table=table))
+        try:
+            for path, rows, error in load(database, paths, table=table):
+                if error is not None:
+                    raise ValueError(f"failed to load {path}: {error}")
+            database.query(f"OPTIMIZE TABLE {table} FINAL")
+
+            size = table_size(database, table)
+            r = OrderedDict([
+                ("profile", profile),
+                ("rows", int(size["rows"] or 0)),
+                ("compressed_bytes", int(size["compressed"] or 0)),
+                ("uncompressed_bytes", int(size["uncompressed"] or 0)),
+                ("scans", OrderedDict())
+            ])
+            for name, query in scan_queries.items():
+                times = []
+                for i in range(int(repeat)):
+                    start = time.perf_counter()
+                    database.query(query.format(table=table))
+                    times.append(time.perf_counter() - start)
+                r["scans"][name] = min(times)
+        finally:
+            if not keep:
+                database.query(f"DROP TABLE IF EXISTS {table}")
+
+        if progress is not None:
+            progress(r)
+        reports.append(r)
+    return reports
@@ -0,0 +1,239 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+import time
+import random
+import threading
+
+from testflows.database.base import DatabaseConnectionError, DatabaseServerError
+from testflows.database.metrics import registry
+
+error_code_re = re.compile(r"Code: (\d+)\.")
+
+#: ClickHouse error codes of transient server errors by error class
+error_codes = {
+    202: "overloaded", # TOO_MANY_SIMULTANEOUS_QUERIES
+    252: "too_many_parts", # TOO_MANY_PARTS
+    209: "unavailable", # SOCKET_TIMEOUT
+    210: "unavailable", # NETWORK_ERROR
+    242: "unavailable", # TABLE_IS_READ_ONLY
+    319: "unavailable" # UNKNOWN_STATUS_OF_INSERT
+}
+
+#: HTTP status codes of transient server errors
+unavailable_statuses = (502, 503, 504)
+
+def error_class(exc):
+    """Return error class of the exception
+    or None if the error is not transient.
+
+    Error classes are:
+        'connection'     failed to connect or to get response
+        'unavailable'    server or a replica is unavailable
+        'overloaded'     too many simultaneous queries
+        'too_many_parts' too many parts in a partition
+    """
+    if isinstance(exc, DatabaseConnectionError):
+        return "connection"
+    if isinstance(exc, DatabaseServerError):
+        match = error_code_re.search(str(exc))
+        if match and int(match.group(1)) in error_codes:
+            return error_codes[int(match.group(1))]
+        if exc.status in unavailable_statuses:
+            return "unavailable"
+    return None
+
+#: statements that only read data
+read_statement_re = re.compile(r"\s*(SELECT|WITH|SHOW|DESCRIBE|DESC|EXISTS|EXPLAIN)\b", re.IGNORECASE)
+
+insert_statement_re = re.compile(r"\s*INSERT\b", re.IGNORECASE)
+
+def idempotent(query, params=None):
+    """Return True if the query can be retried without
+    changing the data more than once.
+
+    Queries that only read data and inserts that have
+    the `insert_deduplication_token` setting are idempotent.
+    Any other query could be applied by the server even if
+    the response was not received, for example after
+    a read timeout, so it is not retried.
+
+    :param query: query
+    :param params: query HTTP parameters, default: None
+    """
+    if read_statement_re.match(query):
+        return True
+    if insert_statement_re.match(query):
+        return bool((params or {}).get("insert_deduplication_token"))
+    return False
+
+class RetryPolicy:
+    """Retry policy with exponential backoff and jitter.
+
+    The delay before retry number n (starting from 0) is
+    min(`max_backoff`, `backoff` * `multiplier` ** n) reduced
+    by a random fraction of up to `jitter` so that clients
+    that failed at the same time do not retry at the same time.
+    """
+    def __init__(self, retries=3, backoff=0.1, max_backoff=10, multiplier=2, jitter=1):
+        """
+        :param retries: maximum number of retries, default: 3
+        :param backoff: initial backoff in seconds, default: 0.1
+        :param max_backoff: maximum backoff in seconds, default: 10
+        :param multiplier: backoff multiplier, default: 2
+        :param jitter: fraction of the backoff that is randomized
+            where 0 is no jitter and 1 is full jitter, default: 1
+        """
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.multiplier = float(multiplier)
+        self.jitter = float(jitter)
+
+    def __repr__(self):
+        return (f"RetryPolicy(retries={self.retries}, backoff={self.backoff}, "
+            f"max_backoff={self.max_backoff}, multiplier={self.multiplier}, jitter={self.jitter})")
+
+    def delay(self, attempt):
+        """Return delay in seconds before the retry
+        or None if no more retries are left.
+
+        :param attempt: number of the failed attempt starting from 0
+        """
+        if attempt >= self.retries:
+            return None
+        backoff = min(self.max_backoff, self.backoff * self.multiplier ** attempt)
+        return backoff * (1 - self.jitter * random.random())
+
+default_policies = {
+    "connection": RetryPolicy(retries=3, backoff=0.1, max_backoff=2),
+    "unavailable": RetryPolicy(retries=5, backoff=0.5, max_backoff=10),
+    "overloaded": RetryPolicy(retries=5, backoff=0.5, max_backoff=10),
+    "too_many_parts": RetryPolicy(retries=10, backoff=1, max_backoff=30)
+}
+
+def retry_policies(spec=None):
+    """Return retry policies by error class using the default policies
+    updated by the specification.
+
+    Specification is a comma separated list of
+    '<error class>:<retries>[:<backoff>[:<max backoff>]]' entries,
+    for example 'too_many_parts:20:2:60,connection:0'.
+    Setting retries to 0 disables retries for the error class.
+
+    :param spec: specification, default: None
+    """
+    policies = dict(default_policies)
+    for entry in (spec or "").split(","):
+        if not entry.strip():
+            continue
+        name, *values = [value.strip() for value in entry.split(":")]
+        if name not in default_policies:
+            raise ValueError(f"unknown error class '{name}'")
+        if not values or len(values) > 3:
+            raise ValueError(f"invalid retry policy '{entry}'")
+        if int(values[0]) <= 0:
+            policies.pop(name)
+            continue
+        policies[name] = RetryPolicy(*values)
+    return policies
+
+class CircuitBreaker:
+    """Circuit breaker that rejects requests while the server recovers.
+
+    The circuit opens after `failure_threshold` consecutive transient
+    failures and requests are rejected without being sent.
+    After `recovery_timeout` seconds the circuit becomes half-open
+    and up to `half_open_requests` trial requests are allowed.
+    The circuit closes if a trial request succeeds and opens
+    again if it fails.
+
+    State transitions are counted in the metrics registry
+    and passed to the `on_transition` callback.
+    """
+    closed = "closed"
+    open = "open"
+    half_open = "half-open"
+
+    def __init__(self, failure_threshold=5, recovery_timeout=10, half_open_requests=1,
+            on_transition=None, metrics=None):
+        """
+        :param failure_threshold: number of consecutive failures that open the circuit, default: 5
+        :param recovery_timeout: time in seconds before the open circuit becomes half-open, default: 10
+        :param half_open_requests: number of trial requests in half-open state, default: 1
+        :param on_transition: function called with (name, old state, new state), default: None
+        :param metrics: metrics registry, default: global registry
+        """
+        self.failure_threshold = int(failure_threshold)
+        self.recovery_timeout = float(recovery_timeout)
+        self.half_open_requests = int(half_open_requests)
+        self.on_transition = on_transition
+        self.name = None
+        self.lock = threading.Lock()
+        self.state = self.closed
+        self.failures = 0
+        self.trials = 0
+        self.opened_at = None
+        metrics = metrics if metrics is not None else registry
+        self.transitions = {
+            self.closed: metrics.counter("database_io_circuit_closed_total", "circuit breaker transitions to closed"),
+            self.open: metrics.counter("database_io_circuit_opened_total", "circuit breaker transitions to open"),
+            self.half_open: metrics.counter("database_io_circuit_half_opened_total",
+                "circuit breaker transitions to half-open")
+        }
+        self.open_circuits = metrics.gauge("database_io_circuit_open", "open circuit breakers")
+
+    def transition(self, state):
+        old, self.state = self.state, state
+        self.transitions[state].inc()
+        if state == self.open:
+            self.open_circuits.inc()
+        elif old == self.open:
+            self.open_circuits.dec()
+        if self.on_transition is not None:
+            self.on_transition(self.name, old, state)
+
+    def allow(self):
+        """Return True if request is allowed.
+        """
+        with self.lock:
+            if self.state == self.open:
+                if time.monotonic() - self.opened_at < self.recovery_timeout:
+                    return False
+                self.trials = 0
+                self.transition(self.half_open)
+            if self.state == self.half_open:
+                if self.trials >= self.half_open_requests:
+                    return False
+                self.trials += 1
+            return True
+
+    def success(self):
+        """Record request that was answered by the server.
+        """
+        with self.lock:
+            self.failures = 0
+            if self.state != self.closed:
+                self.transition(self.closed)
+
+    def failure(self):
+        """Record request that failed with a transient error.
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.half_open or (self.state == self.closed
+                    and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.transition(self.open)
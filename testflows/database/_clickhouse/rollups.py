@@ -0,0 +1,237 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Rollups of test results.
+
+The `results_rollup` table is an AggregatingMergeTree table
+that holds aggregated results of each test, except steps,
+keyed by `test_top_key`, `test_key` and `message_date`.
+It is filled by the `results_rollup_mv` materialized view
+as RESULT messages are inserted into the `messages` table
+so that run summaries do not need to read the messages.
+
+Messages that were inserted before the materialized view was created
+are aggregated once by the backfill. Messages are split by insertion
+and not by their time so that late messages, such as replayed
+or loaded ones, are not aggregated twice. Before the view is created
+merges of the source table are stopped and the largest block number
+of its parts is recorded in the `results_rollup_backfills` table.
+The backfill then only reads the parts with block numbers up to
+the recorded one, as later parts are aggregated by the view, and it
+is marked as done once it is complete so that running the statements
+again does not aggregate the messages twice. Merges are started
+again once the backfill is done.
+"""
+import datetime
+
+rollup_table = "results_rollup"
+
+rollup_view = "results_rollup_mv"
+
+backfills_table = "results_rollup_backfills"
+
+rollup_columns = """
+    test_top_key UInt64,
+    test_key UInt64,
+    message_date Date,
+    test_top SimpleAggregateFunction(any, String),
+    test_id SimpleAggregateFunction(any, String),
+    test_name SimpleAggregateFunction(any, String),
+    result_count SimpleAggregateFunction(sum, UInt64),
+    ok_count SimpleAggregateFunction(sum, UInt64),
+    fail_count SimpleAggregateFunction(sum, UInt64),
+    error_count SimpleAggregateFunction(sum, UInt64),
+    null_count SimpleAggregateFunction(sum, UInt64),
+    skip_count SimpleAggregateFunction(sum, UInt64),
+    xfail_count SimpleAggregateFunction(sum, UInt64),
+    duration_sum SimpleAggregateFunction(sum, Float64),
+    duration_max SimpleAggregateFunction(max, Float64),
+    duration_quantiles AggregateFunction(quantiles(0.5, 0.9, 0.99), Float64),
+    min_start_time SimpleAggregateFunction(min, Float64),
+    max_end_time SimpleAggregateFunction(max, Float64),
+    last_result AggregateFunction(argMax, String, Float64)
+"""
+
+#: aggregates RESULT messages where message_rtime is the test duration
+rollup_select = """SELECT
+    test_top_key,
+    test_key,
+    message_date,
+    any(test_top) AS test_top,
+    any(test_id) AS test_id,
+    any(test_name) AS test_name,
+    count() AS result_count,
+    countIf(result_type = 'OK') AS ok_count,
+    countIf(result_type = 'Fail') AS fail_count,
+    countIf(result_type = 'Error') AS error_count,
+    countIf(result_type = 'Null') AS null_count,
+    countIf(result_type = 'Skip') AS skip_count,
+    countIf(result_type IN ('XOK', 'XFail', 'XError', 'XNull')) AS xfail_count,
+    sum(message_rtime) AS duration_sum,
+    max(message_rtime) AS duration_max,
+    quantilesState(0.5, 0.9, 0.99)(message_rtime) AS duration_quantiles,
+    min(message_time - message_rtime) AS min_start_time,
+    max(message_time) AS max_end_time,
+    argMaxState(toString(result_type), message_time) AS last_result
+FROM {source}
+WHERE message_keyword = 'RESULT' AND test_type != 'Step'
+GROUP BY test_top_key, test_key, message_date"""
+
+def source_view(source):
+    """Return materialized view that aggregates
+    the source table into the rollup.
+    """
+    return rollup_view if source == "messages" else f"{source}_rollup_mv"
+
+class Backfill:
+    """Statement that aggregates RESULT messages of the parts
+    of the source table recorded before the view was created.
+
+    The backfill is inserted using a deduplication token that is unique
+    to the recorded backfill so that it is not applied twice
+    if it is interrupted before it is marked as done.
+    """
+    def __init__(self, source, view):
+        self.source = source
+        self.view = view
+        pending = (f"SELECT {{column}} FROM {backfills_table} FINAL"
+            f" WHERE source = '{source}' AND backfilled = 0")
+        self.pending_query = pending.format(column="run")
+        self.query = (f"INSERT INTO {rollup_table} " + rollup_select.format(source=source).replace("WHERE ",
+            f"WHERE _part IN (SELECT name FROM system.parts WHERE database = currentDatabase()"
+            f" AND table = '{source}' AND active AND max_block_number <= ({pending.format(column='max_block')}))"
+            " AND ", 1) + "\nORDER BY test_top_key, test_key, message_date")
+
+    def __str__(self):
+        return self.query
+
+    def __call__(self, database):
+        r = database.query(self.pending_query).any()
+        if not r:
+            return
+        database.query(self.query, params={"insert_deduplication_token": f"{self.view}_{r[0]['run']}"})
+
+def source_statements(source="messages", view=rollup_view):
+    """Return statements that aggregate RESULT messages
+    of the source table into the rollup.
+
+    The statements stop merges of the source table, record its largest
+    block number if the view does not exist yet, create the view,
+    check that no part mixes recorded and later blocks, backfill
+    the recorded parts unless the backfill is done, mark it as done
+    and start merges again.
+
+    :param source: source table, default: 'messages'
+    :param view: materialized view, default: `rollup_view`
+    """
+    parts = f"system.parts WHERE database = currentDatabase() AND table = '{source}' AND active"
+    pending = f"{backfills_table} FINAL WHERE source = '{source}' AND backfilled = 0"
+    return [
+        f"SYSTEM STOP MERGES {source}",
+        f"INSERT INTO {backfills_table} (source, run, max_block)"
+            f" SELECT '{source}', generateUUIDv4(), max(max_block_number) FROM {parts}"
+            f" HAVING (SELECT count() FROM system.tables WHERE database = currentDatabase() AND name = '{view}') = 0",
+        f"CREATE MATERIALIZED VIEW IF NOT EXISTS {view} TO {rollup_table} AS {rollup_select.format(source=source)}",
+        f"SELECT throwIf(count() > 0, 'parts of {source} were merged after the backfill was recorded')"
+            f" FROM {parts} AND min_block_number <= (SELECT max_block FROM {pending})"
+            f" AND max_block_number > (SELECT max_block FROM {pending})",
+        Backfill(source, view),
+        f"INSERT INTO {backfills_table} (source, run, max_block, backfilled)"
+            f" SELECT source, run, max_block, 1 FROM {pending}",
+        f"SYSTEM START MERGES {source}"
+    ]
+
+#: statements that create the rollup of the messages table,
+#: statements can be run again if they are interrupted
+statements = [
+    f"CREATE TABLE IF NOT EXISTS {rollup_table}\n({rollup_columns}) ENGINE = AggregatingMergeTree()\n"
+        "PARTITION BY toYYYYMM(message_date)\nORDER BY (test_top_key, test_key, message_date)\n"
+        "SETTINGS non_replicated_deduplication_window = 1000",
+    f"CREATE TABLE IF NOT EXISTS {backfills_table} (source String, run UUID, max_block Int64, backfilled UInt8)"
+        " ENGINE = ReplacingMergeTree(backfilled) ORDER BY source"
+] + source_statements()
+
+#: results of each test of the runs using the last result of each test
+tests_query = f"""SELECT
+    test_top_key,
+    test_key,
+    any(test_top) AS top,
+    any(test_name) AS name,
+    argMaxMerge(last_result) AS test_result,
+    min(min_start_time) AS start_time,
+    max(max_end_time) AS end_time
+FROM {rollup_table}
+WHERE {{where}}
+GROUP BY test_top_key, test_key"""
+
+runs_query = f"""SELECT
+    any(top) AS test_top,
+    anyIf(name, test_key = test_top_key) AS test_name,
+    anyIf(test_result, test_key = test_top_key) AS result,
+    countIf(test_key != test_top_key) AS tests,
+    countIf(test_key != test_top_key AND test_result = 'OK') AS passed,
+    countIf(test_key != test_top_key AND test_result = 'Fail') AS failed,
+    countIf(test_key != test_top_key AND test_result = 'Error') AS errored,
+    countIf(test_key != test_top_key AND test_result = 'Null') AS nulled,
+    countIf(test_key != test_top_key AND test_result = 'Skip') AS skipped,
+    countIf(test_key != test_top_key AND startsWith(test_result, 'X')) AS xfailed,
+    min(start_time) AS started,
+    max(end_time) AS ended,
+    ended - started AS duration
+FROM ({tests_query})
+GROUP BY test_top_key
+ORDER BY started DESC
+LIMIT {{{{limit:UInt32}}}}"""
+
+tests_summary_query = f"""SELECT
+    test_name,
+    uniqExact(test_top_key) AS runs,
+    sum(result_count) AS results,
+    sum(ok_count) AS passed,
+    sum(fail_count) AS failed,
+    sum(error_count) AS errored,
+    sum(null_count) AS nulled,
+    sum(skip_count) AS skipped,
+    sum(xfail_count) AS xfailed,
+    least(passed, failed + errored + nulled) / results AS flakiness,
+    sum(duration_sum) / results AS mean_duration,
+    max(duration_max) AS max_duration,
+    quantilesMerge(0.5, 0.9, 0.99)(duration_quantiles) AS duration_quantiles
+FROM {rollup_table}
+WHERE message_date >= {{since:Date}} AND test_key != test_top_key
+GROUP BY test_name
+HAVING {{flaky:UInt8}} = 0 OR flakiness > 0
+ORDER BY flakiness DESC, failed + errored + nulled DESC, results DESC
+LIMIT {{limit:UInt32}}"""
+
+def since_date(since):
+    return since if since is not None else datetime.date(1970, 1, 1)
+
+def run_summary_request(run):
+    """Return query and parameters of the summary of the run.
+    """
+    return (runs_query.format(where="test_top_key = cityHash64({run:String})"),
+        {"run": run, "limit": 1})
+
+def run_summaries_request(since=None, limit=100):
+    """Return query and parameters of the summaries of the runs.
+    """
+    return (runs_query.format(where="message_date >= {since:Date}"),
+        {"since": since_date(since), "limit": int(limit)})
+
+def test_summaries_request(since=None, flaky=False, limit=100):
+    """Return query and parameters of the summaries of the tests.
+    """
+    return (tests_summary_query,
+        {"since": since_date(since), "flaky": bool(flaky), "limit": int(limit)})
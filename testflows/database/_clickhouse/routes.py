@@ -0,0 +1,109 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keyword-routed storage of messages.
+
+Instead of writing every message into one wide `messages` row,
+each message is written to a narrow `<table>_<route>` table
+that only has the columns common to all messages and the columns
+of the message keyword. For example, RESULT messages are written to
+`messages_result` and ATTRIBUTE messages to `messages_attribute`.
+Messages with keywords that do not have their own columns are
+written to `messages_message`.
+
+The `<table>_view` table uses the Merge engine to read
+all the routed tables back as one table with all the columns,
+where the columns a routed table does not have are read
+as default values.
+"""
+from testflows.database._clickhouse import jsonbackend
+from testflows.database._clickhouse.profiles import column_definitions, messages_schema
+
+#: routes that have their own columns with the route name prefix
+keyword_routes = ("test", "result", "attribute", "requirement", "argument", "tag",
+    "example", "node", "ticket", "value", "metric")
+
+#: route of the messages with any other keyword
+default_route = "message"
+
+routes = keyword_routes + (default_route,)
+
+#: columns that are set in all messages
+common_columns = ("test_type", "test_subtype", "test_id", "test_key", "test_parent",
+    "test_top", "test_top_key", "test_istop", "test_flags", "test_cflags", "test_level", "test_name")
+
+def column_route(name):
+    """Return route of the column or None
+    if the column is common to all routes.
+    """
+    if name.startswith("message_") or name in common_columns:
+        return None
+    prefix = name.split("_", 1)[0]
+    return prefix if prefix in keyword_routes else default_route
+
+def keyword_route(keyword):
+    """Return route of the message keyword.
+    """
+    route = keyword.lower()
+    return route if route in keyword_routes else default_route
+
+def route_columns(route):
+    """Return names of the columns of the routed table.
+    """
+    return [name for name, type, default, codec in column_definitions()
+        if column_route(name) in (None, route)]
+
+def route_table(table, route):
+    return f"{table}_{route}"
+
+def view_table(table):
+    return f"{table}_view"
+
+keyword_prefix = '{"message_keyword":"'
+
+def message_keyword(line):
+    """Return keyword of the JSON message line.
+    """
+    # messages are written with the keyword first
+    if line.startswith(keyword_prefix):
+        return line[len(keyword_prefix):line.index('"', len(keyword_prefix))]
+    return jsonbackend.loads(line)["message_keyword"]
+
+def split(lines):
+    """Split message lines by route.
+
+    :param lines: list of JSON message lines
+    """
+    batches = {}
+    for line in lines:
+        batches.setdefault(keyword_route(message_keyword(line)), []).append(line)
+    return batches
+
+def routed_schema(table="messages", profile="default", ttl=None):
+    """Return statements that create the routed tables
+    and the view that merges them back.
+
+    :param table: table name, default: 'messages'
+    :param profile: schema profile, default: 'default'
+    :param ttl: number of days messages are kept, default: None (keep forever)
+    """
+    statements = []
+    for route in routes:
+        statements.append(messages_schema(profile, table=route_table(table, route), ttl=ttl,
+            include=set(route_columns(route))).replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+
+    columns = ",\n".join(f"    {name} {type}" for name, type, default, codec in column_definitions(profile))
+    statements.append(f"CREATE TABLE IF NOT EXISTS {view_table(table)}\n(\n{columns}\n)"
+        f" ENGINE = Merge(currentDatabase(), '^{table}_({'|'.join(routes)})$')")
+    return statements
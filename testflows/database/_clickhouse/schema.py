@@ -13,9 +13,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-schema = [
-"DROP TABLE IF EXISTS messages",
-"""CREATE TABLE messages
+messages_table = """CREATE TABLE messages
 (
     message_keyword Enum8(
         'NONE' = 0,
@@ -162,8 +160,36 @@ schema = [
     result_test String
 ) ENGINE = MergeTree()
 PARTITION BY toYYYYMM(message_date)
-ORDER BY (test_id, message_num)"""
+ORDER BY (test_id, message_num)
+SETTINGS non_replicated_deduplication_window = 1000"""
+
+#: statements that create the initial messages table,
+#: see `migrations` for the statements that evolve it in place
+schema = [
+    "DROP TABLE IF EXISTS messages",
+    messages_table
 ]
 
+def columns(statement=messages_table):
+    """Return list of (name, definition) tuples for the columns
+    of the CREATE TABLE statement where the definition is
+    the column type followed by any default expression.
+    """
+    body = statement[statement.index("(") + 1:statement.rindex(") ENGINE")]
+    body = "\n".join(line.split("--", 1)[0] for line in body.splitlines())
+    columns, depth, start = [], 0, 0
+    for i, c in enumerate(body + ","):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            definition = " ".join(body[start:i].split())
+            start = i + 1
+            if definition:
+                name, definition = definition.split(" ", 1)
+                columns.append((name, definition.replace("Enum8 (", "Enum8(")))
+    return columns
+
 if __name__ == "__main__":
     print(";\n".join(schema))
@@ -0,0 +1,128 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import threading
+
+class Spool:
+    """Append-only on-disk spool of insert batches.
+
+    Each batch is stored in its own file named using
+    an increasing sequence number so that batches
+    can be replayed in the order they were spooled.
+    The file contains the insert query on the first line
+    followed by the batch data.
+
+    Batches that the server rejects with a permanent error
+    are moved to the `quarantine` subdirectory together with
+    the error so that they do not block replaying later batches.
+    """
+    suffix = ".batch"
+    error_suffix = ".error"
+
+    def __init__(self, path):
+        self.path = path
+        self.quarantine_path = os.path.join(path, "quarantine")
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        entries = self.entries()
+        self.count = len(entries)
+        # quarantined batches keep their names so sequence numbers
+        # must not be reused even if the spool itself is empty
+        names = entries[-1:] + self.quarantined()[-1:]
+        self.seq = max((int(name.split(".", 1)[0]) for name in names), default=0)
+
+    def __len__(self):
+        return self.count
+
+    def entries(self):
+        """Return names of the spooled batches in order.
+        """
+        return sorted(name for name in os.listdir(self.path) if name.endswith(self.suffix))
+
+    def append(self, query, body):
+        """Durably store a batch.
+
+        :param query: insert query
+        :param body: batch data
+        """
+        name = self.next_name()
+        self.store(os.path.join(self.path, name), query.encode("utf-8") + b"\n" + body)
+
+        with self.lock:
+            self.count += 1
+
+        return name
+
+    def next_name(self):
+        with self.lock:
+            self.seq += 1
+            return f"{self.seq:020d}{self.suffix}"
+
+    def store(self, path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp_path, path)
+
+    def quarantine(self, query, body, error):
+        """Durably store a batch that can't be inserted
+        in the quarantine directory.
+
+        :param query: insert query
+        :param body: batch data
+        :param error: error returned by the server
+        """
+        os.makedirs(self.quarantine_path, exist_ok=True)
+        name = self.next_name()
+        self.store(os.path.join(self.quarantine_path, name[:-len(self.suffix)] + self.error_suffix),
+            str(error).encode("utf-8"))
+        self.store(os.path.join(self.quarantine_path, name), query.encode("utf-8") + b"\n" + body)
+        return name
+
+    def quarantine_entry(self, name, error):
+        """Move spooled batch to the quarantine directory.
+
+        :param name: name of the spooled batch
+        :param error: error returned by the server
+        """
+        os.makedirs(self.quarantine_path, exist_ok=True)
+        self.store(os.path.join(self.quarantine_path, name[:-len(self.suffix)] + self.error_suffix),
+            str(error).encode("utf-8"))
+        os.rename(os.path.join(self.path, name), os.path.join(self.quarantine_path, name))
+        with self.lock:
+            self.count -= 1
+
+    def quarantined(self):
+        """Return names of the quarantined batches in order.
+        """
+        if not os.path.exists(self.quarantine_path):
+            return []
+        return sorted(name for name in os.listdir(self.quarantine_path) if name.endswith(self.suffix))
+
+    def read(self, name):
+        """Return query and body of the spooled batch.
+        """
+        with open(os.path.join(self.path, name), "rb") as fd:
+            query, body = fd.read().split(b"\n", 1)
+        return query.decode("utf-8"), body
+
+    def remove(self, name):
+        """Remove spooled batch.
+        """
+        os.remove(os.path.join(self.path, name))
+        with self.lock:
+            self.count -= 1
@@ -12,37 +12,266 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import time
+import hashlib
+import logging
 import threading
 import concurrent.futures
 
+from testflows.database.base import DatabaseError
+from testflows.database._clickhouse import jsonbackend
+from testflows.database._clickhouse.spool import Spool
+from testflows.database._clickhouse import routes
+from testflows.database._clickhouse.retry import error_class
+from testflows.database._clickhouse.adaptive import parts_query
+from testflows.database.metrics import registry, rows_buckets, bytes_buckets
+
 auto_flush_interval = 0.25
+max_batch_rows = 100000
+max_batch_bytes = 16 * 1024 * 1024
+max_inflight = 5
+spool_retry_interval = 1
+spool_drain_timeout = 10
+
+logger = logging.getLogger("testflows.database")
+
+formats = {
+    "JSONEachRow": lambda table, batch: "".join(batch).encode("utf-8"),
+    "RowBinary": lambda table, batch: table.encode_rows(jsonbackend.loads_rows("".join(batch)))
+}
+
+def utf8_size(s):
+    """Return size of the string encoded in UTF-8.
+    """
+    return len(s) if s.isascii() else len(s.encode("utf-8"))
+
+def writer_metrics(registry):
+    """Return writer metrics from the registry.
+    """
+    self = State()
+    self.messages = registry.counter("database_writer_messages_total", "messages received")
+    self.committed = registry.counter("database_writer_committed_messages_total",
+        "messages inserted or spooled")
+    self.lag = registry.gauge("database_writer_lag_messages", "messages received but not yet committed")
+    self.lag_bytes = registry.gauge("database_writer_lag_bytes", "log bytes received but not yet committed")
+    self.buffer_messages = registry.gauge("database_writer_buffer_messages", "messages in the buffer")
+    self.buffer_bytes = registry.gauge("database_writer_buffer_bytes", "size of messages in the buffer")
+    self.inflight = registry.gauge("database_writer_inflight", "inserts in progress")
+    self.flushes = registry.counter("database_writer_flushes_total", "buffer flushes")
+    self.batch_rows = registry.histogram("database_writer_batch_rows", "messages in a batch", buckets=rows_buckets)
+    self.batch_bytes = registry.histogram("database_writer_batch_bytes", "size of encoded batch",
+        buckets=bytes_buckets)
+    self.encode_seconds = registry.histogram("database_writer_encode_seconds", "batch encoding time")
+    self.write_seconds = registry.histogram("database_writer_write_seconds", "batch encoding and insert time")
+    self.inserts = registry.counter("database_writer_inserts_total", "batch inserts")
+    self.insert_failures = registry.counter("database_writer_insert_failures_total", "failed batch inserts")
+    self.sent_bytes = registry.counter("database_writer_sent_bytes_total", "size of inserted batches")
+    self.spooled = registry.counter("database_writer_spooled_batches_total", "batches written to the spool")
+    self.replayed = registry.counter("database_writer_replayed_batches_total", "batches replayed from the spool")
+    self.quarantined = registry.counter("database_writer_quarantined_batches_total",
+        "batches rejected by the server that were moved to the spool quarantine")
+    self.flush_interval = registry.gauge("database_writer_flush_interval_seconds", "adaptive flush interval")
+    self.batch_rows_limit = registry.gauge("database_writer_batch_rows_limit", "adaptive maximum batch size")
+    self.parts = registry.gauge("database_writer_parts", "maximum number of active parts in a partition")
+    return self
+
+def encode(self, table, batch):
+    with self.metrics.encode_seconds.time():
+        body = self.encode(table, batch)
+    self.metrics.batch_rows.observe(len(batch))
+    self.metrics.batch_bytes.observe(len(body))
+    return body
+
+def insert_params(self, body):
+    """Return insert settings for the encoded batch.
+
+    The deduplication token is derived from the batch data
+    so that retried and replayed inserts of the same batch
+    are deduplicated by the server.
+    """
+    params = dict(self.insert_settings)
+    if self.deduplicate:
+        params["insert_deduplication_token"] = hashlib.sha1(body).hexdigest()
+    return params
+
+def committed(self, batch, checkpoint=None):
+    self.metrics.committed.inc(len(batch))
+    self.metrics.lag.dec(len(batch))
+    if checkpoint is not None:
+        self.checkpoint.done(checkpoint)
+        if self.offset is not None:
+            self.metrics.lag_bytes.set(self.offset - self.checkpoint.offset)
+
+def split(self, batch):
+    """Return list of (target, rows) tuples where target
+    is the (table, query) tuple the rows are inserted with.
+    """
+    if self.targets is None:
+        return [((self.table, self.query), batch)]
+    return [(self.targets[route], rows) for route, rows in routes.split(batch).items()]
+
+def insert(self, table, query, batch):
+    body = encode(self, table, batch)
+    try:
+        self.metrics.inserts.inc()
+        start = time.monotonic()
+        self.database.query(query, body=body, params=insert_params(self, body))
+        if self.controller is not None:
+            adapt(self, table, len(batch), time.monotonic() - start)
+        self.metrics.sent_bytes.inc(len(body))
+    except DatabaseError as exc:
+        self.metrics.insert_failures.inc()
+        if self.spool is None:
+            raise
+        if error_class(exc) is None:
+            self.spool.quarantine(query, body, exc)
+            self.metrics.quarantined.inc()
+            return
+        spool_batch(self, query, body)
+
+def write(self, batch, checkpoint=None):
+    """Encode and insert batch. If insert fails and spool is
+    enabled then the batch is spooled to be replayed later
+    unless the server rejected it with a permanent error
+    in which case it is moved to the spool quarantine.
+    Routed batches are inserted into each route's table in turn.
+    """
+    self.metrics.inflight.inc()
+    try:
+        with self.metrics.write_seconds.time():
+            for (table, query), rows in split(self, batch):
+                insert(self, table, query, rows)
+    finally:
+        self.metrics.inflight.dec()
+    committed(self, batch, checkpoint)
+
+def adapt(self, table, rows, latency):
+    """Update batch controller after an insert.
+    """
+    controller = self.controller
+    controller.observe(rows, latency)
+    if controller.check_parts():
+        try:
+            parts = self.database.query(parts_query, parameters={"table": table.name}).one()["parts"]
+            controller.observe_parts(int(parts or 0))
+        except DatabaseError:
+            pass
+    self.metrics.flush_interval.set(controller.flush_interval)
+    self.metrics.batch_rows_limit.set(controller.batch_rows)
+    if controller.parts is not None:
+        self.metrics.parts.set(controller.parts)
+
+def batch_rows(self):
+    """Return maximum number of messages in a batch.
+    """
+    if self.controller is not None:
+        return min(self.max_batch_rows, self.controller.batch_rows)
+    return self.max_batch_rows
+
+def spool_batch(self, query, body):
+    self.spool.append(query, body)
+    self.metrics.spooled.inc()
+    self.replay_event.set()
 
-def write(database, query):
-    database.query(query)
+def replay_entry(self, name):
+    """Replay spooled batch. Batches rejected with
+    a permanent error are moved to the quarantine.
+    """
+    query, body = self.spool.read(name)
+    self.metrics.inserts.inc()
+    try:
+        self.database.query(query, body=body, params=insert_params(self, body))
+    except DatabaseError as exc:
+        self.metrics.insert_failures.inc()
+        if error_class(exc) is not None:
+            raise
+        self.spool.quarantine_entry(name, exc)
+        self.metrics.quarantined.inc()
+        return
+    self.metrics.sent_bytes.inc(len(body))
+    self.metrics.replayed.inc()
+    self.spool.remove(name)
+
+def replay(self):
+    """Replay spooled batches one at a time in order
+    stopping at the first batch that fails to be inserted
+    until `spool_retry_interval` passes.
+    """
+    while not self.replay_stop.is_set():
+        if not len(self.spool):
+            self.replay_event.wait(auto_flush_interval)
+            self.replay_event.clear()
+            continue
+
+        try:
+            for name in self.spool.entries():
+                if self.replay_stop.is_set():
+                    break
+                replay_entry(self, name)
+        except DatabaseError:
+            self.replay_stop.wait(spool_retry_interval)
+        except Exception:
+            logger.exception("failed to replay spooled batch")
+            self.replay_stop.wait(spool_retry_interval)
+
+def drain(self):
+    """Wait for spooled batches to be replayed
+    for at most `spool_drain_timeout` seconds
+    and stop replaying. Any batches that remain
+    are replayed the next time the spool is used.
+    """
+    deadline = time.time() + spool_drain_timeout
+    while len(self.spool) and time.time() < deadline:
+        time.sleep(0.05)
+    self.replay_stop.set()
+    self.replay_event.set()
+    self.replayer.join()
 
 def flush(self, final=False):
-    self.timer.cancel()
-    query = None
-
-    with self.buffer as buffer:
-        if buffer:
-            query = f"{self.query} {' '.join(buffer)}"
-            del buffer[:]
-
-    if query:
-        self.tasks.append(self.workers.submit(write, self.database, query))
-
-    if not final:
-        done, pending = concurrent.futures.wait(self.tasks, return_when=concurrent.futures.FIRST_COMPLETED)
-        for task in done:
-            task.result()
-        self.tasks = list(pending)
-    else:
-        for task in self.tasks:
-            task.result()
+    with self.lock:
+        if self.closed:
+            return
 
-    if not final:
-        self.timer = set_timer(self)
+        self.timer.cancel()
+
+        with self.buffer as buffer:
+            offset = buffer.offset
+            batch = buffer.take()
+            self.metrics.buffer_messages.set(0)
+            self.metrics.buffer_bytes.set(0)
+
+        done, pending = concurrent.futures.wait(self.tasks, timeout=0)
+
+        if batch:
+            self.metrics.flushes.inc()
+            checkpoint = self.checkpoint.add(offset) if self.checkpoint is not None else None
+            if self.spool is not None and (len(self.spool) or len(pending) >= self.max_inflight):
+                for (table, query), rows in split(self, batch):
+                    spool_batch(self, query, encode(self, table, rows))
+                committed(self, batch, checkpoint)
+            else:
+                task = self.workers.submit(write, self, batch, checkpoint)
+                self.tasks.append(task)
+                pending.add(task)
+
+        if not final:
+            while self.spool is None and len(pending) >= self.max_inflight:
+                done_, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                done |= done_
+            for task in done:
+                task.result()
+            self.tasks = list(pending)
+        else:
+            self.closed = True
+            for task in self.tasks:
+                task.result()
+            if self.spool is not None:
+                drain(self)
+            if self.checkpoint is not None:
+                self.checkpoint.finish()
+
+        if not final:
+            self.timer = set_timer(self)
 
 class State:
     pass
@@ -50,46 +279,175 @@ class State:
 class Buffer():
     def __init__(self):
         self.buffer = []
+        self.size = 0
+        self.offset = None
         self.lock = threading.Lock()
         super(Buffer, self).__init__()
 
     def __enter__(self):
         self.lock.acquire()
-        return self.buffer
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.lock.release()
 
+    def __len__(self):
+        return len(self.buffer)
+
+    def append(self, msg, offset=None):
+        """Append message.
+
+        :param msg: message
+        :param offset: log offset right after the message, default: None
+        """
+        self.buffer.append(msg)
+        self.size += utf8_size(msg)
+        self.offset = offset
+
+    def take(self):
+        """Remove and return all buffered messages.
+        """
+        batch, self.buffer, self.size = self.buffer, [], 0
+        return batch
+
 def set_timer(self):
-    timer = threading.Timer(auto_flush_interval, flush, (self,))
+    interval = self.controller.flush_interval if self.controller is not None else auto_flush_interval
+    timer = threading.Timer(interval, flush, (self,))
+    timer.daemon = True
     timer.start()
     return timer
 
-def transform(database, stop, table="messages"):
+def insert_target(table, format):
+    """Return (table, query) tuple used to insert into the table.
+    """
+    if format == "RowBinary":
+        return table, f"INSERT INTO {table.name} ({', '.join(table.columns)}) FORMAT RowBinary"
+    return table, f"INSERT INTO {table.name} FORMAT JSONEachRow"
+
+def transform(database, stop, table="messages", format="JSONEachRow",
+        max_batch_rows=max_batch_rows, max_batch_bytes=max_batch_bytes, max_inflight=max_inflight,
+        spool=None, checkpoint=None, metrics=None, controller=None, deduplicate=True,
+        async_insert=False, wait_for_async_insert=True, routed=False):
     """Write to ClickHouse database.
 
+    Messages are buffered and flushed every `auto_flush_interval` seconds
+    or as soon as the buffer reaches `max_batch_rows` messages or `max_batch_bytes` bytes.
+    When `max_inflight` inserts are already in progress the flush blocks
+    which in turn blocks the sender until the database catches up.
+
+    If `spool` directory is specified then batches that fail to be inserted
+    or that would otherwise block are written to the spool instead
+    and replayed in order once the database catches up. Batches that
+    the server rejects with a permanent error, such as a parse error,
+    are moved to the `quarantine` subdirectory of the spool instead.
+
+    If `controller` is specified then the flush interval and the maximum
+    batch size are adapted using the insert latency and the number of parts.
+
+    If `checkpoint` is specified then messages must be tuples of
+    (line, offset) and the checkpoint is advanced as batches are committed.
+
+    If `deduplicate` is set then each batch is inserted with
+    an `insert_deduplication_token` computed from the batch data
+    so that retrying or replaying a batch does not duplicate rows.
+    Deduplication requires a replicated table or a MergeTree table
+    with the `non_replicated_deduplication_window` setting.
+
+    If `async_insert` is set then batches are inserted using ClickHouse
+    asynchronous inserts so that the server can combine small inserts
+    from many concurrent writers. If `wait_for_async_insert` is not set
+    then the insert returns before the data is flushed by the server.
+
+    If `routed` is set then each batch is split by message keyword
+    and each part is inserted into the narrow `<table>_<route>` table
+    of its route as created by `routes.routed_schema()`.
+
     :param database: database object
     :param stop: stop event
     :param table: table name, default: 'messages'
+    :param format: insert format either 'JSONEachRow' or 'RowBinary',
+        default: 'JSONEachRow'
+    :param max_batch_rows: maximum number of messages in a batch, default: 100000
+    :param max_batch_bytes: maximum size of messages in a batch, default: 16 MiB
+    :param max_inflight: maximum number of concurrent inserts, default: 5
+    :param spool: spool directory, default: None
+    :param checkpoint: checkpoint object, default: None
+    :param metrics: metrics registry, default: global registry
+    :param controller: batch controller, default: None
+    :param deduplicate: insert batches with deduplication token, default: True
+    :param async_insert: use asynchronous inserts, default: False
+    :param wait_for_async_insert: wait for asynchronous inserts to be flushed, default: True
+    :param routed: insert messages into keyword-routed tables, default: False
     """
+    if format not in formats:
+        raise ValueError(f"unsupported format '{format}'")
+
     self = State()
     self.buffer = Buffer()
+    self.lock = threading.Lock()
+    self.closed = False
     self.database = database
-    self.table = self.database.table(table)
-    self.query = f"INSERT INTO {self.table.name} FORMAT JSONEachRow "
+    self.encode = formats[format]
+    self.targets = None
+    if routed:
+        self.targets = {route: insert_target(self.database.table(routes.route_table(table, route)), format)
+            for route in routes.routes}
+    else:
+        self.table, self.query = insert_target(self.database.table(table), format)
+    self.max_batch_rows = int(max_batch_rows)
+    self.max_batch_bytes = int(max_batch_bytes)
+    self.max_inflight = int(max_inflight)
     self.tasks = []
-    self.timer = set_timer(self)
+    self.spool = Spool(spool) if spool is not None else None
+    self.checkpoint = checkpoint
+    self.controller = controller
+    self.deduplicate = bool(deduplicate)
+    self.insert_settings = {}
+    if async_insert:
+        self.insert_settings["async_insert"] = 1
+        self.insert_settings["wait_for_async_insert"] = int(bool(wait_for_async_insert))
+        if self.deduplicate:
+            self.insert_settings["async_insert_deduplicate"] = 1
+    if routed and format == "JSONEachRow":
+        # messages carry columns of other routes
+        self.insert_settings["input_format_skip_unknown_fields"] = 1
+    self.offset = None
+    self.metrics = writer_metrics(metrics if metrics is not None else registry)
 
     msg = None
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as workers:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_inflight) as workers:
         self.workers = workers
+        self.timer = set_timer(self)
+
+        if self.spool is not None:
+            self.replay_stop = threading.Event()
+            self.replay_event = threading.Event()
+            self.replayer = threading.Thread(target=replay, args=(self,), daemon=True)
+            self.replayer.name = "tfs-database-replay"
+            self.replayer.start()
 
         while True:
             if msg is not None:
+                line, offset = msg, None
+                if type(msg) is tuple:
+                    line, offset = msg
+                    offset += utf8_size(line) + (self.checkpoint.start if self.checkpoint else 0)
+
                 with self.buffer as buffer:
-                    buffer.append(msg)
+                    buffer.append(line, offset)
+                    full = len(buffer) >= batch_rows(self) or buffer.size >= self.max_batch_bytes
+                    self.metrics.buffer_messages.set(len(buffer))
+                    self.metrics.buffer_bytes.set(buffer.size)
+
+                self.metrics.messages.inc()
+                self.metrics.lag.inc()
+                if offset is not None and self.checkpoint is not None:
+                    self.offset = offset
+                    self.metrics.lag_bytes.set(offset - self.checkpoint.offset)
 
                 if stop is not None and stop.is_set():
                     flush(self, final=True)
+                elif full:
+                    flush(self)
 
             msg = yield msg
@@ -20,8 +20,38 @@ def argparser(parser):
             Options are specific to each output handler. For the default ClickHouse handler
             the following options can be specified:
                 'host=<hostname>'
+                'hosts=<hostname[:port],...>'
+                'pool_size=<connections per host>'
+                'pool_timeout=<seconds to wait for a free connection>'
+                'policy=<round-robin|least-loaded>'
                 'database=<database>'
                 'user=<user>'
-                'password=<password>'.
+                'password=<password>'
+                'format=<JSONEachRow|RowBinary>'
+                'compression=<gzip|deflate|zstd|lz4|br>'
+                'response_compression=<gzip|deflate|zstd|br>'
+                'json=<json|orjson|simdjson>'
+                'retry=<error class>:<retries>[:<backoff>[:<max backoff>]],...'
+                'circuit_breaker_threshold=<failures>'
+                'circuit_breaker_timeout=<seconds>'
+                'max_batch_rows=<rows>'
+                'max_batch_bytes=<bytes>'
+                'max_inflight=<inserts>'
+                'spool=<directory>'
+                'deduplicate=<0|1>'
+                'async_insert=<0|1>'
+                'wait_for_async_insert=<0|1>'
+                'routed=<0|1>'
+                'adaptive=<0|1>'
+                'min_flush_interval=<seconds>'
+                'max_flush_interval=<seconds>'
+                'min_batch_rows=<rows>'
+                'target_insert_rate=<inserts per second>'
+                'max_insert_latency=<seconds>'
+                'max_parts=<parts>'
+                'checkpoint=<file>'
+                'metrics=<file>'
+                'metrics_interval=<seconds>'
+                'metrics_port=<port>'.
             For example: '--database host=localhost'
             """, type=key_value_type, required=False)
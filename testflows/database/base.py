@@ -16,20 +16,29 @@ import json
 from collections import OrderedDict
 from collections.abc import Generator
 from collections import namedtuple
+from types import MappingProxyType
 
 __all__ = [
         "Database",
         "DatabaseConnection",
         "DatabaseQueryResponse",
         "DatabaseQueryStreamResponse",
+        "DatabaseQueryColumnsResponse",
+        "AsyncDatabase",
+        "AsyncDatabaseConnection",
+        "AsyncDatabaseQueryStreamResponse",
         "DatabaseError",
         "DatabaseConnectionError",
+        "DatabaseServerError",
+        "DatabaseCircuitOpenError",
         "DatabaseQueryError",
         "DatabaseQueryNoEntries",
         "DatabaseQueryMultipleEntries",
         "ColumnTypes",
         "ColumnType",
         "Table",
+        "Row",
+        "RowBatch",
         "Column",
         "Columns"
     ]
@@ -49,6 +58,18 @@ class DatabaseQueryMultipleEntries(DatabaseQueryError):
 class DatabaseConnectionError(DatabaseError):
     pass
 
+class DatabaseServerError(DatabaseError):
+    """Error response returned by the server.
+    """
+    def __init__(self, message, status=None):
+        super(DatabaseServerError, self).__init__(message)
+        self.status = status
+
+class DatabaseCircuitOpenError(DatabaseConnectionError):
+    """Request rejected because the circuit breaker is open.
+    """
+    pass
+
 class DatabaseConnection:
     name = None
 
@@ -65,25 +86,175 @@ class DatabaseConnection:
         self.close()
         self.open()
 
-    def io(self, query, data, stream=False, params=None):
+    def io(self, query, data, stream=False, params=None, body=None, format=None):
         raise NotImplementedError
 
 class DatabaseQueryStreamResponse(Generator):
-    def __init__(self, response, convert):
+    def __init__(self, response, convert, convert_batch=None, cancel=None):
+        """Streaming query response.
+
+        :param response: response
+        :param convert: function to convert one line into a row
+        :param convert_batch: function to convert a list of lines
+            into a list of rows, default: None
+        :param cancel: function to stop the query on the server, default: None
+        """
         self.response = response
         self.convert = convert
+        self.convert_batch = convert_batch or (lambda lines: [convert(line) for line in lines])
+        self.cancel_query = cancel
         self.iter = iter(self.response.iter_lines())
+        self.done = False
+        self.done_callbacks = []
+
+    def on_done(self, callback):
+        """Call function once the response is read
+        or cancelled or right away if it already is.
+        """
+        if self.done:
+            callback()
+        else:
+            self.done_callbacks.append(callback)
+
+    def finish(self):
+        self.done = True
+        callbacks, self.done_callbacks = self.done_callbacks, []
+        for callback in callbacks:
+            callback()
 
     def send(self, _):
         try:
             r = next(self.iter)
             return self.convert(r)
-        except Exception as e:
-            self.response.connection.close()
+        except StopIteration:
+            self.finish()
+            raise
+        except Exception:
+            self.cancel()
             raise
 
     def throw(self, type=None, value=None, traceback=None):
-         raise StopIteration
+        # close() throws GeneratorExit when the stream is abandoned
+        self.cancel()
+        raise StopIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cancel()
+
+    def __del__(self):
+        # release the connection of a stream that was dropped without being closed
+        if not getattr(self, "done", True):
+            try:
+                self.cancel()
+            except Exception:
+                pass
+
+    def iter_batches(self, size=10000, chunk_size=1048576):
+        """Iterate over the response in batches of rows.
+
+        The response is read in large chunks and lines are converted
+        in batches so that the per line overhead is small and the memory
+        used is bounded by the chunk and batch size. If iteration is
+        stopped before the response is exhausted then the query
+        is cancelled.
+
+        :param size: maximum number of rows in a batch, default: 10000
+        :param chunk_size: size of the chunk in bytes read from the response,
+            default: 1048576
+        """
+        tail = b""
+        lines = []
+        try:
+            for chunk in self.response.iter_content(chunk_size=chunk_size):
+                chunk = tail + chunk
+                start = 0
+                while True:
+                    end = chunk.find(b"\n", start)
+                    if end < 0:
+                        break
+                    if end > start:
+                        lines.append(chunk[start:end])
+                        if len(lines) >= size:
+                            batch, lines = lines, []
+                            yield self.convert_batch(batch)
+                    start = end + 1
+                tail = chunk[start:]
+            if tail.strip():
+                lines.append(tail)
+            if lines:
+                yield self.convert_batch(lines)
+            self.finish()
+        finally:
+            if not self.done:
+                self.cancel()
+
+    def cancel(self):
+        """Stop reading the response and cancel
+        the query on the server. Called when the stream
+        is closed, exits its context or is garbage collected.
+        """
+        if self.done:
+            return
+        self.response.close()
+        try:
+            if self.cancel_query is not None:
+                self.cancel_query()
+        finally:
+            self.finish()
+
+class AsyncDatabaseConnection:
+    name = None
+
+    def __init__(self):
+        pass
+
+    async def open(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def reset(self):
+        await self.close()
+        await self.open()
+
+    async def io(self, query, data, stream=False, params=None, body=None, format=None):
+        raise NotImplementedError
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+class AsyncDatabaseQueryStreamResponse:
+    def __init__(self, response, convert):
+        self.response = response
+        self.convert = convert
+        self.iter = self.response.content.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            while True:
+                r = (await self.iter.__anext__()).rstrip(b"\r\n")
+                if r:
+                    return self.convert(r)
+        except StopAsyncIteration:
+            self.response.release()
+            raise
+        except Exception:
+            self.response.close()
+            raise
+
+    async def aclose(self):
+        self.response.close()
 
 class DatabaseQueryResponse:
     def __init__(self, response, convert):
@@ -115,31 +286,92 @@ class DatabaseQueryResponse:
     def any(self):
         return self.data
 
+class DatabaseQueryColumnsResponse:
+    def __init__(self, response, convert):
+        self.response = response
+        self.columns = convert(response)
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def keys(self):
+        return self.columns.keys()
+
+    def values(self):
+        return self.columns.values()
+
+    def items(self):
+        return self.columns.items()
+
 class Row:
+    """Table row that stores values in a list
+    indexed using the shared table columns.
+    """
+    __slots__ = ("columns", "_values")
+
     def __init__(self, columns, default_data=None):
         self.columns = columns
         if default_data is None:
             default_data = self.default_data(columns)
-        self.data = OrderedDict(default_data)
+        self._values = [value for _, value in default_data]
+
+    @classmethod
+    def from_values(cls, columns, values):
+        """Return row with a copy of the values.
+        """
+        row = cls.__new__(cls)
+        row.columns = columns
+        row._values = list(values)
+        return row
 
     @classmethod
     def default_data(cls, columns):
         return [(col.name, col.type.default_value) for col in columns.values()]
 
+    @property
+    def data(self):
+        """Read-only mapping of the column names to the values,
+        use item assignment to set values.
+        """
+        return MappingProxyType(OrderedDict(zip(self.columns, self._values)))
+
     def __str__(self):
-        return f'Row{str(self.data).lstrip("OrderedDict")}'
+        return f"Row({list(self.items())})"
 
     def __repr__(self):
-        return f'Row{repr(self.data).lstrip("OrderedDict")}'
+        return f"Row({list(self.items())!r})"
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __contains__(self, key):
+        return key in self.columns
 
     def values(self):
-        return self.data.values()
+        return tuple(self._values)
 
     def keys(self):
-        return self.data.keys()
+        return self.columns.keys()
+
+    def items(self):
+        return zip(self.columns, self._values)
 
     def __getitem__(self, index):
-        return self.data[index]
+        try:
+            return self._values[self.columns[index].index]
+        except KeyError:
+            raise KeyError(index) from None
 
     def __setitem__(self, key, value, raw=False):
         try:
@@ -148,7 +380,59 @@ class Row:
             raise KeyError(f"'{key}' no such column") from None
         if not raw:
             value = col_type.convert(value)
-        self.data[key] = value
+        self._values[col_index] = value
+
+class RowBatch:
+    """Batch of table rows stored column-wise.
+    """
+    __slots__ = ("columns", "data", "count")
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.data = [[] for _ in columns]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("row index out of range")
+        return Row.from_values(self.columns, [column[index] for column in self.data])
+
+    def __iter__(self):
+        for values in zip(*self.data):
+            yield Row.from_values(self.columns, values)
+
+    def column(self, name):
+        """Return values of the column.
+        """
+        return self.data[self.columns[name].index]
+
+    def append(self, row):
+        """Append row which is either a `Row`
+        or a mapping of column names to values that
+        are converted using the column types.
+        """
+        if isinstance(row, Row):
+            values = row._values
+        else:
+            values = [col.type.default_value if row.get(name) is None else col.type.convert(row[name])
+                for name, col in self.columns.items()]
+        for column, value in zip(self.data, values):
+            column.append(value)
+        self.count += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def clear(self):
+        for column in self.data:
+            column.clear()
+        self.count = 0
 
 Column = namedtuple("Column", "name index type")
 
@@ -162,11 +446,16 @@ class Table:
         self.database = database
         self.columns = columns
         self.row_default_data = Row.default_data(columns)
+        self.row_default_values = [value for _, value in self.row_default_data]
 
     def default_row(self):
-        return Row(self.columns, default_data=self.row_default_data)
+        return Row.from_values(self.columns, self.row_default_values)
 
-ColumnType = namedtuple("ColumnType", "name convert default_value")
+    def row_batch(self):
+        return RowBatch(self.columns)
+
+ColumnType = namedtuple("ColumnType", "name convert default_value encode")
+ColumnType.__new__.__defaults__ = (None,)
 
 class ColumnTypes:
     def __getitem__(self, name):
@@ -175,8 +464,13 @@ class ColumnTypes:
 class Database:
     column_types = ColumnTypes()
 
-    def __init__(self, connection):
+    def __init__(self, connection, cache=None):
+        """
+        :param connection: database connection
+        :param cache: query result cache, default: None
+        """
         self.connection = connection
+        self.cache = cache
 
     @property
     def name(self):
@@ -185,5 +479,30 @@ class Database:
     def table(self, name):
         raise NotImplementedError
 
-    def query(self, query, data=None, stream=False, params=None):
-        return self.connection.io(query, data=data, stream=stream, params=params)
+    def query(self, query, data=None, stream=False, params=None, body=None, format=None):
+        if self.cache is None or stream or body is not None:
+            r = self.connection.io(query, data=data, stream=stream, params=params, body=body, format=format)
+        else:
+            r = self.cache.get(query, params, format, server=self.connection.name)
+            if r is None:
+                r = self.connection.io(query, data=data, stream=stream, params=params, body=body, format=format)
+                self.cache.put(query, params, format, r, server=self.connection.name)
+        if self.cache is not None:
+            self.cache.invalidate(query)
+        return r
+
+class AsyncDatabase:
+    column_types = ColumnTypes()
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @property
+    def name(self):
+        return self.connection.name
+
+    async def table(self, name):
+        raise NotImplementedError
+
+    async def query(self, query, data=None, stream=False, params=None, body=None, format=None):
+        return await self.connection.io(query, data=data, stream=stream, params=params, body=body, format=format)
@@ -0,0 +1,226 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import re
+import sys
+import json
+import copy
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from testflows.database.base import DatabaseQueryResponse, DatabaseQueryColumnsResponse
+
+__all__ = ["QueryCache"]
+
+name = r"((?:[`\"]?\w+[`\"]?\.)?[`\"]?\w+[`\"]?)"
+read_re = re.compile(r"\b(?:FROM|JOIN)\s+" + name, re.IGNORECASE)
+write_re = re.compile(r"^\s*(?:INSERT\s+INTO(?:\s+TABLE)?|ALTER\s+TABLE|TRUNCATE(?:\s+TABLE)?"
+    r"|DROP\s+TABLE|RENAME\s+TABLE|OPTIMIZE\s+TABLE)(?:\s+IF\s+EXISTS)?\s+" + name, re.IGNORECASE)
+cacheable_re = re.compile(r"^\s*(?:SELECT|WITH)\b", re.IGNORECASE)
+
+def table_name(name):
+    """Return table name without the database
+    and quotes.
+    """
+    return name.rsplit(".", 1)[-1].strip("`\"")
+
+class Entry:
+    __slots__ = ("expires", "size", "tables", "kind", "value")
+
+    def __init__(self, expires, size, tables, kind, value):
+        self.expires = expires
+        self.size = size
+        self.tables = tables
+        self.kind = kind
+        self.value = value
+
+class QueryCache:
+    """Cache of query results keyed on the server and database,
+    the query text, parameters and format.
+
+    Entries expire after the TTL, least recently used
+    entries are evicted once the total size of cached responses
+    exceeds the limit, and entries that read from a table
+    are invalidated when the table is modified using
+    the same `Database`. Queries that read from `system` tables
+    are not cached.
+
+    Persisted entries are stored as JSON and only row results
+    are persisted, columnar results are only cached in memory.
+    """
+    suffix = ".cache"
+
+    def __init__(self, ttl=60, max_bytes=64 * 1024 * 1024, path=None):
+        """
+        :param ttl: time to live of an entry in seconds, default: 60
+        :param max_bytes: maximum total size of cached responses in bytes,
+            default: 64MiB
+        :param path: directory where entries are persisted, default: None
+        """
+        self.ttl = float(ttl)
+        self.max_bytes = int(max_bytes)
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, query, params=None, format=None, server=None):
+        return hashlib.sha1(json.dumps([server, query, sorted((params or {}).items()), format],
+            default=str).encode("utf-8")).hexdigest()
+
+    def tables(self, query):
+        """Return names of the tables the query reads from
+        or None if the query should not be cached.
+        """
+        if not cacheable_re.match(query):
+            return None
+        tables = read_re.findall(query)
+        for name in tables:
+            if name.strip("`\"").lower().startswith("system."):
+                return None
+        return frozenset(table_name(name) for name in tables)
+
+    def get(self, query, params=None, format=None, server=None):
+        """Return cached response or None.
+
+        :param server: name of the connection to the server and database, default: None
+        """
+        if self.tables(query) is None:
+            return None
+        key = self.key(query, params, format, server)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires < time.time():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        # copy so that callers can't modify the cached value
+        if entry.kind is DatabaseQueryColumnsResponse:
+            value = entry.value.__class__((name, column.copy() if hasattr(column, "copy") else column)
+                for name, column in entry.value.items())
+        else:
+            value = copy.deepcopy(entry.value)
+        return entry.kind(None, convert=lambda r: value)
+
+    def put(self, query, params, format, response, server=None):
+        """Cache query response.
+
+        :param server: name of the connection to the server and database, default: None
+        """
+        tables = self.tables(query)
+        if tables is None:
+            return
+
+        if isinstance(response, DatabaseQueryColumnsResponse):
+            value = response.columns
+        elif isinstance(response, DatabaseQueryResponse):
+            value = response.data
+        else:
+            return
+
+        size = len(response.response.content) if response.response is not None else sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+
+        key = self.key(query, params, format, server)
+        entry = Entry(time.time() + self.ttl, size, tables, type(response), value)
+
+        if self.path is not None and entry.kind is DatabaseQueryResponse:
+            self.save(key, entry)
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key, persisted=False)
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def invalidate(self, query):
+        """Invalidate entries that read from the table
+        modified by the query.
+        """
+        match = write_re.match(query)
+        if match is None:
+            return
+        name = table_name(match.group(1))
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if name in entry.tables]:
+                self.remove(key)
+
+    def clear(self):
+        """Remove all entries.
+        """
+        with self.lock:
+            for key in list(self.entries):
+                self.remove(key)
+
+    def remove(self, key, persisted=True):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        if persisted and self.path is not None:
+            try:
+                os.remove(os.path.join(self.path, key + self.suffix))
+            except FileNotFoundError:
+                pass
+
+    def save(self, key, entry):
+        path = os.path.join(self.path, key + self.suffix)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fd:
+            json.dump([entry.expires, entry.size, sorted(entry.tables), entry.value], fd)
+        os.replace(tmp_path, path)
+
+    def load(self):
+        """Load persisted entries that have not expired.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                with open(path, encoding="utf-8") as fd:
+                    expires, size, tables, value = json.load(fd)
+                entry = Entry(expires, size, frozenset(tables), DatabaseQueryResponse, value)
+            except Exception:
+                entry = None
+            if entry is None or entry.expires < now:
+                os.remove(path)
+                continue
+            entries.append((name[:-len(self.suffix)], entry))
+
+        for key, entry in sorted(entries, key=lambda item: item[1].expires):
+            self.entries[key] = entry
+            self.size += entry.size
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
@@ -18,16 +18,39 @@ from testflows._core.cli.arg.common import epilog
 from testflows._core.cli.arg.common import HelpFormatter
 from testflows._core.cli.arg.handlers.handler import Handler as HandlerBase
 
+from testflows.database._clickhouse.profiles import profiles
+
 class Handler(HandlerBase):
     @classmethod
     def add_command(cls, commands):
         parser = commands.add_parser("create", help="create database", epilog=epilog(),
-            description="Create new database.",
+            description="Create new database by applying all the schema migrations.",
             formatter_class=HelpFormatter)
 
         parser.add_argument("-f", "--force", action="store_true", help="delete any existing database", default=False)
+        parser.add_argument("--profile", type=str, choices=list(profiles), default="default",
+            help="schema profile, default: default")
+        parser.add_argument("--ttl", type=int, default=None,
+            help="number of days messages are kept, default: keep forever")
+        parser.add_argument("--routed", action="store_true", default=False,
+            help="also create keyword-routed tables and their view, default: False")
+        parser.add_argument("--database", dest="options", metavar="name=value", nargs="+",
+            type=argtype.key_value, default=[],
+            help="""database options, for example: 'host=localhost',
+                see '--database' option of the test program for the list of options""")
 
         parser.set_defaults(func=cls())
 
     def handle(self, args):
-        pass
+        from testflows.database.handler import database_connection
+        from testflows.database.clickhouse import Database
+        from testflows.database._clickhouse import migrations
+
+        options = {option.key: option.value for option in args.options}
+        database = Database(connection=database_connection(options))
+
+        applied = migrations.create(database, force=args.force, profile=args.profile, ttl=args.ttl, routed=args.routed,
+            progress=lambda migration: print(f"{migration.version}: {migration.description}"))
+
+        print(f"database is at version {migrations.latest_version()}"
+            + ("" if applied else ", nothing to do"))
@@ -17,6 +17,9 @@ from testflows._core.cli.arg.common import HelpFormatter
 from testflows._core.cli.arg.handlers.handler import Handler as HandlerBase
 
 from .create import Handler as create_handler
+from .load import Handler as load_handler
+from .migrate import Handler as migrate_handler
+from .profiles import Handler as profiles_handler
 
 class Handler(HandlerBase):
     @classmethod
@@ -29,3 +32,6 @@ class Handler(HandlerBase):
             description=None, help=None)
         database_commands.required = True
         create_handler.add_command(database_commands)
+        load_handler.add_command(database_commands)
+        migrate_handler.add_command(database_commands)
+        profiles_handler.add_command(database_commands)
@@ -0,0 +1,77 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+
+import testflows._core.cli.arg.type as argtype
+
+from testflows._core.cli.arg.common import epilog
+from testflows._core.cli.arg.common import HelpFormatter
+from testflows._core.cli.arg.handlers.handler import Handler as HandlerBase
+
+class Handler(HandlerBase):
+    @classmethod
+    def add_command(cls, commands):
+        parser = commands.add_parser("load", help="load logs into database", epilog=epilog(),
+            description="Load log files into database using multiple processes "
+                "to read the logs and multiple connections to insert them.",
+            formatter_class=HelpFormatter)
+
+        parser.add_argument("paths", metavar="path", type=str, nargs="+",
+            help="log file or directory with log files, log files can be compressed")
+        parser.add_argument("--database", dest="options", metavar="name=value", nargs="+",
+            type=argtype.key_value, default=[],
+            help="""database options, for example: 'host=localhost',
+                see '--database' option of the test program for the list of options""")
+        parser.add_argument("--table", type=str, default="messages",
+            help="table name, default: messages")
+        parser.add_argument("--format", type=str, choices=["JSONEachRow", "RowBinary"], default="JSONEachRow",
+            help="insert format, default: JSONEachRow")
+        parser.add_argument("--pattern", type=str, default="*.log*",
+            help="file name pattern used to find log files in directories, default: '*.log*'")
+        parser.add_argument("-w", "--workers", type=int, default=None,
+            help="number of processes used to read logs, default: number of CPUs")
+        parser.add_argument("-c", "--connections", type=int, default=None,
+            help="number of concurrent inserts, default: 5")
+        parser.add_argument("--batch-rows", type=int, default=None,
+            help="maximum number of rows in a batch, default: 100000")
+
+        parser.set_defaults(func=cls())
+
+    def handle(self, args):
+        from testflows.database.handler import database_connection
+        from testflows.database.clickhouse import Database
+        from testflows.database._clickhouse import transform
+        from testflows.database._clickhouse.load import load
+
+        options = {option.key: option.value for option in args.options}
+        json = options.pop("json", None)
+        database = Database(connection=database_connection(options))
+
+        def progress(path, rows, error):
+            if error is not None:
+                print(f"{path}: failed\n{error}", file=sys.stderr)
+            else:
+                print(f"{path}: {rows} rows")
+
+        results = load(database, args.paths, table=args.table, format=args.format,
+            workers=args.workers, connections=args.connections or transform.max_inflight,
+            batch_rows=args.batch_rows or transform.max_batch_rows,
+            pattern=args.pattern, progress=progress, json=json)
+
+        failed = [path for path, rows, error in results if error is not None]
+        print(f"loaded {sum(rows for path, rows, error in results)} rows from {len(results)} files"
+            + (f", {len(failed)} failed" if failed else ""))
+        if failed:
+            sys.exit(1)
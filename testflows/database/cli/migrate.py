@@ -0,0 +1,61 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import testflows._core.cli.arg.type as argtype
+
+from testflows._core.cli.arg.common import epilog
+from testflows._core.cli.arg.common import HelpFormatter
+from testflows._core.cli.arg.handlers.handler import Handler as HandlerBase
+
+class Handler(HandlerBase):
+    @classmethod
+    def add_command(cls, commands):
+        parser = commands.add_parser("migrate", help="migrate database", epilog=epilog(),
+            description="Migrate database schema in place by applying pending migrations.",
+            formatter_class=HelpFormatter)
+
+        parser.add_argument("--database", dest="options", metavar="name=value", nargs="+",
+            type=argtype.key_value, default=[],
+            help="""database options, for example: 'host=localhost',
+                see '--database' option of the test program for the list of options""")
+        parser.add_argument("--to", dest="version", type=int, default=None,
+            help="target version, default: latest")
+        parser.add_argument("--dry-run", action="store_true", default=False,
+            help="only show pending migrations")
+
+        parser.set_defaults(func=cls())
+
+    def handle(self, args):
+        from testflows.database.handler import database_connection
+        from testflows.database.clickhouse import Database
+        from testflows.database._clickhouse import migrations
+
+        options = {option.key: option.value for option in args.options}
+        database = Database(connection=database_connection(options))
+
+        def progress(migration):
+            print(f"{migration.version}: {migration.description}")
+            if args.dry_run:
+                for statement in migration.statements:
+                    print(f"    {statement}")
+
+        if args.dry_run:
+            for migration in migrations.pending(database, args.version):
+                progress(migration)
+            return
+
+        current = migrations.current_version(database)
+        applied = migrations.migrate(database, args.version, progress=progress)
+        print(f"migrated from version {current} to {applied[-1].version}" if applied
+            else f"database is at version {current}, nothing to do")
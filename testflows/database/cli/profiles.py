@@ -0,0 +1,71 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+
+import testflows._core.cli.arg.type as argtype
+
+from testflows._core.cli.arg.common import epilog
+from testflows._core.cli.arg.common import HelpFormatter
+from testflows._core.cli.arg.handlers.handler import Handler as HandlerBase
+
+from testflows.database._clickhouse.profiles import profiles
+
+class Handler(HandlerBase):
+    @classmethod
+    def add_command(cls, commands):
+        parser = commands.add_parser("profiles", help="compare schema profiles", epilog=epilog(),
+            description="Load sample logs into a table for each schema profile "
+                "and report compressed size and scan time of each profile.",
+            formatter_class=HelpFormatter)
+
+        parser.add_argument("paths", metavar="path", type=str, nargs="+",
+            help="log file or directory with log files, log files can be compressed")
+        parser.add_argument("--database", dest="options", metavar="name=value", nargs="+",
+            type=argtype.key_value, default=[],
+            help="""database options, for example: 'host=localhost',
+                see '--database' option of the test program for the list of options""")
+        parser.add_argument("--profile", dest="profiles", type=str, nargs="+",
+            choices=list(profiles), default=list(profiles),
+            help="schema profiles, default: all")
+        parser.add_argument("--repeat", type=int, default=3,
+            help="number of times each scan query is run, default: 3")
+        parser.add_argument("--keep", action="store_true", default=False,
+            help="keep the tables")
+        parser.add_argument("-o", "--output", type=str, default=None,
+            help="write report to file in JSON format")
+
+        parser.set_defaults(func=cls())
+
+    def handle(self, args):
+        from testflows.database.handler import database_connection
+        from testflows.database.clickhouse import Database
+        from testflows.database._clickhouse.profiles import report
+
+        options = {option.key: option.value for option in args.options}
+        database = Database(connection=database_connection(options))
+
+        def progress(r):
+            ratio = r["uncompressed_bytes"] / r["compressed_bytes"] if r["compressed_bytes"] else 0
+            print(f"{r['profile']}: {r['rows']} rows, {r['compressed_bytes']} bytes compressed,"
+                f" {r['uncompressed_bytes']} bytes uncompressed, ratio {ratio:.2f}")
+            for name, seconds in r["scans"].items():
+                print(f"    {name}: {seconds:.4f}s")
+
+        reports = report(database, args.paths, profiles=args.profiles, repeat=args.repeat,
+            keep=args.keep, progress=progress)
+
+        if args.output:
+            with open(args.output, "w") as fd:
+                json.dump(reports, fd, indent=2)
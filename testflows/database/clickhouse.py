@@ -13,5 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from testflows.database._clickhouse.database import *
+from testflows.database._clickhouse.pool import DatabaseConnectionPool
+from testflows.database._clickhouse.retry import RetryPolicy, CircuitBreaker
+from testflows.database.cache import QueryCache
 from testflows.database._clickhouse.schema import schema
 from testflows.database._clickhouse.transform import transform
@@ -12,27 +12,118 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import hashlib
+import threading
+
 import testflows.settings as settings
 
 from testflows.database.pipeline import WriteToDatabasePipeline
-from testflows.database.clickhouse import Database, DatabaseConnection
+from testflows.database.clickhouse import Database, DatabaseConnection, DatabaseConnectionPool
+from testflows.database._clickhouse import transform, jsonbackend
+from testflows.database._clickhouse.checkpoint import Checkpoint
+from testflows.database._clickhouse.adaptive import BatchController
+from testflows.database._clickhouse.retry import CircuitBreaker, retry_policies
+from testflows.database.metrics import registry
 from testflows._core.compress import CompressedFile
 
-def database_handler():
-    """Handler to write output messages to database.
+def database_connection(options):
+    """Return database connection for the handler options.
+    Connection options are removed from the options.
     """
-    options = {option.key: option.value for option in settings.database}
-
-    conn = DatabaseConnection(
-        host=options.pop("host", "localhost"),
+    connection_options = dict(
         database=options.pop("database", "default"),
         user=options.pop("user", None),
         password=options.pop("password", None),
-        port=options.pop("port", 8123)
+        port=options.pop("port", 8123),
+        compression=options.pop("compression", None),
+        response_compression=options.pop("response_compression", None),
+        retry=retry_policies(options.pop("retry", None))
     )
 
+    circuit_breaker_threshold = int(options.pop("circuit_breaker_threshold", 5))
+    circuit_breaker_timeout = float(options.pop("circuit_breaker_timeout", 10))
+
+    if "hosts" in options:
+        conn = DatabaseConnectionPool(
+            hosts=options.pop("hosts"),
+            pool_size=options.pop("pool_size", 5),
+            pool_timeout=options.pop("pool_timeout", 30),
+            policy=options.pop("policy", "round-robin"),
+            **connection_options
+        )
+    else:
+        circuit_breaker = None
+        if circuit_breaker_threshold > 0:
+            circuit_breaker = CircuitBreaker(failure_threshold=circuit_breaker_threshold,
+                recovery_timeout=circuit_breaker_timeout)
+        conn = DatabaseConnection(host=options.pop("host", "localhost"), circuit_breaker=circuit_breaker,
+            **connection_options)
+
+    return conn
+
+def database_handler():
+    """Handler to write output messages to database.
+    """
+    options = {option.key: option.value for option in settings.database}
+
+    conn = database_connection(options)
+
+    transform_options = {
+        "format": options.pop("format", "JSONEachRow"),
+        "max_batch_rows": int(options.pop("max_batch_rows", transform.max_batch_rows)),
+        "max_batch_bytes": int(options.pop("max_batch_bytes", transform.max_batch_bytes)),
+        "max_inflight": int(options.pop("max_inflight", transform.max_inflight)),
+        "spool": options.pop("spool", None),
+        "deduplicate": options.pop("deduplicate", "1").lower() in ("1", "true", "yes", "on"),
+        "async_insert": options.pop("async_insert", "0").lower() in ("1", "true", "yes", "on"),
+        "wait_for_async_insert": options.pop("wait_for_async_insert", "1").lower() in ("1", "true", "yes", "on"),
+        "routed": options.pop("routed", "0").lower() in ("1", "true", "yes", "on")
+    }
+
+    if options.pop("adaptive", "0").lower() in ("1", "true", "yes", "on"):
+        transform_options["controller"] = BatchController(
+            min_flush_interval=float(options.pop("min_flush_interval", 0.25)),
+            max_flush_interval=float(options.pop("max_flush_interval", 10)),
+            min_batch_rows=int(options.pop("min_batch_rows", 1000)),
+            max_batch_rows=transform_options["max_batch_rows"],
+            target_insert_rate=float(options.pop("target_insert_rate", 1)),
+            max_insert_latency=float(options.pop("max_insert_latency", 1)),
+            max_parts=int(options.pop("max_parts", 300))
+        )
+
+    checkpoint = options.pop("checkpoint", None)
+
+    if "json" in options:
+        jsonbackend.set_backend(options.pop("json"))
+
+    if "metrics_port" in options:
+        registry.serve(int(options.pop("metrics_port")))
+
+    metrics_stop = threading.Event()
+    metrics_writer = None
+    if "metrics" in options:
+        metrics_writer = registry.write_snapshots(options.pop("metrics"),
+            interval=float(options.pop("metrics_interval", 10)), stop=metrics_stop)
+
     database = Database(connection=conn)
 
+    try:
+        write(database, checkpoint, transform_options)
+    finally:
+        metrics_stop.set()
+        if metrics_writer is not None:
+            metrics_writer.join()
+
+def write(database, checkpoint, transform_options):
+    """Write messages from the log to database.
+    """
     with CompressedFile(settings.read_logfile, tail=True) as log:
         log.seek(0)
-        WriteToDatabasePipeline(log, database, tail=True).run()
+        if checkpoint is not None:
+            head = hashlib.sha1(log.readline()).hexdigest()
+            checkpoint = Checkpoint(checkpoint, head=head)
+            if checkpoint.complete:
+                return
+            transform_options["checkpoint"] = checkpoint
+            log.seek(checkpoint.offset)
+        WriteToDatabasePipeline(log, database, tail=True, **transform_options).run()
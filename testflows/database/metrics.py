@@ -0,0 +1,227 @@
+# Copyright 2020 Katteli Inc.
+# TestFlows.com Open-Source Software Testing Framework (http://testflows.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import time
+import bisect
+import threading
+
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+__all__ = [
+        "Counter",
+        "Gauge",
+        "Histogram",
+        "Registry",
+        "registry"
+    ]
+
+latency_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+rows_buckets = (1, 10, 100, 1000, 10000, 100000, 1000000)
+bytes_buckets = (1024, 16384, 131072, 1048576, 4194304, 16777216, 67108864)
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, value=1):
+        with self.lock:
+            self.value += value
+
+    def snapshot(self):
+        return self.value
+
+    def prometheus(self):
+        return [f"{self.name} {self.value}"]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, value=1):
+        self.inc(-value)
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help="", buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Return context manager that observes
+        the time spent in its block.
+        """
+        return Timer(self)
+
+    def snapshot(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, buckets = 0, OrderedDict()
+        for bound, n in zip(self.buckets + ("+Inf",), counts):
+            cumulative += n
+            buckets[str(bound)] = cumulative
+        return {"count": count, "sum": total, "buckets": buckets}
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = [f'{self.name}_bucket{{le="{bound}"}} {count}' for bound, count in snapshot["buckets"].items()]
+        lines.append(f"{self.name}_sum {snapshot['sum']}")
+        lines.append(f"{self.name}_count {snapshot['count']}")
+        return lines
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.histogram.observe(time.monotonic() - self.start)
+
+class Registry:
+    """Registry of metrics that can be exported
+    in Prometheus text format or as JSON snapshots.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = OrderedDict()
+
+    def metric(self, cls, name, help, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f"metric '{name}' is already registered as {metric.type}")
+            return metric
+
+    def counter(self, name, help=""):
+        """Return counter with the name creating it if needed.
+        """
+        return self.metric(Counter, name, help)
+
+    def gauge(self, name, help=""):
+        """Return gauge with the name creating it if needed.
+        """
+        return self.metric(Gauge, name, help)
+
+    def histogram(self, name, help="", buckets=latency_buckets):
+        """Return histogram with the name creating it if needed.
+        """
+        return self.metric(Histogram, name, help, buckets=buckets)
+
+    def __getitem__(self, name):
+        return self.metrics[name]
+
+    def __contains__(self, name):
+        return name in self.metrics
+
+    def snapshot(self):
+        """Return dictionary of metric values.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return OrderedDict([(metric.name, metric.snapshot()) for metric in metrics])
+
+    def prometheus(self):
+        """Return metrics in Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            if metric.help:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines += metric.prometheus()
+        return "\n".join(lines) + "\n"
+
+    def write_snapshots(self, path, interval=10, stop=None):
+        """Start a thread that appends a JSON snapshot of the metrics
+        to the file every interval seconds, one snapshot per line.
+
+        :param path: file path
+        :param interval: interval in seconds, default: 10
+        :param stop: stop event, the last snapshot is written once it is set, default: None
+        """
+        stop = stop or threading.Event()
+
+        def write():
+            with open(path, "a") as fd:
+                fd.write(json.dumps({"time": time.time(), "metrics": self.snapshot()}) + "\n")
+
+        def run():
+            while not stop.wait(float(interval)):
+                write()
+            write()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.name = "tfs-database-metrics"
+        thread.start()
+        return thread
+
+    def serve(self, port, host=""):
+        """Start HTTP server that serves the metrics
+        in Prometheus text format on '/metrics'.
+
+        :param port: port
+        :param host: host, default: all interfaces
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.name = "tfs-database-metrics-server"
+        thread.start()
+        return server
+
+registry = Registry()
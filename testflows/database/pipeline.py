@@ -21,12 +21,12 @@ from testflows._core.transform.log.stop import transform as stop_transform
 from testflows.database.clickhouse import transform as write_to_database_transform
 
 class WriteToDatabasePipeline(Pipeline):
-    def __init__(self, input, database, tail=False):
+    def __init__(self, input, database, tail=False, **options):
         stop_event = threading.Event()
 
         steps = [
-            read_transform(input, tail=tail, stop=stop_event),
-            write_to_database_transform(database, stop=stop_event),
+            read_transform(input, tail=tail, offset=options.get("checkpoint") is not None, stop=stop_event),
+            write_to_database_transform(database, stop=stop_event, **options),
             stop_transform(stop_event)
         ]
         super(WriteToDatabasePipeline, self).__init__(steps)
@@ -13,9 +13,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+import json
 import uuid
+import asyncio
 import time
 import datetime
+import tempfile
+import threading
+import gc
 
 from collections import namedtuple
 
@@ -140,6 +146,71 @@ def query_tests(self):
             assert data[0] == {"number":"0"}, error()
             assert data[-1] == {"number":"9999"}, error()
 
+    with Scenario("check streaming in batches"):
+        with When("I run a query that returns large number of entries with stream mode"):
+            r = query("SELECT number FROM system.numbers LIMIT 25000", data=True, stream=True)
+        with And("I consume the entries in batches"):
+            batches = [batch for batch in r.iter_batches(size=10000)]
+        with Then("batches should match the expected"):
+            assert [len(batch) for batch in batches] == [10000, 10000, 5000], error()
+            assert batches[0][0] == {"number":"0"}, error()
+            assert batches[-1][-1] == {"number":"24999"}, error()
+
+        with When("I stop consuming the batches early"):
+            query_id = str(uuid.uuid4())
+            r = query("SELECT number FROM system.numbers LIMIT 1000000", data=True, stream=True,
+                params={"query_id": query_id})
+            for batch in r.iter_batches(size=1000, chunk_size=65536):
+                break
+        with Then("the response should be closed before all the rows were read"):
+            assert r.done is True, error()
+            assert r.response.raw.closed, error()
+            assert r.response.raw.tell() < 1000000 * len('{"number":"0"}\n'), error()
+        with And("the query should not be running on the server"):
+            r = query("SELECT count() AS count FROM system.processes WHERE query_id = {id:String}",
+                data=True, params={"param_id": query_id}).one()
+            assert r == {"count": "0"}, error()
+
+        with And("I can still run other queries"):
+            run_simple_query()
+
+    from testflows.database._clickhouse import jsonbackend
+
+    for backend in jsonbackend.backends:
+        with Scenario(f"query results using {backend} JSON backend"):
+            default_backend = jsonbackend.backend
+            try:
+                with Given(f"I set {backend} JSON backend"):
+                    jsonbackend.set_backend(backend)
+
+                with When("I run a query that returns multiple rows"):
+                    r = query("SELECT number, 'a\\nb' AS str FROM system.numbers LIMIT 10", data=True)
+
+                with Then("rows should match"):
+                    assert r.any() == [{"number": str(i), "str": "a\nb"} for i in range(10)], error()
+
+                with When("I run a query that returns no rows"):
+                    r = query("SELECT * FROM system.one WHERE dummy > 1", data=True)
+
+                with Then("result should be empty"):
+                    assert r.any() == [], error()
+            finally:
+                jsonbackend.set_backend(default_backend)
+
+    for format in ("columns", "TabSeparatedWithNamesAndTypes"):
+        with Scenario(f"columnar results using {format} format"):
+            with When("I run a query that returns columns"):
+                r = query("SELECT number, toString(number) AS str FROM system.numbers LIMIT 10",
+                    data=True, format=format)
+
+            with Then("number of rows should match"):
+                assert len(r) == 10, error()
+
+            with And("columns should match"):
+                assert list(r.keys()) == ["number", "str"], error()
+                assert [int(v) for v in r["number"]] == list(range(10)), error()
+                assert [str(v) for v in r["str"]] == [str(i) for i in range(10)], error()
+
 @TestStep
 def create_test_database(self):
     database_name = f'test_{uuid.uuid1()}'.replace("-", "")
@@ -188,6 +259,26 @@ def database_object(self):
             row['dummy'] = 245
             with Then("new column value should be set"):
                 assert list(row.values()) == ["245"], error()
+            with And("default row should not change"):
+                assert list(table.default_row().values()) == ["0"], error()
+            with And("row data and values should be read-only"):
+                with raises(TypeError):
+                    row.data["dummy"] = 1
+                with raises(AttributeError):
+                    row.values().append(1)
+                assert row["dummy"] == "245", error()
+
+        with When("I add rows to a row batch"):
+            batch = table.row_batch()
+            batch.append(row)
+            batch.append({"dummy": 7})
+            batch.append({})
+            with Then("the rows should be stored column-wise"):
+                assert len(batch) == 3, error()
+                assert batch.column("dummy") == ["245", "7", "0"], error()
+            with And("I can get rows back"):
+                assert str(batch[1]) == "Row([('dummy', '7')])", error()
+                assert [r["dummy"] for r in batch] == ["245", "7", "0"], error()
 
     with Scenario("check types") as self:
         table_name = "supported_types"
@@ -260,6 +351,283 @@ def database_object(self):
                     'enum': 'two', 'nested.str': ['hello'], 'nested.int': [123]}
                 assert r == expected, error()
 
+    with Scenario("insert rows using RowBinary format") as self:
+        table_name = "row_binary_types"
+        Column = namedtuple("Column", "name type")
+
+        columns = [
+            Column("int", "Int8"),
+            Column("uint", "UInt64"),
+            Column("float", "Float64"),
+            Column("str", "String"),
+            Column("date", "Date"),
+            Column("dt", "DateTime"),
+            Column("dt64", "DateTime64"),
+            Column("a_int", "Array(Int8)"),
+            Column("enum", "Enum8(''=10, 'zero'=0, 'one'=1, 'two'=2)"),
+            Column("nested", "Nested(str String, int Int8)")
+        ]
+
+        with Given("I have a database"):
+            with By("creating test database"):
+                create_test_database()
+
+            with And("creating a table that uses all the supported types"):
+                query(f"CREATE TABLE {table_name} (\n"
+                    + ",\n".join(["    %s %s" % (col.name, col.type) for col in columns])
+                    + "\n) ENGINE = Memory()")
+
+        with When("I get table"):
+            table = self.context.database.table(table_name)
+
+        with And("I encode rows in RowBinary format"):
+            rows = [
+                {"int": -5, "uint": 6, "float": 2234.2234, "str": "hello\nthere\t\bvoo",
+                    "date": datetime.date(2020,1,1), "dt": datetime.datetime(2020,1,1),
+                    "dt64": datetime.datetime(2020,1,1), "a_int": [8,5,68], "enum": "two",
+                    "nested.str": ["hello"], "nested.int": [123]},
+                {}
+            ]
+            body = table.encode_rows(rows)
+
+        with And("I insert the rows into the table"):
+            query(f"INSERT INTO {table_name} ({', '.join(table.columns)}) FORMAT RowBinary", body=body)
+
+        with Then("data should match"):
+            r = query(f"SELECT * FROM {table_name} ORDER BY int").all()
+            assert r[0] == {'int': -5, 'uint': '6',
+                'float': 2234.2234, 'str': 'hello\nthere\t\x08voo',
+                'date': '2020-01-01', 'dt': '2020-01-01 00:00:00',
+                'dt64': '2020-01-01 00:00:00.000', 'a_int': [8, 5, 68],
+                'enum': 'two', 'nested.str': ['hello'], 'nested.int': [123]}, error()
+            assert r[1]["str"] == "" and r[1]["a_int"] == [] and r[1]["enum"] == "zero", error()
+
+        with And("encoding a row with invalid enum value should fail"):
+            with raises(ValueError):
+                table.encode_rows([{"enum": "three"}])
+
+        with And("naive datetimes should be encoded as UTC in any local timezone"):
+            tz = os.environ.get("TZ")
+            os.environ["TZ"] = "Asia/Tokyo"
+            time.tzset()
+            try:
+                dt = datetime.datetime(2020,1,1)
+                assert table.columns["dt"].type.encode(dt) == (1577836800).to_bytes(4, "little"), error()
+                assert table.columns["dt64"].type.encode(dt) == (1577836800000).to_bytes(8, "little"), error()
+                assert table.columns["dt64"].type.convert(dt) == "1577836800.000", error()
+            finally:
+                if tz is None:
+                    del os.environ["TZ"]
+                else:
+                    os.environ["TZ"] = tz
+                time.tzset()
+
+    with Scenario("wrapped and composite types") as self:
+        from testflows.database.clickhouse import Database, TableMetadataCache
+
+        with Given("I have a database"):
+            with By("creating test database"):
+                create_test_database()
+
+            with And("creating a table with wrapped and composite types"):
+                query("CREATE TABLE composite_types (n Nullable(UInt8), m Map(String, UInt64),"
+                    " t Tuple(UInt8, String), a Array(Nullable(Int32)), f Nullable(Float64),"
+                    " s SimpleAggregateFunction(sum, UInt64)) ENGINE = Memory()")
+
+        with When("I get table"):
+            table = self.context.database.table("composite_types")
+
+        with Then("each column should have a type"):
+            types = {name: column.type.name for name, column in table.columns.items()}
+            assert types == {"n": "Nullable(UInt8)", "m": "Map(String, UInt64)", "t": "Tuple(UInt8, String)",
+                "a": "Array(Nullable(Int32))", "f": "Nullable(Float64)", "s": "UInt64"}, error()
+
+        with And("table metadata of all tables can be refreshed"):
+            database = Database(self.context.database.connection, metadata=TableMetadataCache())
+            assert list(database.refresh_tables()) == ["composite_types"], error()
+
+        with And("simple aggregate function values should be encoded using the argument type"):
+            assert table.columns["s"].type.encode(3) == (3).to_bytes(8, "little"), error()
+
+        with And("encoding values of wrapped types in RowBinary format should fail"):
+            with raises(TypeError):
+                table.encode_rows([{"n": 1}])
+
+    with Scenario("query parameters") as self:
+        with Given("I have a database"):
+            with By("creating test database"):
+                create_test_database()
+
+        with When("I run a query with parameters of different types"):
+            r = self.context.database.query("SELECT {s:String} AS s, {n:UInt32} AS n, {f:Float64} AS f,"
+                " {d:Date} AS d, {a:Array(String)} AS a, {e:Nullable(String)} AS e",
+                parameters={"s": "it's a\ttab\\ and\nnewline", "n": 42, "f": 0.5,
+                    "d": datetime.date(2020, 1, 2), "a": ["x", "y'z"], "e": None}).one()
+
+        with Then("values should be bound without client-side escaping"):
+            assert r == {"s": "it's a\ttab\\ and\nnewline", "n": 42, "f": 0.5, "d": "2020-01-02",
+                "a": ["x", "y'z"], "e": None}, error()
+
+        with And("invalid parameter names should be rejected"):
+            with raises(ValueError):
+                self.context.database.query("SELECT {x:String}", parameters={"x; DROP": "x"})
+
+        with And("timezone aware datetimes should not depend on the server timezone"):
+            tz = datetime.timezone(datetime.timedelta(hours=9))
+            r = self.context.database.query("SELECT toTimeZone({t:DateTime64(6)}, 'UTC') AS t",
+                parameters={"t": datetime.datetime(2020, 1, 2, 9, 0, 0, 500000, tzinfo=tz)}).one()
+            assert r == {"t": "2020-01-02 00:00:00.500000"}, error()
+
+    with Scenario("executemany") as self:
+        with Given("I have a database"):
+            with By("creating test database"):
+                create_test_database()
+
+            with And("creating a table"):
+                query("CREATE TABLE t (n UInt32, s String, dt DateTime) ENGINE = Memory()")
+
+        with When("I insert rows as dictionaries"):
+            self.context.database.executemany("INSERT INTO t", [{"n": i, "s": f"row '{i}'",
+                "dt": datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=i)} for i in range(100)])
+
+        with And("I insert rows as tuples"):
+            self.context.database.executemany("INSERT INTO t (n, s, dt) VALUES",
+                ((i, "tuple\n", "2020-01-01 00:00:00") for i in range(100, 150)))
+
+        with Then("all rows should be inserted"):
+            r = query("SELECT count() AS count, max(n) AS max, any(s) LIKE 'row%' AS like,"
+                " max(dt) AS dt FROM t WHERE n < 100").one()
+            assert r == {"count": "100", "max": 99, "like": 1, "dt": "2020-01-01 00:01:39"}, error()
+            assert query("SELECT count() AS count FROM t WHERE s = {s:String}",
+                parameters={"s": "tuple\n"}).one() == {"count": "50"}, error()
+
+        with And("only INSERT queries should be supported"):
+            with raises(ValueError):
+                self.context.database.executemany("SELECT 1", [{}])
+
+        with And("queries with anything but VALUES after the table should be rejected"):
+            for statement in ("INSERT INTO t SELECT 1, 'x', now()", "INSERT INTO t VALUES (1, 'x', now())",
+                    "INSERT INTO t (n) SELECT 1"):
+                with raises(ValueError):
+                    self.context.database.executemany(statement, [{}])
+
+    with Scenario("query result cache") as self:
+        from testflows.database.clickhouse import QueryCache
+
+        with Given("I have a database"):
+            with By("creating test database"):
+                create_test_database()
+
+            with And("creating a table"):
+                query("CREATE TABLE cached (x UInt8) ENGINE = Memory()")
+
+        with And("I enable query result cache"):
+            path = tempfile.mkdtemp()
+            cache = QueryCache(ttl=60, path=path)
+            self.context.database.cache = cache
+
+        with When("I run the same query twice"):
+            r1 = query("SELECT count() AS c FROM cached").one()
+            r2 = query("SELECT count() AS c FROM cached").one()
+
+        with Then("second query should be a cache hit"):
+            assert r1 == r2 == {"c": "0"}, error()
+            assert (cache.hits, cache.misses) == (1, 1), error()
+
+        with When("I insert into the table"):
+            query("INSERT INTO cached VALUES (1)")
+
+        with Then("cached result should be invalidated"):
+            assert query("SELECT count() AS c FROM cached").one() == {"c": "1"}, error()
+            assert (cache.hits, cache.misses) == (1, 2), error()
+
+        with When("I open the cache from the same directory"):
+            persisted = QueryCache(ttl=60, path=path)
+
+        with Then("persisted result should be used"):
+            server = self.context.database.connection.name
+            assert persisted.get("SELECT count() AS c FROM cached", server=server).one() == {"c": "1"}, error()
+
+        with And("results should not be shared with other databases"):
+            assert persisted.get("SELECT count() AS c FROM cached", server="other@" + server) is None, error()
+
+        with And("entries should be persisted as JSON"):
+            for name in os.listdir(path):
+                with open(os.path.join(path, name)) as fd:
+                    json.load(fd)
+
+        with When("I modify the returned result"):
+            persisted.get("SELECT count() AS c FROM cached", server=server).one()["c"] = "100"
+
+        with Then("cached result should not change"):
+            assert persisted.get("SELECT count() AS c FROM cached", server=server).one() == {"c": "1"}, error()
+
+        with When("I truncate the table"):
+            query("TRUNCATE TABLE cached")
+
+        with Then("cached result should be invalidated"):
+            assert len(cache) == 0, error()
+            assert len(QueryCache(ttl=60, path=path)) == 0, error()
+
+        with When("I run queries that exceed the size limit"):
+            cache.max_bytes = 100
+            query("INSERT INTO cached VALUES (1)")
+            for i in range(10):
+                query(f"SELECT {i} AS number FROM cached")
+
+        with Then("least recently used results should be evicted"):
+            assert 0 < len(cache) < 10 and cache.size <= 100, error()
+
+    with Scenario("table metadata cache") as self:
+        from testflows.database.clickhouse import Database, TableMetadataCache
+
+        with Given("I have a database"):
+            with By("creating test database"):
+                create_test_database()
+
+            with And("creating tables"):
+                query("CREATE TABLE first (x UInt8) ENGINE = Memory()")
+                query("CREATE TABLE second (y String) ENGINE = Memory()")
+
+        with And("I have two database objects that share table metadata cache"):
+            metadata = TableMetadataCache(check_interval=0)
+            databases = [Database(self.context.database.connection, metadata=metadata) for i in range(2)]
+
+        with When("I get the same table using both database objects"):
+            tables = [database.table("first") for database in databases]
+
+        with Then("the same table object should be returned"):
+            assert tables[0] is tables[1], error()
+            assert list(tables[0].columns) == ["x"], error()
+
+        with When("I modify the table"):
+            query("ALTER TABLE first ADD COLUMN z UInt8")
+
+        with Then("table metadata should be refreshed"):
+            table = databases[0].table("first")
+            assert table is not tables[0], error()
+            assert list(table.columns) == ["x", "z"], error()
+
+        with When("I modify the table again within the same second"):
+            query("ALTER TABLE first MODIFY COLUMN z String")
+
+        with Then("table metadata should be refreshed again"):
+            assert databases[1].table("first").columns["z"].type.name == "String", error()
+
+        with When("I refresh metadata of all tables"):
+            tables = databases[1].refresh_tables()
+
+        with Then("all tables should be cached"):
+            assert sorted(tables) == ["first", "second"], error()
+            assert databases[0].table("second") is tables["second"], error()
+
+        with When("I drop the table"):
+            query("DROP TABLE second")
+
+        with Then("getting the table should fail"):
+            with raises(KeyError):
+                databases[0].table("second")
+
     with Scenario("use schema") as self:
         with Given("I have a database"):
             with By("creating test database"):
@@ -302,6 +670,893 @@ def database_object(self):
                 assert row2["attribute_name"] == '\'"attr2"\'', error()
 
 
+@TestFeature
+def database_connection_pool(self):
+    with Given("I import objects"):
+        from testflows.database.clickhouse import DatabaseConnectionPool
+
+        with When("I create connection pool object"):
+            self.context.connection = DatabaseConnectionPool(["localhost", "localhost:8123"], "default")
+
+    query_tests(self)
+
+    for policy in ("round-robin", "least-loaded"):
+        with Scenario(f"failover using {policy} policy") as self:
+            with When("I create connection pool with one replica that is down"):
+                pool = DatabaseConnectionPool(["localhost:1", "localhost"], "default",
+                    policy=policy, health_check_interval=0.1)
+                self.context.connection = pool
+
+            with And("I run simple queries"):
+                for i in range(4):
+                    run_simple_query()
+
+            with Then("replica that is down should be marked as unhealthy"):
+                assert [replica.healthy for replica in pool.replicas] == [False, True], error()
+
+            with And("it should stay unhealthy after health check"):
+                pool.check_health()
+                assert pool.replicas[0].healthy is False, error()
+
+            with Finally("I close the pool"):
+                pool.close()
+
+    with Scenario("streaming queries stay in flight until read") as self:
+        with When("I create connection pool using least-loaded policy"):
+            pool = DatabaseConnectionPool(["localhost", "localhost:8123"], "default", policy="least-loaded")
+
+        with And("I start streaming query results"):
+            r = pool.io("SELECT number FROM system.numbers LIMIT 10000", data=True, stream=True)
+
+        with Then("the query should be in flight"):
+            assert sum(replica.inflight for replica in pool.replicas) == 1, error()
+
+        with When("I read all the results"):
+            data = [entry for entry in r]
+
+        with Then("the query should not be in flight"):
+            assert len(data) == 10000, error()
+            assert sum(replica.inflight for replica in pool.replicas) == 0, error()
+
+        with When("I cancel streaming query"):
+            r = pool.io("SELECT number FROM system.numbers LIMIT 1000000", data=True, stream=True)
+            r.cancel()
+
+        with Then("the query should not be in flight"):
+            assert sum(replica.inflight for replica in pool.replicas) == 0, error()
+
+        with When("I close streaming query after reading some results"):
+            r = pool.io("SELECT number FROM system.numbers LIMIT 1000000", data=True, stream=True)
+            next(r)
+            r.close()
+
+        with Then("the query should not be in flight"):
+            assert sum(replica.inflight for replica in pool.replicas) == 0, error()
+
+        with When("I read only some results using the stream as a context manager"):
+            with pool.io("SELECT number FROM system.numbers LIMIT 1000000", data=True, stream=True) as r:
+                next(r)
+
+        with Then("the query should not be in flight"):
+            assert sum(replica.inflight for replica in pool.replicas) == 0, error()
+
+        with When("I abandon streaming query"):
+            r = pool.io("SELECT number FROM system.numbers LIMIT 1000000", data=True, stream=True)
+            next(r)
+            del r
+            gc.collect()
+
+        with Then("the query should not be in flight"):
+            assert sum(replica.inflight for replica in pool.replicas) == 0, error()
+
+        with Finally("I close the pool"):
+            pool.close()
+
+    with Scenario("no free connections") as self:
+        from testflows.database.clickhouse import DatabaseConnectionError
+
+        with When("I create connection pool with one connection"):
+            pool = DatabaseConnectionPool(["localhost"], "default", pool_size=1, pool_timeout=0.1)
+
+        try:
+            with And("I start streaming query results"):
+                r = pool.io("SELECT number FROM system.numbers LIMIT 1000000", data=True, stream=True)
+
+            with Then("another query should fail instead of waiting for a free connection"):
+                with raises(DatabaseConnectionError):
+                    pool.io("SELECT 1", data=True)
+
+            with And("the replica should stay healthy"):
+                assert pool.replicas[0].healthy is True, error()
+                assert pool.replicas[0].inflight == 1, error()
+
+            with When("I close streaming query"):
+                r.close()
+
+            with Then("another query should work"):
+                pool.io("SELECT 1", data=True)
+        finally:
+            with Finally("I close the pool"):
+                pool.close()
+
+    with Scenario("all replicas are down") as self:
+        with When("I create connection pool where all replicas are down"):
+            self.context.connection = DatabaseConnectionPool(["localhost:1", "localhost:2"], "default")
+
+        with Then("query should raise an exception"):
+            from testflows.database.clickhouse import DatabaseConnectionError
+            with raises(DatabaseConnectionError):
+                self.context.connection.io("SELECT 1", data=True)
+
+@TestFeature
+def async_database_object(self):
+    with Given("I import objects"):
+        from testflows.database.clickhouse import AsyncDatabase, AsyncDatabaseConnection
+
+    def run(coroutine, database="default"):
+        async def session():
+            async with AsyncDatabaseConnection(host="localhost", database=database) as conn:
+                return await coroutine(AsyncDatabase(conn))
+        return asyncio.run(session())
+
+    with Scenario("simple query"):
+        with When("I run simple query"):
+            async def simple_query(database):
+                return await database.query("SELECT 1")
+            r = run(simple_query)
+
+        with Then("it should work"):
+            assert r.data == [{"1": 1}], error()
+
+    with Scenario("concurrent queries"):
+        with When("I run many queries concurrently"):
+            async def concurrent_queries(database):
+                return await asyncio.gather(*[database.query(f"SELECT {i} AS i") for i in range(200)])
+            r = run(concurrent_queries)
+
+        with Then("each query should return its own result"):
+            assert [e.one()["i"] for e in r] == list(range(200)), error()
+
+    with Scenario("query error"):
+        with When("I run invalid query"):
+            async def invalid_query(database):
+                from testflows.database.clickhouse import DatabaseError
+                try:
+                    await database.query("SELECT no_such_column")
+                except DatabaseError as exc:
+                    return exc
+
+        with Then("it should raise an exception"):
+            assert run(invalid_query) is not None, error()
+
+    with Scenario("streaming"):
+        with When("I run a query that returns large number of entries with stream mode"):
+            async def streaming_query(database):
+                r = await database.query("SELECT number FROM system.numbers LIMIT 10000", stream=True)
+                return [entry async for entry in r]
+            data = run(streaming_query)
+
+        with Then("entries should match the expected"):
+            assert data[0] == {"number":"0"}, error()
+            assert data[-1] == {"number":"9999"}, error()
+
+    with Scenario("use table"):
+        with When("I get table"):
+            async def get_table(database):
+                return await database.table("one")
+            table = run(get_table, database="system")
+
+        with Then("I check the row"):
+            assert str(table.default_row()) == "Row([('dummy', '0')])", error()
+
+def log_messages(count, keyword="NOTE"):
+    """Return log lines that mimic test log messages.
+    """
+    test_id = f"/{uuid.uuid1()}"
+    return [json.dumps({"message_keyword": keyword, "message_hash": "00000000",
+        "message_object": 0, "message_num": i, "message_stream": None, "message_level": 1,
+        "message_time": time.time(), "message_rtime": 0.1, "test_type": "Test",
+        "test_subtype": "Scenario", "test_id": test_id, "test_name": "/test",
+        "test_flags": 0, "test_cflags": 0, "test_level": 1, "message": f"message {i}"},
+        separators=(",", ":")) + "\n" for i in range(count)]
+
+def result_messages(run, results, start=0):
+    """Return log lines of the results of a run where
+    the first result is the result of the top level test.
+    """
+    return [json.dumps({"message_keyword": "RESULT", "message_num": i, "message_time": start + 10 + i,
+        "message_rtime": 1.0 + i, "test_type": "Test" if i else "Module", "test_id": run + (f"/{i}" if i else ""),
+        "test_name": "/module" + (f"/test {i}" if i else ""), "result_type": result},
+        separators=(",", ":")) + "\n" for i, result in enumerate(results)]
+
+def write_messages(database, lines, **kwargs):
+    """Send log lines through the database writer transform.
+    """
+    from testflows.database.clickhouse import transform
+
+    stop = threading.Event()
+    writer = transform(database, stop, **kwargs)
+    next(writer)
+    for i, line in enumerate(lines):
+        if i == len(lines) - 1:
+            stop.set()
+        writer.send(line)
+
+@TestStep(Given)
+def messages_table(self):
+    """Create test database and messages table.
+    """
+    with By("creating test database"):
+        create_test_database()
+
+    with And("loading schema"):
+        from testflows.database.clickhouse import schema
+        for statement in schema:
+            query(statement)
+
+@TestFeature
+def write_to_database(self):
+    for format in ("JSONEachRow", "RowBinary"):
+        with Scenario(f"write messages using {format} format") as self:
+            with Given("I have messages table"):
+                messages_table()
+
+            with When("I write messages in small batches"):
+                lines = log_messages(1000)
+                write_messages(self.context.database, lines, format=format, max_batch_rows=100)
+
+            with Then("all messages should be written"):
+                r = query("SELECT count() AS count, uniqExact(message_num) AS nums FROM messages").one()
+                assert r == {"count": "1000", "nums": "1000"}, error()
+
+    for format in ("JSONEachRow", "RowBinary"):
+        with Scenario(f"load log files using {format} format") as self:
+            from testflows.database._clickhouse.load import load
+            import gzip
+
+            with Given("I have messages table"):
+                messages_table()
+
+            with And("I have a directory with plain and compressed log files"):
+                path = tempfile.mkdtemp()
+                os.makedirs(os.path.join(path, "nested"))
+                files = [os.path.join(path, "first.log"), os.path.join(path, "nested", "second.log.gz"),
+                    os.path.join(path, "nested", "third.log")]
+                for i, name in enumerate(files):
+                    data = "".join(log_messages(250 * (i + 1))).encode("utf-8")
+                    with (gzip.open if name.endswith(".gz") else open)(name, "wb") as fd:
+                        fd.write(data)
+
+            with When("I load the directory"):
+                results = load(self.context.database, [path], format=format,
+                    workers=2, connections=3, batch_rows=100)
+
+            with Then("each file should be loaded"):
+                assert sorted(results) == sorted([(name, 250 * (i + 1), None) for i, name in enumerate(files)]), error()
+
+            with And("all messages should be written"):
+                r = query("SELECT count() AS count FROM messages").one()
+                assert r == {"count": "1500"}, error()
+
+            with When("I load the directory again"):
+                load(self.context.database, [path], format=format, workers=2, connections=3, batch_rows=100)
+
+            with Then("inserts should be deduplicated"):
+                r = query("SELECT count() AS count FROM messages").one()
+                assert r == {"count": "1500"}, error()
+
+    with Scenario("load log files into a table that does not exist") as self:
+        from testflows.database._clickhouse.load import load
+
+        with Given("I have messages table"):
+            messages_table()
+
+        with And("I have a log file"):
+            path = os.path.join(tempfile.mkdtemp(), "first.log")
+            with open(path, "w") as fd:
+                fd.write("".join(log_messages(10)))
+
+        with When("I load the file into a table that does not exist"):
+            results = load(self.context.database, [path], table="no_such_table", workers=1)
+
+        with Then("no rows should be counted for the file"):
+            [(name, rows, error_message)] = results
+            assert name == path and rows == 0, error()
+            assert error_message is not None, error()
+
+    with Scenario("load log files when worker processes exit") as self:
+        from testflows.database._clickhouse import load
+
+        with Given("I have messages table"):
+            messages_table()
+
+        with And("I have log files"):
+            path = tempfile.mkdtemp()
+            files = [os.path.join(path, f"{i}.log") for i in range(2)]
+            for name in files:
+                with open(name, "w") as fd:
+                    fd.write("".join(log_messages(10)))
+
+        with And("worker processes exit without reporting any results"):
+            encode_file = load.encode_file
+            load.encode_file = lambda *args: os._exit(3)
+
+        try:
+            with When("I load the files"):
+                results = load.load(self.context.database, files, workers=2, json="json")
+        finally:
+            load.encode_file = encode_file
+
+        with Then("each file should fail instead of waiting forever"):
+            assert [path for path, rows, error in results] == files, error()
+            for path, rows, error_message in results:
+                assert "exit codes: 3" in error_message, error()
+
+    with Scenario("schema migrations") as self:
+        from testflows.database._clickhouse import migrations
+
+        with Given("I have messages table created without migrations"):
+            messages_table()
+
+        with And("it has messages"):
+            write_messages(self.context.database, log_messages(100))
+
+        with When("I migrate to version 2"):
+            applied = migrations.migrate(self.context.database, 2)
+
+        with Then("first migrations should be applied"):
+            assert [m.version for m in applied] == [1, 2], error()
+            assert migrations.current_version(self.context.database) == 2, error()
+
+        with When("I migrate to the latest version"):
+            applied = migrations.migrate(self.context.database)
+
+        with Then("remaining migrations should be applied"):
+            assert [m.version for m in applied] == list(range(3, migrations.latest_version() + 1)), error()
+
+        with And("skip indexes should exist"):
+            r = query("SELECT name, type FROM system.data_skipping_indices"
+                " WHERE database = currentDatabase() AND table = 'messages' ORDER BY name").all()
+            assert r == [{"name": "attribute_name_idx", "type": "bloom_filter"},
+                {"name": "result_type_idx", "type": "bloom_filter"},
+                {"name": "test_name_idx", "type": "bloom_filter"},
+                {"name": "test_top_key_idx", "type": "minmax"}], error()
+
+        with And("there should be no projections that copy the messages"):
+            r = query("SELECT count() AS count FROM system.projections"
+                " WHERE database = currentDatabase() AND table = 'messages'").one()
+            assert r == {"count": "0"}, error()
+
+        with And("messages should be kept"):
+            assert query("SELECT count() AS count FROM messages").one() == {"count": "100"}, error()
+
+        with When("I write messages of another run"):
+            write_messages(self.context.database, log_messages(20000))
+            query("OPTIMIZE TABLE messages FINAL")
+
+        with Then("per-run queries should skip granules of other runs using the per-run skip index"):
+            run = query("SELECT test_top FROM messages ORDER BY message_time LIMIT 1").one()["test_top"]
+            plan = [entry["explain"].strip() for entry in query("EXPLAIN indexes = 1 SELECT count() FROM messages"
+                " WHERE test_top_key = cityHash64({run:String})", parameters={"run": run}).all()]
+            index = plan.index("Name: test_top_key_idx")
+            granules = next(line for line in plan[index:] if line.startswith("Granules: "))
+            selected, total = map(int, granules.split(": ")[1].split("/"))
+            assert selected < total, error()
+
+        with And("migrating again should do nothing"):
+            assert migrations.migrate(self.context.database) == [], error()
+
+        with And("migrating to an older version should fail"):
+            with raises(ValueError):
+                migrations.migrate(self.context.database, 1)
+
+        with When("I create database using force"):
+            applied = migrations.create(self.context.database, force=True)
+
+        with Then("all migrations should be applied to an empty table"):
+            assert len(applied) == len(migrations.migrations), error()
+            assert query("SELECT count() AS count FROM messages").one() == {"count": "0"}, error()
+
+    with Scenario("storage schema profile") as self:
+        from testflows.database._clickhouse import migrations
+        from testflows.database._clickhouse.profiles import report
+
+        with Given("I have a database"):
+            create_test_database()
+
+        with When("I create messages table using storage profile with TTL"):
+            migrations.create(self.context.database, profile="storage", ttl=30, routed=True)
+
+        with Then("columns should use LowCardinality and codecs"):
+            r = {entry["name"]: entry for entry in query("SELECT name, type, compression_codec FROM system.columns"
+                " WHERE database = currentDatabase() AND table = 'messages'").all()}
+            assert r["attribute_name"]["type"] == "LowCardinality(String)", error()
+            assert r["message_num"]["compression_codec"] == "CODEC(DoubleDelta, ZSTD(1))", error()
+            assert r["message_time"]["compression_codec"] == "CODEC(Delta(8), ZSTD(1))", error()
+            assert r["message"]["compression_codec"] == "CODEC(ZSTD(3))", error()
+
+        with And("table should have TTL that drops whole parts"):
+            r = query("SELECT create_table_query FROM system.tables"
+                " WHERE database = currentDatabase() AND name = 'messages'").one()["create_table_query"]
+            assert "TTL message_date + toIntervalDay(30)" in r, error()
+            assert "ttl_only_drop_parts = 1" in r, error()
+
+        with And("routed tables should use the profile and TTL"):
+            r = query("SELECT create_table_query FROM system.tables"
+                " WHERE database = currentDatabase() AND name = 'messages_attribute'").one()["create_table_query"]
+            assert "`attribute_name` LowCardinality(String)" in r, error()
+            assert "TTL message_date + toIntervalDay(30)" in r, error()
+
+        with And("all migrations should be applied"):
+            assert migrations.current_version(self.context.database) == migrations.latest_version(), error()
+
+        with And("messages can be written using RowBinary format"):
+            write_messages(self.context.database, log_messages(100), format="RowBinary")
+            assert query("SELECT count() AS count FROM messages").one() == {"count": "100"}, error()
+
+        with When("I report profiles for a sample log"):
+            path = os.path.join(tempfile.mkdtemp(), "sample.log")
+            with open(path, "w") as fd:
+                fd.write("".join(log_messages(500)))
+            reports = report(self.context.database, [path], repeat=1)
+
+        with Then("each profile should be reported"):
+            assert [r["profile"] for r in reports] == ["default", "storage"], error()
+            for r in reports:
+                assert r["rows"] == 500, error()
+                assert r["compressed_bytes"] > 0, error()
+                assert len(r["scans"]) == 5, error()
+
+        with And("report tables should be removed"):
+            assert query("SELECT count() AS count FROM system.tables WHERE database = currentDatabase()"
+                " AND name IN ('messages_default', 'messages_storage')").one() == {"count": "0"}, error()
+
+    with Scenario("keyword routed tables") as self:
+        from testflows.database._clickhouse import migrations
+
+        with Given("I have a database"):
+            create_test_database()
+
+        with When("I create database"):
+            migrations.create(self.context.database)
+
+        with Then("routed tables should not be created"):
+            r = query("SELECT count() AS count FROM system.tables WHERE database = currentDatabase()"
+                " AND name LIKE 'messages\\_%'").one()
+            assert r == {"count": "0"}, error()
+
+        with When("I create database with routed tables"):
+            applied = migrations.create(self.context.database, routed=True)
+
+        with Then("no migrations should be applied"):
+            assert applied == [], error()
+
+        with And("routed tables should only have their own columns"):
+            columns = query("SELECT name FROM system.columns"
+                " WHERE database = currentDatabase() AND table = 'messages_result'").all()
+            names = [column["name"] for column in columns]
+            assert "result_type" in names and "test_name" in names, error()
+            assert "attribute_name" not in names and "message" not in names, error()
+
+        for format in ("JSONEachRow", "RowBinary"):
+            with When(f"I write messages with different keywords using {format} format"):
+                write_messages(self.context.database, log_messages(100) + log_messages(20, "RESULT")
+                    + log_messages(10, "ATTRIBUTE"), max_batch_rows=50, routed=True, format=format)
+
+        with Then("each message should be written to the table of its route"):
+            for table, count in (("messages_message", "200"), ("messages_result", "40"),
+                    ("messages_attribute", "20"), ("messages_test", "0")):
+                assert query(f"SELECT count() AS count FROM {table}").one() == {"count": count}, error()
+
+        with And("view should merge the routed tables back"):
+            view = self.context.database.routed_view()
+            assert view.name == "messages_view", error()
+            assert "attribute_name" in view.columns and "message" in view.columns, error()
+            r = query("SELECT message_keyword, count() AS count, max(message) AS message"
+                " FROM messages_view GROUP BY message_keyword ORDER BY message_keyword").all()
+            assert r == [
+                {"message_keyword": "RESULT", "count": "40", "message": ""},
+                {"message_keyword": "NOTE", "count": "200", "message": "message 99"},
+                {"message_keyword": "ATTRIBUTE", "count": "20", "message": ""}
+            ], error()
+
+        with And("routed tables should have the skip indexes of their columns"):
+            r = query("SELECT table, groupArray(name) AS names FROM (SELECT table, name"
+                " FROM system.data_skipping_indices WHERE database = currentDatabase()"
+                " AND table IN ('messages_result', 'messages_attribute') ORDER BY table, name) GROUP BY table ORDER BY table").all()
+            assert r == [{"table": "messages_attribute", "names": ["attribute_name_idx", "test_name_idx", "test_top_key_idx"]},
+                {"table": "messages_result", "names": ["result_type_idx", "test_name_idx", "test_top_key_idx"]}], error()
+
+        with And("routed tables should not have projections"):
+            r = query("SELECT count() AS count FROM system.projections"
+                " WHERE database = currentDatabase() AND table LIKE 'messages\\_%'").one()
+            assert r == {"count": "0"}, error()
+
+        with When("I write results of a run to the routed tables"):
+            write_messages(self.context.database, result_messages("/routed", ["Fail", "OK", "Fail"], start=3000),
+                routed=True)
+
+        with Then("run summary should count them"):
+            r = self.context.database.run_summary("/routed")
+            assert r is not None and r["result"] == "Fail", error()
+            assert (r["tests"], r["passed"], r["failed"]) == ("2", "1", "1"), error()
+
+    with Scenario("test results rollup") as self:
+        from testflows.database._clickhouse import migrations
+
+        with Given("I have messages table with results of a run"):
+            create_test_database()
+            migrations.migrate(self.context.database, 4)
+            write_messages(self.context.database, result_messages("/run1", ["OK", "OK", "Fail", "OK"], start=1000))
+
+        with When("I migrate to the latest version"):
+            migrations.migrate(self.context.database)
+
+        with Then("existing results should be aggregated"):
+            assert query("SELECT sum(result_count) AS count FROM results_rollup").one() == {"count": "4"}, error()
+
+        with When("I write results of another run"):
+            write_messages(self.context.database, result_messages("/run2", ["Fail", "OK", "OK", "Error", "Skip"],
+                start=2000))
+
+        with Then("rollup should have existing and new results"):
+            assert query("SELECT count() AS count FROM results_rollup").one() == {"count": "9"}, error()
+
+        with When("the backfill is interrupted before it is marked as done"):
+            r = query("SELECT run, max_block FROM results_rollup_backfills FINAL WHERE source = 'messages'").one()
+            query("ALTER TABLE results_rollup_backfills DELETE WHERE source = 'messages' SETTINGS mutations_sync = 1")
+            query("INSERT INTO results_rollup_backfills (source, run, max_block)"
+                " VALUES ('messages', {run:UUID}, {max_block:Int64})", parameters=r)
+            migrations.run(self.context.database, migrations.migrations[4].statements)
+
+        with Then("the backfill should not be applied twice"):
+            assert query("SELECT sum(result_count) AS count FROM results_rollup").one() == {"count": "9"}, error()
+            assert query("SELECT backfilled FROM results_rollup_backfills FINAL"
+                " WHERE source = 'messages'").one() == {"backfilled": 1}, error()
+
+        with And("results written after the view was created should not be backfilled"):
+            r = self.context.database.run_summary("/run2")
+            assert (r["tests"], r["passed"], r["failed"], r["errored"], r["skipped"]) == ("4", "2", "0", "1", "1"), error()
+
+        with And("run summary should count results of the tests"):
+            r = self.context.database.run_summary("/run2")
+            assert r["test_name"] == "/module" and r["result"] == "Fail", error()
+            assert (r["tests"], r["passed"], r["failed"], r["errored"], r["skipped"]) == ("4", "2", "0", "1", "1"), error()
+            assert (r["started"], r["ended"], r["duration"]) == (2009, 2014, 5), error()
+            assert self.context.database.run_summary("/run3") is None, error()
+
+        with And("run summaries should start with the latest run"):
+            r = self.context.database.run_summaries()
+            assert [run["test_top"] for run in r] == ["/run2", "/run1"], error()
+
+        with And("flaky tests should have both passing and failing results"):
+            r = self.context.database.test_summaries(flaky=True)
+            assert [(test["test_name"], test["flakiness"]) for test in r] == [
+                ("/module/test 2", 0.5), ("/module/test 3", 0.5)], error()
+            assert r[0]["duration_quantiles"] == [3, 3, 3], error()
+
+        with When("I run the rollup statements again"):
+            migrations.run(self.context.database, migrations.migrations[4].statements)
+
+        with Then("existing results should not be aggregated again"):
+            r = self.context.database.run_summary("/run1")
+            assert (r["tests"], r["passed"], r["failed"]) == ("3", "2", "1"), error()
+            assert query("SELECT sum(result_count) AS count FROM results_rollup").one() == {"count": "9"}, error()
+
+    with Scenario("writer metrics") as self:
+        from testflows.database.metrics import Registry, registry
+
+        with Given("I have messages table"):
+            messages_table()
+
+        with When("I write messages using a metrics registry"):
+            metrics = Registry()
+            requests = registry["database_io_requests_total"].value
+            write_messages(self.context.database, log_messages(1000), max_batch_rows=100, metrics=metrics)
+
+        with Then("message counters should match"):
+            assert metrics["database_writer_messages_total"].value == 1000, error()
+            assert metrics["database_writer_committed_messages_total"].value == 1000, error()
+            assert metrics["database_writer_lag_messages"].value == 0, error()
+            assert metrics["database_writer_inflight"].value == 0, error()
+
+        with And("batch histograms should be updated"):
+            snapshot = metrics.snapshot()
+            assert snapshot["database_writer_batch_rows"]["count"] == 10, error()
+            assert snapshot["database_writer_batch_rows"]["sum"] == 1000, error()
+            assert snapshot["database_writer_write_seconds"]["buckets"]["+Inf"] == 10, error()
+
+        with And("connection metrics should be updated"):
+            assert registry["database_io_requests_total"].value >= requests + 10, error()
+
+        with And("sent bytes should count encoded request bodies"):
+            sent = registry["database_io_sent_bytes_total"].value
+            self.context.database.query("SELECT 'ünïcödé' AS x")
+            size = len("SELECT 'ünïcödé' AS x FORMAT JSONEachRow".encode("utf-8"))
+            assert registry["database_io_sent_bytes_total"].value == sent + size, error()
+
+        with And("metrics should be exportable"):
+            json.dumps(snapshot)
+            text = metrics.prometheus()
+            assert "# TYPE database_writer_messages_total counter" in text, error()
+            assert "database_writer_messages_total 1000" in text, error()
+            assert 'database_writer_batch_rows_bucket{le="100"} 10' in text, error()
+
+    with Scenario("adaptive batch controller") as self:
+        from testflows.database._clickhouse.adaptive import BatchController
+
+        with Given("I have a batch controller"):
+            controller = BatchController(min_flush_interval=0.5, max_flush_interval=8,
+                min_batch_rows=100, max_batch_rows=10000, target_insert_rate=1,
+                max_insert_latency=1, max_parts=100)
+
+        with Then("flush interval should target the insert rate"):
+            assert controller.flush_interval == 1, error()
+            assert controller.batch_rows == 10000, error()
+
+        with When("inserts are slow"):
+            for i in range(3):
+                controller.observe(rows=10000, latency=4)
+
+        with Then("batch size should decrease and flush interval increase"):
+            assert controller.batch_rows == 1250, error()
+            assert controller.flush_interval == 4, error()
+
+        with When("full batches are inserted quickly"):
+            for i in range(20):
+                controller.observe(rows=controller.batch_rows, latency=0.01)
+
+        with Then("batch size should grow back and flush interval recover"):
+            assert controller.batch_rows == 10000, error()
+            assert controller.flush_interval == 1, error()
+
+        with When("a partition has too many parts"):
+            controller.observe_parts(400)
+
+        with Then("flush interval should increase up to the maximum"):
+            assert controller.flush_interval == 8, error()
+
+        with When("parts are merged"):
+            controller.observe_parts(10)
+
+        with Then("flush interval should return to the target"):
+            assert controller.flush_interval == 1, error()
+
+    with Scenario("write messages using adaptive batch controller") as self:
+        from testflows.database._clickhouse.adaptive import BatchController
+        from testflows.database.metrics import Registry
+
+        with Given("I have messages table"):
+            messages_table()
+
+        with When("I write messages using the batch controller"):
+            metrics = Registry()
+            controller = BatchController(min_batch_rows=10, max_batch_rows=200, min_flush_interval=0.1)
+            write_messages(self.context.database, log_messages(1000), format="RowBinary",
+                controller=controller, metrics=metrics)
+
+        with Then("all messages should be written"):
+            r = query("SELECT count() AS count FROM messages").one()
+            assert r == {"count": "1000"}, error()
+
+        with And("controller state should be reported"):
+            assert controller.latency is not None, error()
+            assert controller.parts is not None, error()
+            assert metrics["database_writer_batch_rows_limit"].value == controller.batch_rows, error()
+            assert metrics["database_writer_flush_interval_seconds"].value == controller.flush_interval, error()
+
+    with Scenario("backpressure when database is slow") as self:
+        with Given("I have messages table"):
+            messages_table()
+
+        with And("database that is slow to insert"):
+            class SlowDatabase:
+                def __init__(self, database):
+                    self.database = database
+                    self.inflight = 0
+                    self.max_inflight = 0
+                    self.lock = threading.Lock()
+
+                def table(self, name):
+                    return self.database.table(name)
+
+                def query(self, query, **kwargs):
+                    with self.lock:
+                        self.inflight += 1
+                        self.max_inflight = max(self.max_inflight, self.inflight)
+                    try:
+                        time.sleep(0.05)
+                        return self.database.query(query, **kwargs)
+                    finally:
+                        with self.lock:
+                            self.inflight -= 1
+
+            database = SlowDatabase(self.context.database)
+
+        with When("I write messages with limited number of inserts in flight"):
+            write_messages(database, log_messages(2000), max_batch_rows=10, max_inflight=2)
+
+        with Then("number of concurrent inserts should not exceed the limit"):
+            assert database.max_inflight <= 2, error()
+
+        with And("all messages should be written"):
+            r = query("SELECT count() AS count FROM messages").one()
+            assert r == {"count": "2000"}, error()
+
+    with Scenario("batch size limit counts encoded bytes"):
+        from testflows.database._clickhouse.transform import Buffer
+
+        with When("I append a message with multi-byte characters"):
+            buffer = Buffer()
+            buffer.append("\u00e9" * 10 + "\n")
+
+        with Then("buffer size should be the size of the message in UTF-8"):
+            assert buffer.size == 21, error()
+
+    with Scenario("spool batches when database is down") as self:
+        with Given("I have messages table"):
+            messages_table()
+
+        with And("database that is down"):
+            class FailingDatabase:
+                def __init__(self, database):
+                    self.database = database
+                    self.down = True
+
+                def table(self, name):
+                    return self.database.table(name)
+
+                def query(self, query, **kwargs):
+                    if self.down:
+                        from testflows.database.clickhouse import DatabaseConnectionError
+                        raise DatabaseConnectionError("database is down")
+                    return self.database.query(query, **kwargs)
+
+            database = FailingDatabase(self.context.database)
+            spool = os.path.join(tempfile.mkdtemp(), "spool")
+
+        with When("I write messages while database is down"):
+            from testflows.database._clickhouse import transform
+            with By("reducing spool drain timeout"):
+                spool_drain_timeout, transform.spool_drain_timeout = transform.spool_drain_timeout, 0.5
+            try:
+                write_messages(database, log_messages(1000), max_batch_rows=100, spool=spool)
+            finally:
+                transform.spool_drain_timeout = spool_drain_timeout
+
+        with Then("batches should be spooled"):
+            assert len(os.listdir(spool)) > 0, error()
+
+        with When("database is back up and I write more messages"):
+            database.down = False
+            write_messages(database, log_messages(100), spool=spool)
+
+        with Then("spooled batches should be replayed"):
+            assert os.listdir(spool) == [], error()
+            r = query("SELECT count() AS count FROM messages").one()
+            assert r == {"count": "1100"}, error()
+
+    with Scenario("quarantine batches rejected by the server") as self:
+        from testflows.database._clickhouse.spool import Spool
+
+        with Given("I have messages table"):
+            messages_table()
+
+        with And("a spool with a batch the server can't parse"):
+            spool = os.path.join(tempfile.mkdtemp(), "spool")
+            Spool(spool).append("INSERT INTO messages FORMAT JSONEachRow", b"not json\n")
+
+        with When("I write messages using the spool"):
+            write_messages(self.context.database, log_messages(100) + ['{"message_keyword":"NOTE","message_num":"x"}\n'],
+                max_batch_rows=50, spool=spool)
+
+        with Then("rejected batches should be quarantined with their errors"):
+            quarantined = Spool(spool).quarantined()
+            assert len(quarantined) == 2, error()
+            assert len(Spool(spool)) == 0, error()
+            with open(os.path.join(spool, "quarantine", quarantined[0].replace(".batch", ".error"))) as fd:
+                assert "Code:" in fd.read(), error()
+
+        with And("other batches should be inserted"):
+            r = query("SELECT count() AS count FROM messages").one()
+            assert r == {"count": "100"}, error()
+
+        with When("I restart the spool and quarantine another batch"):
+            contents = {}
+            for name in os.listdir(os.path.join(spool, "quarantine")):
+                with open(os.path.join(spool, "quarantine", name), "rb") as fd:
+                    contents[name] = fd.read()
+            name = Spool(spool).quarantine("INSERT INTO messages FORMAT JSONEachRow", b"bad\n", "Code: 27.")
+
+        with Then("existing quarantined batches should not be overwritten"):
+            assert name not in quarantined, error()
+            assert Spool(spool).quarantined() == sorted(quarantined + [name]), error()
+            for entry, data in contents.items():
+                with open(os.path.join(spool, "quarantine", entry), "rb") as fd:
+                    assert fd.read() == data, error()
+
+    with Scenario("insert deduplication tokens") as self:
+        with Given("I have messages table"):
+            messages_table()
+
+        with And("database that loses the response of the first insert"):
+            class FlakyDatabase:
+                def __init__(self, database):
+                    self.database = database
+                    self.params = []
+                    self.lock = threading.Lock()
+
+                def table(self, name):
+                    return self.database.table(name)
+
+                def query(self, query, params=None, **kwargs):
+                    r = self.database.query(query, params=params, **kwargs)
+                    with self.lock:
+                        self.params.append(params)
+                        first = len(self.params) == 1
+                    if first:
+                        from testflows.database.clickhouse import DatabaseConnectionError
+                        raise DatabaseConnectionError("connection reset")
+                    return r
+
+            database = FlakyDatabase(self.context.database)
+            spool = os.path.join(tempfile.mkdtemp(), "spool")
+
+        with When("I write messages using asynchronous inserts"):
+            write_messages(database, log_messages(500), max_batch_rows=100, max_inflight=1,
+                spool=spool, async_insert=True, wait_for_async_insert=False)
+
+        with Then("the retried batch should reuse its token"):
+            tokens = [params["insert_deduplication_token"] for params in database.params]
+            assert len(tokens) == 6, error()
+            assert tokens.count(tokens[0]) == 2, error()
+            assert len(set(tokens)) == 5, error()
+
+        with And("asynchronous insert settings should be sent"):
+            for params in database.params:
+                assert params["async_insert"] == 1, error()
+                assert params["wait_for_async_insert"] == 0, error()
+                assert params["async_insert_deduplicate"] == 1, error()
+
+    with Scenario("resume from checkpoint") as self:
+        with Given("I have messages table"):
+            messages_table()
+
+        with And("I have a log file"):
+            lines = log_messages(1000) + log_messages(1, keyword="STOP")
+            log = os.path.join(tempfile.mkdtemp(), "test.log")
+            with open(log, "w") as fd:
+                fd.write("".join(lines))
+            checkpoint_path = log + ".checkpoint"
+
+        with When("I write first part of the log and stop"):
+            from testflows.database._clickhouse.checkpoint import Checkpoint
+            offsets = [sum(len(line.encode("utf-8")) for line in lines[:i]) for i in range(600)]
+            write_messages(self.context.database, list(zip(lines[:600], offsets)),
+                max_batch_rows=100, checkpoint=Checkpoint(checkpoint_path, head="test"))
+
+        with Then("checkpoint should be at the end of the last written message"):
+            checkpoint = Checkpoint(checkpoint_path, head="test")
+            assert checkpoint.offset == sum(len(line.encode("utf-8")) for line in lines[:600]), error()
+
+        with When("I resume writing the log from the checkpoint"):
+            from testflows.database.pipeline import WriteToDatabasePipeline
+            with open(log, "rb") as fd:
+                fd.seek(checkpoint.offset)
+                WriteToDatabasePipeline(fd, self.context.database, checkpoint=checkpoint).run()
+
+        with Then("each message should be written only once"):
+            r = query("SELECT count() AS count FROM messages").one()
+            assert r == {"count": "1001"}, error()
+
+        with And("checkpoint should be at the end of the log"):
+            checkpoint = Checkpoint(checkpoint_path, head="test")
+            assert checkpoint.offset == os.path.getsize(log), error()
+            assert checkpoint.complete is True, error()
+
+        with And("checkpoint for a different log should be ignored"):
+            assert Checkpoint(checkpoint_path, head="other").offset == 0, error()
+
 @TestFeature
 def database_connection_object(self):
     with Given("I import objects"):
@@ -328,10 +1583,184 @@ def database_connection_object(self):
         with And("I run simple query"):
             run_simple_query()
 
+    with Scenario("compressed connection"):
+        for compression in ("gzip", "deflate"):
+            with When(f"I create connection that uses {compression} compression"):
+                self.context.connection = DatabaseConnection("localhost", "default",
+                    compression=compression, response_compression=compression)
+            with And("I run simple query"):
+                run_simple_query()
+            with And("I stream query results"):
+                r = query("SELECT number FROM system.numbers LIMIT 10000", data=True, stream=True)
+                data = [entry for entry in r]
+            with Then("entries should match the expected"):
+                assert data[-1] == {"number":"9999"}, error()
+
+        with When("I create connection that uses unsupported compression"):
+            with Then("it should raise an exception"):
+                with raises(ValueError):
+                    DatabaseConnection("localhost", "default", compression="xz")
+
+        with When("I create connection that uses response compression the installed urllib3 can't decode"):
+            from testflows.database._clickhouse.database import decompressors
+            with Then("it should raise an exception"):
+                for compression in ("zstd", "br"):
+                    if compression not in decompressors:
+                        with raises(ValueError):
+                            DatabaseConnection("localhost", "default", response_compression=compression)
+
+        with Finally("I restore the default connection"):
+            self.context.connection = DatabaseConnection("localhost", "default")
+
+    with Scenario("retry policies"):
+        from testflows.database.clickhouse import RetryPolicy, DatabaseServerError, DatabaseConnectionError
+        from testflows.database._clickhouse.retry import error_class, retry_policies
+
+        with When("I create retry policy without jitter"):
+            policy = RetryPolicy(retries=4, backoff=0.5, max_backoff=2, jitter=0)
+
+        with Then("backoff should grow exponentially up to the maximum"):
+            assert [policy.delay(attempt) for attempt in range(5)] == [0.5, 1, 2, 2, None], error()
+
+        with And("jitter should only reduce the backoff"):
+            policy = RetryPolicy(retries=10, backoff=1, max_backoff=1, jitter=0.5)
+            assert all(0.5 <= policy.delay(0) <= 1 for i in range(100)), error()
+
+        with And("errors should be classified"):
+            assert error_class(DatabaseConnectionError()) == "connection", error()
+            assert error_class(DatabaseServerError("Code: 252. DB::Exception: Too many parts", 500)) == "too_many_parts", error()
+            assert error_class(DatabaseServerError("Code: 202. DB::Exception: Too many simultaneous queries", 500)) == "overloaded", error()
+            assert error_class(DatabaseServerError("Service Unavailable", 503)) == "unavailable", error()
+            assert error_class(DatabaseServerError("Code: 62. DB::Exception: Syntax error", 400)) is None, error()
+
+        with And("policies should be configurable per error class"):
+            policies = retry_policies("too_many_parts:20:2:60,connection:0")
+            assert "connection" not in policies, error()
+            assert policies["too_many_parts"].retries == 20, error()
+            assert policies["too_many_parts"].max_backoff == 60, error()
+            assert policies["unavailable"].retries == 5, error()
+            with raises(ValueError):
+                retry_policies("unknown:1")
+
+    with Scenario("retry transient errors"):
+        from testflows.database.clickhouse import RetryPolicy, DatabaseServerError
+        from testflows.database.metrics import registry
+
+        with Given("connection where the first inserts fail with too many parts"):
+            connection = DatabaseConnection("localhost", "default",
+                retry={"too_many_parts": RetryPolicy(retries=3, backoff=0.01)})
+            post = connection.post
+            failures = []
+
+            def flaky_post(query, params, stream):
+                if len(failures) < 2:
+                    failures.append(query)
+                    raise DatabaseServerError("Code: 252. DB::Exception: Too many parts (300)", 500)
+                return post(query, params, stream)
+
+            connection.post = flaky_post
+            retries = registry["database_io_retries_total"].value
+
+        with When("I run query"):
+            r = connection.io("SELECT 1 AS one", data=True).one()
+
+        with Then("query should succeed after retries"):
+            assert r == {"one": 1}, error()
+            assert len(failures) == 2, error()
+            assert registry["database_io_retries_total"].value == retries + 2, error()
+
+        with When("query fails with an error that is not transient"):
+            with Then("it should not be retried"):
+                with raises(DatabaseServerError):
+                    connection.io("SELECT no_such_column", data=True)
+                assert registry["database_io_retries_total"].value == retries + 2, error()
+
+        with When("insert fails with a connection error"):
+            from testflows.database.clickhouse import DatabaseConnectionError
+            connection.retry = {"connection": RetryPolicy(retries=3, backoff=0.01)}
+            sent = []
+
+            def failing_post(query, params, stream):
+                sent.append(query)
+                raise DatabaseConnectionError("read timeout")
+
+            connection.post = failing_post
+
+            with Then("insert without deduplication token should not be retried"):
+                with raises(DatabaseConnectionError):
+                    connection.io("INSERT INTO t FORMAT JSONEachRow", body=b"{}")
+                assert len(sent) == 1, error()
+
+            with And("insert with deduplication token should be retried"):
+                with raises(DatabaseConnectionError):
+                    connection.io("INSERT INTO t FORMAT JSONEachRow", body=b"{}",
+                        params={"insert_deduplication_token": "token"})
+                assert len(sent) == 5, error()
+
+            with And("INSERT ... SELECT should not be retried"):
+                with raises(DatabaseConnectionError):
+                    connection.io("INSERT INTO t SELECT * FROM s")
+                assert len(sent) == 6, error()
+
+    with Scenario("circuit breaker"):
+        from testflows.database.clickhouse import CircuitBreaker, DatabaseCircuitOpenError, DatabaseConnectionError
+
+        with Given("connection to a server that is down"):
+            transitions = []
+            breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=0.2,
+                on_transition=lambda name, old, new: transitions.append((old, new)))
+            connection = DatabaseConnection("localhost", "default", retry={}, circuit_breaker=breaker)
+            post = connection.post
+            sent = []
+            down = [True]
+
+            def failing_post(query, params, stream):
+                sent.append(query)
+                if down[0]:
+                    raise DatabaseConnectionError("connection refused")
+                return post(query, params, stream)
+
+            connection.post = failing_post
+
+        with When("queries fail"):
+            for i in range(3):
+                with raises(DatabaseConnectionError):
+                    connection.io("SELECT 1", data=True)
+
+        with Then("circuit should open and reject queries without sending them"):
+            assert breaker.state == "open", error()
+            with raises(DatabaseCircuitOpenError):
+                connection.io("SELECT 1", data=True)
+            assert len(sent) == 3, error()
+
+        with When("trial query fails after the recovery timeout"):
+            time.sleep(0.25)
+            with raises(DatabaseConnectionError):
+                connection.io("SELECT 1", data=True)
+
+        with Then("circuit should open again"):
+            assert breaker.state == "open", error()
+
+        with When("server recovers"):
+            down[0] = False
+            time.sleep(0.25)
+            r = connection.io("SELECT 1 AS one", data=True).one()
+
+        with Then("circuit should close"):
+            assert r == {"one": 1}, error()
+            assert breaker.state == "closed", error()
+
+        with And("state transitions should be reported"):
+            assert transitions == [("closed", "open"), ("open", "half-open"), ("half-open", "open"),
+                ("open", "half-open"), ("half-open", "closed")], error()
+
     query_tests(self)
 
 if main():
     with Module("regression"):
         Feature(run=database_connection_object)
+        Feature(run=database_connection_pool)
         Feature(run=database_object)
+        Feature(run=async_database_object)
+        Feature(run=write_to_database)
 